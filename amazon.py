@@ -1,151 +1,339 @@
 import argparse
 import csv
+import io
 import logging
+import math
 import os
 import sys
-from collections import defaultdict
-from datetime import datetime, timedelta
+import zipfile
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import IO, NamedTuple
 
 from dotenv import load_dotenv
-from lunchable import TransactionUpdateObject
+from lunchable import LunchMoney, TransactionUpdateObject
+from lunchable.models import TransactionObject
 
+from assignment import connected_components, min_cost_assignment
 from constants import NOTES_MAX_LENGTH
-from deepinfra import get_suggested_category_id
-from lunch import get_lunch_client
+from deepinfra import get_suggested_category_ids
+from lunch import get_lunch_client, get_lunch_client_for_chat_id
+from transaction_mirror import get_transaction_mirror
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("amz")
 
 
 def parse_date_time(d: str) -> datetime:
-    try:
-        return datetime.strptime(d, "%Y-%m-%dT%H:%M:%S.%fZ")
-    except ValueError:
-        return datetime.strptime(d, "%Y-%m-%dT%H:%M:%SZ")
-
+    # dates look like 2024-01-31T12:34:56Z or 2024-01-31T12:34:56.789Z. fromisoformat parses
+    # both several times faster than strptime, which adds up over years of orders
+    return datetime.fromisoformat(d).replace(tzinfo=None)
+
+
+# how far (in the transaction currency) an order total can be from the transaction amount
+MARGIN_OF_ERROR = 0.5
+
+# the folder of the data export zip where the order history CSV is
+ORDER_HISTORY_FOLDER = "Retail.OrderHistory.1"
+
+
+class AmazonOrderRow(NamedTuple):
+    """The columns of an export row that matching needs. The export has many more."""
+
+    total_owed: str
+    currency: str
+    product_name: str
+
+
+@dataclass
+class AmazonOrder:
+    """An order of the export, with all of its rows (one per product)."""
+
+    order_id: str
+    order_date: datetime
+    currency: str
+    # position of the order in the export, so ties are broken like a top to bottom scan would
+    seq: int
+    total_owed: float = 0.0
+    product_names: list[str] = field(default_factory=list)
+    rows: list[AmazonOrderRow] = field(default_factory=list)
+
+
+@dataclass
+class AmazonMatchCandidate:
+    """Something a transaction can match: either a whole order, or a single row of it."""
+
+    order: AmazonOrder
+    # the row of the order this candidate stands for, or None for the whole order
+    row_idx: int | None
+    date: datetime
+    amount: float
+    currency: str
+
+    @property
+    def key(self) -> tuple[int, int]:
+        # unique per candidate, and sorts like the export (an order before its rows)
+        return self.order.seq, -1 if self.row_idx is None else self.row_idx
+
+    def as_match(self) -> dict[str, str]:
+        if self.row_idx is None:
+            return {
+                "Order ID": self.order.order_id,
+                "Total Owed": str(self.order.total_owed),
+                "Currency": self.order.currency,
+                "Product Name": ", ".join(self.order.product_names),
+            }
+        row = self.order.rows[self.row_idx]
+        return {
+            "Order ID": self.order.order_id,
+            "Total Owed": row.total_owed,
+            "Currency": row.currency,
+            "Product Name": row.product_name,
+        }
+
+
+class AmazonOrderIndex:
+    """The orders of an Amazon export, indexed to find the order that matches a transaction.
+
+    The export is parsed once. Orders (aggregated by ID) and their individual rows are put in
+    buckets by currency and amount, each bucket MARGIN_OF_ERROR wide and sorted by date, so a
+    lookup only looks at the (at most 3) buckets within the margin of the amount, and bisects
+    them down to the dates within the allowed range.
+
+    A transaction matches the order with the closest date whose total is within the margin. The
+    rows of an order are only matched individually when the order total is not within it (e.g.
+    when Amazon charged the items of an order separately).
+    """
+
+    def __init__(self, margin_of_error: float = MARGIN_OF_ERROR):
+        self.margin_of_error = margin_of_error
+        self.orders: dict[str, AmazonOrder] = {}
+        self._buckets: dict[tuple[str, int], tuple[list[datetime], list[AmazonMatchCandidate]]] = {}
+        # what get_amazon_transactions_summary reports, collected while indexing
+        self.row_count = 0
+        self.start_date: datetime | None = None
+        self.end_date: datetime | None = None
+
+    @classmethod
+    def from_csv(cls, file_path: str, margin_of_error: float = MARGIN_OF_ERROR) -> "AmazonOrderIndex":
+        with open(file_path, newline="", encoding="utf-8-sig") as csvfile:
+            return cls.from_rows(csv.DictReader(csvfile), margin_of_error)
+
+    @classmethod
+    def from_csv_stream(cls, stream: IO[bytes], margin_of_error: float = MARGIN_OF_ERROR) -> "AmazonOrderIndex":
+        """Indexes a CSV read from a binary stream, one row at a time."""
+        with io.TextIOWrapper(stream, encoding="utf-8-sig", newline="") as csvfile:
+            return cls.from_rows(csv.DictReader(csvfile), margin_of_error)
+
+    @classmethod
+    def from_zip(cls, zip_file: str | IO[bytes], margin_of_error: float = MARGIN_OF_ERROR) -> "AmazonOrderIndex | None":
+        """Indexes the order history CSV of a data export zip, decompressing it as it is read.
+
+        Returns None if the zip has no order history CSV.
+        """
+        with zipfile.ZipFile(zip_file) as archive:
+            for info in archive.infolist():
+                if info.filename.lower().endswith(".csv") and ORDER_HISTORY_FOLDER in info.filename:
+                    logger.info(f"Indexing {info.filename} ({info.file_size} bytes) from the zip")
+                    with archive.open(info) as stream:
+                        return cls.from_csv_stream(stream, margin_of_error)
+        return None
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[dict[str, str]], margin_of_error: float = MARGIN_OF_ERROR) -> "AmazonOrderIndex":
+        index = cls(margin_of_error)
+        candidates = []
+        for row in rows:
+            order_id = row["Order ID"]
+            order = index.orders.get(order_id)
+            row_date = parse_date_time(row["Order Date"])
+            if order is None:
+                # the rows of an order share its date, the first one is used as the order date
+                order = AmazonOrder(order_id, row_date, row["Currency"], seq=len(index.orders))
+                index.orders[order_id] = order
 
-def find_closest_match(
-    order_data: dict, target_date_dt: datetime, target_price: float, target_currency: str, margin_of_error: float
-) -> dict[str, str] | None:
-    """Find the closest matching order from the processed order data."""
-    closest_result = None
-    closest_date_diff = timedelta.max
-
-    # Check aggregated data against target price and currency
-    for order_id, data in order_data.items():
-        if abs(data.total_owed - target_price) <= margin_of_error and data.currency.lower() == target_currency.lower():
-            date_diff = abs(target_date_dt - parse_date_time(data.rows[0]["Order Date"]))
-            if date_diff < closest_date_diff:
-                closest_date_diff = date_diff
-                closest_result = {
-                    "Order ID": order_id,
-                    "Total Owed": str(data.total_owed),
-                    "Currency": data.currency,
-                    "Product Name": ", ".join(data.product_names),
-                }
-        else:
-            # Check individual rows if the aggregated total does not match
-            for row in data.rows:
-                total_owed = float(row["Total Owed"].replace(",", ""))
-                currency = row["Currency"]
-                if abs(total_owed - target_price) <= margin_of_error and currency.lower() == target_currency.lower():
-                    date_diff = abs(target_date_dt - parse_date_time(row["Order Date"]))
-                    if date_diff < closest_date_diff:
-                        closest_date_diff = date_diff
-                        closest_result = {
-                            "Order ID": row["Order ID"],
-                            "Total Owed": row["Total Owed"],
-                            "Currency": row["Currency"],
-                            "Product Name": row["Product Name"],
-                        }
-
-    return closest_result
+            total_owed = float(row["Total Owed"].replace(",", ""))
+            order.total_owed += total_owed
+            order.currency = row["Currency"]
+            order.product_names.append(row["Product Name"])
+            order.rows.append(AmazonOrderRow(row["Total Owed"], row["Currency"], row["Product Name"]))
+            candidates.append(AmazonMatchCandidate(order, len(order.rows) - 1, row_date, total_owed, row["Currency"]))
+
+            index.row_count += 1
+            if index.start_date is None or row_date < index.start_date:
+                index.start_date = row_date
+            if index.end_date is None or row_date > index.end_date:
+                index.end_date = row_date
+
+        for order in index.orders.values():
+            candidates.append(AmazonMatchCandidate(order, None, order.order_date, order.total_owed, order.currency))
+
+        for candidate in sorted(candidates, key=lambda c: c.date):
+            dates, entries = index._buckets.setdefault(
+                index._bucket_key(candidate.currency, candidate.amount), ([], [])
+            )
+            dates.append(candidate.date)
+            entries.append(candidate)
+        return index
+
+    def summary(self) -> dict:
+        return {
+            "total_transactions": self.row_count,
+            "start_date": self.start_date.strftime("%Y-%m-%d") if self.start_date else None,
+            "end_date": self.end_date.strftime("%Y-%m-%d") if self.end_date else None,
+        }
+
+    def _bucket_key(self, currency: str, amount: float) -> tuple[str, int]:
+        return currency.lower(), math.floor(amount / self.margin_of_error)
+
+    def _order_matches(self, order: AmazonOrder, price: float, currency: str) -> bool:
+        return abs(order.total_owed - price) <= self.margin_of_error and order.currency.lower() == currency
+
+    def find_candidates(
+        self, target_date: date, target_price: float, target_currency: str | None, allow_days: int
+    ) -> list[tuple[timedelta, AmazonMatchCandidate]]:
+        """Returns what the transaction can match, with how far from its date, closest (then first) first."""
+        currency = (target_currency or "USD").lower()
+        target_date_dt = datetime(target_date.year, target_date.month, target_date.day)
+        start_date = target_date_dt - timedelta(days=allow_days)
+        end_date = target_date_dt + timedelta(days=allow_days)
+
+        low = math.floor((target_price - self.margin_of_error) / self.margin_of_error)
+        high = math.floor((target_price + self.margin_of_error) / self.margin_of_error)
+
+        found = []
+        for bucket in range(low, high + 1):
+            dates, entries = self._buckets.get((currency, bucket), ([], []))
+            for candidate in entries[bisect_left(dates, start_date) : bisect_right(dates, end_date)]:
+                if abs(candidate.amount - target_price) > self.margin_of_error:
+                    continue
+                matches_order = self._order_matches(candidate.order, target_price, currency)
+                # whole orders are matched when their total is in the margin, their rows otherwise
+                if (candidate.row_idx is None) != matches_order:
+                    continue
+                found.append((abs(target_date_dt - candidate.date), candidate))
+
+        found.sort(key=lambda f: (f[0], f[1].key))
+        return found
+
+    def find_closest_match(
+        self, target_date: date, target_price: float, target_currency: str | None, allow_days: int
+    ) -> dict[str, str] | None:
+        """Finds the order (or order row) closest in date to the transaction whose amount is within the margin."""
+        found = self.find_candidates(target_date, target_price, target_currency, allow_days)
+        return found[0][1].as_match() if found else None
+
+    def match_transactions(self, transactions: list[TransactionObject], allow_days: int) -> "AmazonMatching":
+        """Matches each transaction to a different order (or order row), as close in date as possible overall.
+
+        Matching each transaction to its closest order on its own can give the same order to two
+        purchases of the same price. Instead, transactions and the orders they can match form a
+        graph, and each connected component of it is solved as a minimum cost assignment: as many
+        transactions as possible get an order, and then the total distance in days is minimized.
+        """
+        candidates: dict[int, list[tuple[timedelta, AmazonMatchCandidate]]] = {}
+        edges = []
+        for tx in transactions:
+            candidates[tx.id] = self.find_candidates(tx.date, tx.amount, tx.currency, allow_days)
+            edges.extend((tx.id, candidate.key) for _, candidate in candidates[tx.id])
+
+        matching = AmazonMatching()
+        for tx_ids, keys in connected_components(edges):
+            for tx_id, candidate in self._assign(tx_ids, sorted(keys), candidates).items():
+                if candidate is None:
+                    matching.unmatched.append(tx_id)
+                    continue
+                matching.matches[tx_id] = candidate.as_match()
+                # another candidate just as close means the pick between them was arbitrary
+                assigned_diff = next(diff for diff, c in candidates[tx_id] if c is candidate)
+                if sum(diff == assigned_diff for diff, _ in candidates[tx_id]) > 1:
+                    matching.ambiguous.append(tx_id)
+
+        matching.unmatched.extend(tx.id for tx in transactions if not candidates[tx.id])
+        return matching
+
+    @staticmethod
+    def _assign(
+        tx_ids: list[int],
+        keys: list[tuple[int, int]],
+        candidates: dict[int, list[tuple[timedelta, AmazonMatchCandidate]]],
+    ) -> dict[int, AmazonMatchCandidate | None]:
+        """Solves the assignment of one connected component of transactions and candidates."""
+        if len(tx_ids) == 1:
+            # nothing to compete with, the closest candidate wins
+            return {tx_ids[0]: candidates[tx_ids[0]][0][1]}
+
+        # the cost of a candidate is its distance in seconds, and among equally distant ones the
+        # candidate that comes first in the export is cheaper, like when matching one by one
+        column = {key: idx for idx, key in enumerate(keys)}
+        real_costs = {
+            (tx_id, column[candidate.key]): int(diff.total_seconds()) * (len(keys) + 1) + column[candidate.key]
+            for tx_id in tx_ids
+            for diff, candidate in candidates[tx_id]
+        }
+        # leaving a transaction unmatched costs more than any rearrangement of the others, and an
+        # impossible pair costs more than leaving them all unmatched
+        unmatched_cost = (len(tx_ids) + 1) * (max(real_costs.values()) + 1)
+        impossible_cost = (len(tx_ids) + 1) * unmatched_cost
+
+        costs = []
+        for tx_id in tx_ids:
+            row = [real_costs.get((tx_id, idx), impossible_cost) for idx in range(len(keys))]
+            costs.append(row + [unmatched_cost] * len(tx_ids))
+
+        by_key = {candidate.key: candidate for tx_id in tx_ids for _, candidate in candidates[tx_id]}
+        assigned = {}
+        for tx_id, col in zip(tx_ids, min_cost_assignment(costs), strict=True):
+            assigned[tx_id] = by_key[keys[col]] if col < len(keys) else None
+        return assigned
+
+
+@dataclass
+class AmazonMatching:
+    """The result of matching a set of transactions against the export."""
+
+    # the order (or order row) each matched transaction got, by transaction id
+    matches: dict[int, dict[str, str]] = field(default_factory=dict)
+    # transactions without anything to match, or that lost all of their candidates to others
+    unmatched: list[int] = field(default_factory=list)
+    # transactions that had more than one candidate at the same distance
+    ambiguous: list[int] = field(default_factory=list)
 
 
 def parse_csv_and_filter(
     file_path: str, target_date: str, target_price: float, target_currency: str | None, allow_days: int
 ) -> dict[str, str] | None:
-    if target_currency is None:
-        target_currency = "USD"
-
-    class OrderData:
-        def __init__(self):
-            self.total_owed: float = 0.0
-            self.currency: str = ""
-            self.product_names: list[str] = []
-            self.rows: list[dict[str, str]] = []
-
-    # Convert target_date string to a datetime object
-    target_date_dt = datetime.strptime(target_date, "%Y-%m-%d")
-
-    # Define the date range for filtering
-    start_date = target_date_dt - timedelta(days=allow_days)
-    end_date = target_date_dt + timedelta(days=allow_days)
-
-    order_data = defaultdict(OrderData)
-    margin_of_error = 0.5
-
-    # Read and parse the CSV file
-    with open(file_path, newline="") as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        for row in reader:
-            # Convert the "Order Date" in the row to a datetime object
-            order_date = parse_date_time(row["Order Date"])
-
-            # Remove commas from the "Total Owed" string and convert to float
-            total_owed = float(row["Total Owed"].replace(",", ""))
-            currency = row["Currency"]
-            order_id = row["Order ID"]
-            product_name = row["Product Name"]
-
-            # Aggregate data by order ID
-            if start_date <= order_date <= end_date:
-                od = order_data[order_id]
-                od.total_owed += total_owed
-                od.currency = currency
-                od.product_names.append(product_name)
-                od.rows.append(row)
-
-    # Find the closest matching transaction
-    return find_closest_match(order_data, target_date_dt, target_price, target_currency, margin_of_error)
-
-
-def get_amazon_transactions_summary(file_path: str):
-    """Just return a summary of the transactions in the CSV file."""
-    logger.info("Getting summary of transactions in %s", file_path)
-    summary = {"total_transactions": 0, "start_date": None, "end_date": None}
-    with open(file_path, newline="") as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        transactions = list(reader)
-        summary["total_transactions"] = len(transactions)
+    """Finds the order that matches a single transaction. Use AmazonOrderIndex to match several."""
+    index = AmazonOrderIndex.from_csv(file_path)
+    return index.find_closest_match(
+        datetime.strptime(target_date, "%Y-%m-%d").date(), target_price, target_currency, allow_days
+    )
 
-        if transactions:
-            dates = [parse_date_time(row["Order Date"]) for row in transactions]
-            summary["start_date"] = min(dates).strftime("%Y-%m-%d")
-            summary["end_date"] = max(dates).strftime("%Y-%m-%d")
 
+def get_amazon_transactions_summary(export: "str | AmazonOrderIndex"):
+    """Just return a summary of the transactions in the CSV file (or the index built from it)."""
+    index = export if isinstance(export, AmazonOrderIndex) else AmazonOrderIndex.from_csv(export)
+    summary = index.summary()
     logger.info(
         "Found %d transactions from %s to %s", summary["total_transactions"], summary["start_date"], summary["end_date"]
     )
     return summary
 
 
-def update_amazon_transaction(transaction, found, lunch, categories, dry_run, auto_categorize):
-    """Update a single Amazon transaction with product information and proper categorization."""
+def update_amazon_transaction(transaction, found, lunch, categories, dry_run, suggested_category_id=None):
+    """Update a single Amazon transaction with product information and proper categorization.
+
+    The category is only changed when there is a suggestion (see suggest_amazon_categories).
+    """
     category_id = transaction.category_id
     previous_category_name = [c.name for c in categories if c.id == category_id]
     previous_category_name = previous_category_name[0] if previous_category_name else None
 
     product_name = found["Product Name"]
-    if auto_categorize:
-        _, cat_id = get_suggested_category_id(tx_id=transaction.id, lunch=lunch, override_notes=product_name)
-        # make sure the category exists, since LLMs hallucinate
-        if cat_id not in [c.id for c in categories]:
-            category_id = transaction.category_id  # just leave it as is
-        else:
-            category_id = cat_id
+    if suggested_category_id is not None:
+        category_id = suggested_category_id
 
     if not dry_run:
         if len(product_name) > NOTES_MAX_LENGTH:
@@ -185,61 +373,134 @@ def update_amazon_transaction(transaction, found, lunch, categories, dry_run, au
     }
 
 
-def process_amazon_transactions(
-    file_path: str,
+@dataclass
+class AmazonSyncPlan:
+    """The Amazon transactions of a date range, matched against the export."""
+
+    lunch: LunchMoney
+    categories: list
+    # the Amazon transactions found in Lunch Money
+    transactions: list
+    matching: AmazonMatching
+    # the matched transactions without notes yet, which are the ones to update, with their match
+    to_update: list[tuple] = field(default_factory=list)
+
+    @property
+    def found_count(self) -> int:
+        return len(self.matching.matches)
+
+
+def plan_amazon_sync(
+    export: "str | AmazonOrderIndex",
     days_back: int,
-    dry_run: bool,
     allow_days: int,
-    auto_categorize: bool = True,
     lunch_money_token: str | None = None,
-) -> dict:
-    logger.info(
-        f"Processing Amazon transactions in {file_path} with {days_back} days back and {allow_days} days threshold"
-    )
-    load_dotenv()
-    if not lunch_money_token:
-        lunch_money_token = os.getenv("LUNCH_MONEY_TOKEN")
-        if not lunch_money_token:
-            logger.error("LUNCH_MONEY_TOKEN environment variable not set")
-            sys.exit(1)
-
-    lunch = get_lunch_client(lunch_money_token)
-    categories = lunch.get_categories()
+    chat_id: int | None = None,
+) -> AmazonSyncPlan:
+    """Matches the Amazon transactions of the last days_back days against the orders export.
+
+    The export is either the path to the orders CSV, or an index already built from it.
+    When a chat_id is given, transactions are read from the chat's transaction mirror and its
+    client is used. Otherwise (e.g. from the command line) the given token, or the
+    LUNCH_MONEY_TOKEN env var, is used to query Lunch Money directly.
+    """
+    logger.info(f"Processing Amazon transactions with {days_back} days back and {allow_days} days threshold")
     today = datetime.now()
     today = today.replace(hour=0, minute=0, second=0, microsecond=0)
 
     start_date = today - timedelta(days=days_back)
     start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-    amz = lunch.get_transactions(start_date=start_date, end_date=today)
+
+    if chat_id is not None:
+        lunch = get_lunch_client_for_chat_id(chat_id)
+        amz = get_transaction_mirror().get_transactions(chat_id, start_date.date(), today.date())
+        amz = [a for a in amz if not a.is_pending]
+    else:
+        load_dotenv()
+        if not lunch_money_token:
+            lunch_money_token = os.getenv("LUNCH_MONEY_TOKEN")
+            if not lunch_money_token:
+                logger.error("LUNCH_MONEY_TOKEN environment variable not set")
+                sys.exit(1)
+
+        lunch = get_lunch_client(lunch_money_token)
+        amz = lunch.get_transactions(start_date=start_date, end_date=today)
+    categories = lunch.get_categories()
 
     logger.info("Pulled transactions for range %s to %s, got %d transactions", start_date, today, len(amz))
     amz = [a for a in amz if a.payee == "Amazon" and a.amount > 0]
 
-    amz_cnt = len(amz)
-    found_cnt = 0
-    will_update = 0
-    report = {"processed_transactions": amz_cnt, "updates": []}
+    index = export if isinstance(export, AmazonOrderIndex) else AmazonOrderIndex.from_csv(export)
+    matching = index.match_transactions(amz, allow_days)
+    plan = AmazonSyncPlan(lunch, categories, amz, matching)
+    for tx_id in matching.ambiguous:
+        logger.info("⚠️ Amazon transaction %s had several orders equally close in date", tx_id)
     for a in amz:
-        found = parse_csv_and_filter(file_path, a.date.strftime("%Y-%m-%d"), a.amount, a.currency, allow_days)
+        found = matching.matches.get(a.id)
         if not found:
             a.plaid_metadata = None
             logger.info("🚫 Amazon transaction not found for %s", a)
-            continue
-
-        found_cnt += 1
-        if a.notes is None:
+        elif a.notes is None:
             logger.info("Will update tx %s %s %s %s with %s", a.date, a.amount, a.currency, a.notes, found)
-
-            update_result = update_amazon_transaction(a, found, lunch, categories, dry_run, auto_categorize)
-            report["updates"].append(update_result)
-            will_update += 1
+            plan.to_update.append((a, found))
         else:
             logger.info("Already has notes for %s %s %s %s", a.date, a.amount, a.currency, a.notes)
 
-    logger.info("Processed %d Amazon transactions", amz_cnt)
-    logger.info("Will update %d Amazon transactions out of %d", will_update, found_cnt)
-    report["found_transactions"] = found_cnt
-    report["will_update_transactions"] = will_update
+    logger.info("Will update %d Amazon transactions out of %d", len(plan.to_update), plan.found_count)
+    return plan
+
+
+def suggest_amazon_categories(to_update: list[tuple], categories: list) -> dict[int, int]:
+    """Asks the LLM for the category of the matched transactions, given the products of their orders.
+
+    All of them are categorized together, in as few prompts as possible. Returns the suggested
+    category id by transaction id, which only includes existing categories since LLMs hallucinate.
+    """
+    return get_suggested_category_ids(
+        [transaction for transaction, _ in to_update],
+        categories,
+        override_notes={transaction.id: found["Product Name"] for transaction, found in to_update},
+    )
+
+
+def apply_amazon_match(
+    chat_id: int, tx_id: int, found: dict[str, str], *, lunch, categories, suggested_category_id: int | None
+) -> dict | None:
+    """Updates a transaction of the chat with the order it matched, unless it got notes in the meantime.
+
+    The transaction is read again from Lunch Money first, so this can safely be repeated for a
+    transaction that was already updated (e.g. by a sync that got interrupted).
+    """
+    transaction = get_transaction_mirror().refresh_transaction(chat_id, tx_id)
+    if transaction.notes is not None:
+        logger.info("Transaction %s already has notes, skipping", tx_id)
+        return None
+    return update_amazon_transaction(transaction, found, lunch, categories, False, suggested_category_id)
+
+
+def process_amazon_transactions(
+    export: "str | AmazonOrderIndex",
+    days_back: int,
+    dry_run: bool,
+    allow_days: int,
+    *,
+    auto_categorize: bool = True,
+    lunch_money_token: str | None = None,
+    chat_id: int | None = None,
+) -> dict:
+    """Matches Amazon transactions against the orders export and updates them. See plan_amazon_sync."""
+    plan = plan_amazon_sync(export, days_back, allow_days, lunch_money_token, chat_id)
+    report = {"processed_transactions": len(plan.transactions), "updates": []}
+    suggestions = suggest_amazon_categories(plan.to_update, plan.categories) if auto_categorize else {}
+    for a, found in plan.to_update:
+        update_result = update_amazon_transaction(a, found, plan.lunch, plan.categories, dry_run, suggestions.get(a.id))
+        report["updates"].append(update_result)
+
+    logger.info("Processed %d Amazon transactions", len(plan.transactions))
+    report["found_transactions"] = plan.found_count
+    report["unmatched_transactions"] = len(plan.matching.unmatched)
+    report["ambiguous_transactions"] = len(plan.matching.ambiguous)
+    report["will_update_transactions"] = len(plan.to_update)
     return report
 
 
@@ -260,6 +521,6 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
     result = process_amazon_transactions(
-        args.file_path, args.days_back, args.dry_run, args.allow_days, args.auto_categorize
+        args.file_path, args.days_back, args.dry_run, args.allow_days, auto_categorize=args.auto_categorize
     )
     logger.info(result)
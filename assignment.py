@@ -0,0 +1,104 @@
+from collections.abc import Hashable, Iterable
+
+
+def min_cost_assignment(costs: list[list[int]]) -> list[int]:
+    """Assigns every row of the cost matrix to a distinct column, minimizing the total cost.
+
+    This is the Hungarian algorithm (in its shortest augmenting path form), which runs in
+    O(rows^2 * columns). There must be at least as many columns as rows. Returns the column
+    assigned to each row. Ties are always resolved the same way for the same matrix.
+    """
+    n = len(costs)
+    if n == 0:
+        return []
+    m = len(costs[0])
+    if m < n:
+        raise ValueError(f"Can't assign {n} rows to {m} columns")
+
+    # potentials of rows and columns, and the row assigned to each column (1-based, 0 is none)
+    u = [0] * (n + 1)
+    v = [0] * (m + 1)
+    assigned = [0] * (m + 1)
+    for row in range(1, n + 1):
+        col, way = _shortest_augmenting_path(costs, row, u, v, assigned)
+        # flip the path that ends in the free column that was found
+        while col != 0:
+            prev_col = way[col]
+            assigned[col] = assigned[prev_col]
+            col = prev_col
+
+    result = [-1] * n
+    for j in range(1, m + 1):
+        if assigned[j] != 0:
+            result[assigned[j] - 1] = j - 1
+    return result
+
+
+def _shortest_augmenting_path(
+    costs: list[list[int]], row: int, u: list[int], v: list[int], assigned: list[int]
+) -> tuple[int, list[int]]:
+    """Grows a tree of tight edges from the row until it reaches a free column, updating the potentials.
+
+    Returns that column, and the previous column of each column in the path to it.
+    """
+    m = len(v) - 1
+    inf = float("inf")
+    way = [0] * (m + 1)
+    min_reduced = [inf] * (m + 1)
+    used = [False] * (m + 1)
+    assigned[0] = row
+    col = 0
+    while assigned[col] != 0:
+        used[col] = True
+        current_row = assigned[col]
+        delta = inf
+        next_col = 0
+        for j in range(1, m + 1):
+            if used[j]:
+                continue
+            reduced = costs[current_row - 1][j - 1] - u[current_row] - v[j]
+            if reduced < min_reduced[j]:
+                min_reduced[j] = reduced
+                way[j] = col
+            if min_reduced[j] < delta:
+                delta = min_reduced[j]
+                next_col = j
+        for j in range(m + 1):
+            if used[j]:
+                u[assigned[j]] += delta
+                v[j] -= delta
+            else:
+                min_reduced[j] -= delta
+        col = next_col
+    return col, way
+
+
+def connected_components[L: Hashable, R: Hashable](edges: Iterable[tuple[L, R]]) -> list[tuple[list[L], list[R]]]:
+    """Splits a bipartite graph into its connected components, as (left nodes, right nodes) pairs.
+
+    Nodes keep the order in which they first appear in the edges, and so do the components.
+    """
+    parent: dict[tuple[int, Hashable], tuple[int, Hashable]] = {}
+
+    def find(node: tuple[int, Hashable]) -> tuple[int, Hashable]:
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for left, right in edges:
+        a, b = (0, left), (1, right)
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    components: dict[tuple[int, Hashable], tuple[list, list]] = {}
+    for node in parent:
+        side, key = node
+        component = components.setdefault(find(node), ([], []))
+        component[side].append(key)
+    return list(components.values())
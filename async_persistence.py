@@ -0,0 +1,410 @@
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, event, func, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from errors import NoLunchTokenError
+from metrics_buffer import metric_day
+from persistence import (
+    Analytics,
+    MirroredTransaction,
+    Persistence,
+    PollShardLease,
+    PollWorker,
+    Settings,
+    Transaction,
+    TransactionSyncState,
+    get_db,
+    metrics_upsert,
+    poll_shards_claim,
+    poll_worker_heartbeat,
+)
+from settings_cache import SettingsSnapshot
+
+logger = logging.getLogger("db")
+
+
+class AsyncPersistence:
+    """Async counterpart of Persistence, backed by aiosqlite, for use from async handlers.
+
+    It mirrors the Persistence API method by method, so a handler migrates by swapping
+    `get_db().method(...)` with `await get_async_db().method(...)`. Schema creation, migrations
+    and the poll scheduler remain owned by the wrapped Persistence, which is also notified of
+    every settings write so that both stay consistent.
+    """
+
+    def __init__(self, sync_db: Persistence):
+        self.sync_db = sync_db
+        self.storage_profile = sync_db.storage_profile
+        self.poll_scheduler = sync_db.poll_scheduler
+        self.settings_cache = sync_db.settings_cache
+        self.metrics = sync_db.metrics
+        self.db_path = sync_db.engine.url.database
+        self.engine = create_async_engine(
+            f"sqlite+aiosqlite:///{self.db_path}",
+            pool_size=self.storage_profile.pool_size,
+            max_overflow=self.storage_profile.pool_max_overflow,
+            pool_timeout=self.storage_profile.pool_timeout_secs,
+        )
+        event.listen(
+            self.engine.sync_engine, "connect", lambda dbapi_connection, _: self.storage_profile.apply(dbapi_connection)
+        )
+        self.Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    async def dispose(self) -> None:
+        await self.engine.dispose()
+
+    async def _notify_settings_changed(self, chat_id: int) -> None:
+        async with self.Session() as session:
+            settings = await session.scalar(select(Settings).filter_by(chat_id=chat_id))
+        self.sync_db.settings_changed(chat_id, settings)
+
+    async def save_token(self, chat_id: int, token: str):
+        async with self.Session() as session:
+            stmt = update(Settings).where(Settings.chat_id == chat_id).values(token=token)
+            result = await session.execute(stmt)
+            if result.rowcount == 0:
+                new_setting = Settings(chat_id=chat_id, token=token)
+                session.add(new_setting)
+            await session.commit()
+        await self._notify_settings_changed(chat_id)
+
+    async def get_token(self, chat_id) -> str | None:
+        cached = self.settings_cache.get(int(chat_id))
+        if cached is not None:
+            return cached.token
+        async with self.Session() as session:
+            return await session.scalar(select(Settings.token).filter_by(chat_id=chat_id))
+
+    async def get_all_registered_chats(self) -> list[int]:
+        async with self.Session() as session:
+            return list(await session.scalars(select(Settings.chat_id)))
+
+    async def was_already_sent(self, tx_id: int) -> bool:
+        async with self.Session() as session:
+            return await session.scalar(select(Transaction.message_id).filter_by(tx_id=tx_id).limit(1)) is not None
+
+    async def mark_as_sent(
+        self,
+        tx_id: int,
+        chat_id: int,
+        message_id: int,
+        recurring_type: str | None,
+        *,
+        reviewed=False,
+        plaid_id: str | None = None,
+        render_hash: str | None = None,
+    ) -> None:
+        logger.info(f"Marking transaction {tx_id} as sent with message ID {message_id}")
+        async with self.Session() as session:
+            new_transaction = Transaction(
+                message_id=message_id,
+                tx_id=tx_id,
+                chat_id=chat_id,
+                recurring_type=recurring_type,
+                reviewed_at=datetime.now() if reviewed else None,
+                plaid_id=plaid_id,
+                render_hash=render_hash,
+            )
+            session.add(new_transaction)
+            await session.commit()
+
+    async def get_sent_tx_ids(self, chat_id: int, tx_ids: list[int]) -> set[int]:
+        """Returns the subset of tx_ids that were already sent to the given chat."""
+        if not tx_ids:
+            return set()
+        async with self.Session() as session:
+            stmt = select(Transaction.tx_id).where(Transaction.chat_id == chat_id, Transaction.tx_id.in_(set(tx_ids)))
+            return set(await session.scalars(stmt))
+
+    async def mark_as_sent_many(self, transactions: list[Transaction]) -> None:
+        """Inserts all the given sent transactions in a single DB transaction."""
+        if not transactions:
+            return
+        logger.info(f"Marking {len(transactions)} transactions as sent")
+        async with self.Session() as session:
+            session.add_all(transactions)
+            await session.commit()
+
+    async def get_tx_associated_with(self, message_id: int, chat_id: int) -> int | None:
+        async with self.Session() as session:
+            stmt = select(Transaction.tx_id).filter_by(message_id=message_id, chat_id=chat_id).limit(1)
+            return await session.scalar(stmt)
+
+    async def get_tx_by_id(self, tx_id: int) -> Transaction | None:
+        async with self.Session() as session:
+            return await session.scalar(select(Transaction).filter_by(tx_id=tx_id).limit(1))
+
+    async def get_all_tx_by_chat_id(self, chat_id: int) -> list[Transaction]:
+        async with self.Session() as session:
+            return list(await session.scalars(select(Transaction).filter_by(chat_id=chat_id)))
+
+    async def get_message_id_associated_with(self, tx_id: int, chat_id: int) -> int | None:
+        async with self.Session() as session:
+            stmt = (
+                select(Transaction.message_id)
+                .filter_by(tx_id=tx_id, chat_id=chat_id)
+                .order_by(Transaction.created_at.desc())
+                .limit(1)
+            )
+            return await session.scalar(stmt)
+
+    async def delete_transactions_for_chat(self, chat_id: int):
+        async with self.Session() as session:
+            await session.execute(delete(Transaction).where(Transaction.chat_id == chat_id))
+            await session.execute(delete(MirroredTransaction).where(MirroredTransaction.chat_id == chat_id))
+            await session.execute(delete(TransactionSyncState).where(TransactionSyncState.chat_id == chat_id))
+            await session.commit()
+            logger.info(f"Transactions deleted for chat {chat_id}")
+
+    async def mark_as_reviewed(self, message_id: int, chat_id: int):
+        async with self.Session() as session:
+            stmt = (
+                update(Transaction)
+                .where((Transaction.message_id == message_id) & (Transaction.chat_id == chat_id))
+                .values(reviewed_at=datetime.now())
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    async def get_render_hash(self, chat_id: int, message_id: int) -> str | None:
+        async with self.Session() as session:
+            stmt = select(Transaction.render_hash).where(
+                (Transaction.message_id == message_id) & (Transaction.chat_id == chat_id)
+            )
+            return (await session.scalars(stmt)).first()
+
+    async def save_render_hashes(self, chat_id: int, render_hashes: dict[int, str | None]) -> None:
+        """Stores the hash of what was last rendered in each of the given messages (keyed by message_id)."""
+        if not render_hashes:
+            return
+        async with self.Session() as session:
+            for message_id, render_hash in render_hashes.items():
+                stmt = (
+                    update(Transaction)
+                    .where((Transaction.message_id == message_id) & (Transaction.chat_id == chat_id))
+                    .values(render_hash=render_hash)
+                )
+                await session.execute(stmt)
+            await session.commit()
+
+    async def mark_as_reviewed_by_tx_id(self, tx_id: int, chat_id: int):
+        async with self.Session() as session:
+            stmt = (
+                update(Transaction)
+                .where((Transaction.tx_id == tx_id) & (Transaction.chat_id == chat_id))
+                .values(reviewed_at=datetime.now())
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    async def mark_as_unreviewed(self, message_id: int, chat_id: int):
+        async with self.Session() as session:
+            stmt = (
+                update(Transaction)
+                .where((Transaction.message_id == message_id) & (Transaction.chat_id == chat_id))
+                .values(reviewed_at=None)
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    async def get_current_settings(self, chat_id: str | int) -> SettingsSnapshot:
+        chat_id = int(chat_id)
+        cached = self.settings_cache.get(chat_id)
+        if cached is not None:
+            return cached
+
+        generation = self.settings_cache.generation(chat_id)
+        async with self.Session() as session:
+            settings = await session.scalar(select(Settings).filter_by(chat_id=chat_id))
+            if settings is None:
+                raise NoLunchTokenError("No settings found")
+            return self.settings_cache.fill(chat_id, SettingsSnapshot.from_row(settings), generation)
+
+    async def _update_settings(self, chat_id: int, **values) -> None:
+        async with self.Session() as session:
+            stmt = update(Settings).where(Settings.chat_id == chat_id).values(**values)
+            await session.execute(stmt)
+            await session.commit()
+        await self._notify_settings_changed(chat_id)
+
+    async def update_poll_interval(self, chat_id: int, interval: int) -> None:
+        await self._update_settings(chat_id, poll_interval_secs=interval)
+
+    async def update_last_poll_at(self, chat_id: int, timestamp: str) -> None:
+        await self._update_settings(chat_id, last_poll_at=datetime.fromisoformat(timestamp))
+
+    async def logout(self, chat_id: int) -> None:
+        async with self.Session() as session:
+            await session.execute(delete(Settings).where(Settings.chat_id == chat_id))
+            await session.execute(delete(Transaction).where(Transaction.chat_id == chat_id))
+            await session.execute(delete(MirroredTransaction).where(MirroredTransaction.chat_id == chat_id))
+            await session.execute(delete(TransactionSyncState).where(TransactionSyncState.chat_id == chat_id))
+            await session.commit()
+        self.sync_db.settings_changed(chat_id, None)
+
+    async def get_all_settings(self) -> list[Settings]:
+        async with self.Session() as session:
+            return list((await session.execute(select(Settings))).scalars())
+
+    async def heartbeat_poll_worker(self, worker_id: str, expires_at: datetime, now: datetime) -> list[str]:
+        async with self.Session() as session:
+            await session.execute(poll_worker_heartbeat(worker_id, expires_at))
+            await session.commit()
+            stmt = select(PollWorker.worker_id).where(PollWorker.expires_at > now)
+            return list((await session.execute(stmt)).scalars())
+
+    async def get_poll_shard_leases(self) -> list[PollShardLease]:
+        async with self.Session() as session:
+            return list((await session.execute(select(PollShardLease))).scalars())
+
+    async def claim_poll_shards(
+        self, worker_id: str, shards: list[int], expires_at: datetime, now: datetime
+    ) -> list[int]:
+        if not shards:
+            return []
+        async with self.Session() as session:
+            await session.execute(poll_shards_claim(worker_id, shards, expires_at, now))
+            await session.commit()
+            stmt = select(PollShardLease.shard).where(
+                PollShardLease.owner == worker_id,
+                PollShardLease.expires_at == expires_at,
+                PollShardLease.shard.in_(shards),
+            )
+            return list((await session.execute(stmt)).scalars())
+
+    async def update_auto_mark_reviewed(self, chat_id: int, auto_mark_reviewed: bool) -> None:
+        await self._update_settings(chat_id, auto_mark_reviewed=auto_mark_reviewed)
+
+    async def update_poll_pending(self, chat_id: int, poll_pending: bool) -> None:
+        await self._update_settings(chat_id, poll_pending=poll_pending)
+
+    async def update_show_datetime(self, chat_id: int, show_datetime: bool) -> None:
+        await self._update_settings(chat_id, show_datetime=show_datetime)
+
+    async def update_tagging(self, chat_id: int, tagging: bool) -> None:
+        await self._update_settings(chat_id, tagging=tagging)
+
+    async def update_mark_reviewed_after_categorized(self, chat_id: int, value: bool) -> None:
+        await self._update_settings(chat_id, mark_reviewed_after_categorized=value)
+
+    async def update_timezone(self, chat_id: int, timezone: str) -> None:
+        await self._update_settings(chat_id, timezone=timezone)
+
+    async def update_auto_categorize_after_notes(self, chat_id: int, value: bool) -> None:
+        await self._update_settings(chat_id, auto_categorize_after_notes=value)
+
+    async def update_ai_agent(self, chat_id: int, ai_agent: bool) -> None:
+        await self._update_settings(chat_id, ai_agent=ai_agent)
+
+    async def update_show_transcription(self, chat_id: int, show_transcription: bool) -> None:
+        await self._update_settings(chat_id, show_transcription=show_transcription)
+
+    async def update_ai_response_language(self, chat_id: int, language: str | None) -> None:
+        await self._update_settings(chat_id, ai_response_language=language)
+
+    async def update_ai_model(self, chat_id: int, model: str | None) -> None:
+        await self._update_settings(chat_id, ai_model=model)
+
+    async def set_api_token(self, chat_id: int, token: str | None) -> None:
+        await self._update_settings(chat_id, token=token)
+
+    async def inc_metric(self, key: str, increment: float = 1.0, date: datetime | None = None):
+        """Buffers the increment in memory. It reaches the DB on the next flush_metrics."""
+        if self.metrics.add(key, increment, metric_day(date)):
+            await self.flush_metrics()
+
+    async def flush_metrics(self) -> None:
+        values = self.sync_db.drain_pending_metrics()
+        if not values:
+            return
+        try:
+            async with self.Session() as session:
+                await session.execute(metrics_upsert(values))
+                await session.commit()
+        except Exception:
+            logger.exception(f"Failed to flush {len(values)} metrics, will retry on the next flush")
+            self.metrics.restore(values)
+
+    async def get_metric(self, key: str, start_date: datetime, end_date: datetime) -> float:
+        await self.flush_metrics()
+        async with self.Session() as session:
+            stmt = select(func.sum(Analytics.value)).where(
+                and_(
+                    Analytics.key == key,
+                    Analytics.date >= start_date.replace(hour=0, minute=0, second=0, microsecond=0),
+                    Analytics.date <= end_date.replace(hour=23, minute=59, second=59, microsecond=999999),
+                )
+            )
+            return await session.scalar(stmt) or 0.0
+
+    async def get_all_metrics(self, start_date: datetime, end_date: datetime) -> dict:
+        return await self._get_metrics_by_day(start_date, end_date)
+
+    async def get_specific_metrics(self, key: str, start_date: datetime, end_date: datetime) -> dict:
+        return await self._get_metrics_by_day(start_date, end_date, key)
+
+    async def _get_metrics_by_day(self, start_date: datetime, end_date: datetime, key: str | None = None) -> dict:
+        await self.flush_metrics()
+        async with self.Session() as session:
+            stmt = select(Analytics.key, Analytics.date, Analytics.value).where(
+                Analytics.date >= start_date.replace(hour=0, minute=0, second=0, microsecond=0),
+                Analytics.date <= end_date.replace(hour=23, minute=59, second=59, microsecond=999999),
+            )
+            if key is not None:
+                stmt = stmt.where(Analytics.key == key)
+            results = await session.execute(stmt)
+
+            metrics = {}
+            for metric_key, metric_date, value in results:
+                date_key = metric_date.replace(hour=0, minute=0, second=0, microsecond=0)
+                metrics.setdefault(date_key, {})[metric_key] = value
+            return metrics
+
+    async def get_user_count(self) -> int:
+        async with self.Session() as session:
+            stmt = select(func.count()).select_from(Settings).where(Settings.token != "revoked")
+            return await session.scalar(stmt) or 0
+
+    def get_db_size(self) -> int:
+        if self.db_path is not None:
+            return os.path.getsize(self.db_path)
+        return 0
+
+    async def get_sent_message_count(self) -> int:
+        async with self.Session() as session:
+            return await session.scalar(select(func.count()).select_from(Transaction)) or 0
+
+    async def get_sent_transactions(self, chat_id: int, since: datetime | None = None) -> list[Transaction]:
+        """Get all previously sent transactions for a specific chat from a given date (defaults to last 3 months)."""
+        if since is None:
+            since = datetime.now() - timedelta(days=90)  # Set default since date to 90 days ago
+        async with self.Session() as session:
+            stmt = select(Transaction).where(Transaction.chat_id == chat_id, Transaction.created_at >= since)
+            return list(await session.scalars(stmt))
+
+    async def update_transaction_ids_by_plaid_id(
+        self, old_plaid_id: str, new_tx_id: int, new_plaid_id: str | None
+    ) -> bool:
+        """Update transaction tx_id and plaid_id by matching old plaid_id."""
+        async with self.Session() as session:
+            stmt = (
+                update(Transaction)
+                .where(Transaction.plaid_id == old_plaid_id)
+                .values(tx_id=new_tx_id, plaid_id=new_plaid_id)
+            )
+            result = await session.execute(stmt)
+            await session.commit()
+            return result.rowcount > 0
+
+
+async_db = None
+
+
+def get_async_db() -> AsyncPersistence:
+    global async_db
+    if async_db is None:
+        async_db = AsyncPersistence(get_db())
+    return async_db
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any
+
+from telegram import InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import ContextTypes
+
+from persistence import BackgroundJob, get_db
+from poll_shards import WORKER_ID
+
+logger = logging.getLogger("background_jobs")
+
+# How many background jobs run at the same time (across all chats). The rest wait in the queue
+BACKGROUND_JOBS_MAX_CONCURRENCY = int(os.getenv("BACKGROUND_JOBS_MAX_CONCURRENCY", "4"))
+
+# How many unfinished (queued or running) jobs a chat can have
+BACKGROUND_JOBS_PER_CHAT = int(os.getenv("BACKGROUND_JOBS_PER_CHAT", "1"))
+
+# How often the status message of a running job is edited with its progress
+BACKGROUND_JOB_STATUS_SECS = float(os.getenv("BACKGROUND_JOB_STATUS_SECS", "5"))
+
+# A running job that has not saved progress for this long is considered abandoned (e.g. its
+# replica died) and is taken over by the next worker that looks for jobs to resume
+BACKGROUND_JOB_STALE_SECS = 600
+
+# How often unfinished jobs are looked for, which is what resumes them after a restart
+BACKGROUND_JOBS_RESUME_SECS = 60
+
+
+@dataclass
+class BackgroundJobKind:
+    """How to run one kind of job. A job goes through a list of items, one at a time, in order.
+
+    prepare and run_item block, so they run in a worker thread. prepare gets the job parameters
+    and the items left, so it can load once what they need (e.g. a client, or LLM suggestions
+    for all of them). What it returns is passed to run_item, along with the job parameters and
+    the item, and it returns the counters to add to the job progress. render returns the text and buttons of the status
+    message, given the job, its parameters and the progress so far. finish, if given, runs on the event loop once
+    the job is done or cancelled, with the job parameters and the items it went through (e.g. to update their
+    messages all at once).
+    """
+
+    prepare: Callable[[int, dict, list[dict]], Any]
+    run_item: Callable[[Any, dict, dict], dict[str, int]]
+    render: Callable[[BackgroundJob, dict, dict[str, int]], tuple[str, InlineKeyboardMarkup | None]]
+    finish: Callable[[ContextTypes.DEFAULT_TYPE, BackgroundJob, dict, list[dict]], Awaitable[None]] | None = None
+
+
+class BackgroundJobRunner:
+    """Runs long tasks (e.g. the Amazon sync) outside of the handlers, so the bot keeps answering.
+
+    Jobs are stored in the DB with their items, and their progress is saved after every item.
+    That lets any replica resume them after a restart, and lets the Cancel button (which could be
+    handled by any replica) stop them: it flags the job, and the worker running it stops before
+    the next item.
+    """
+
+    def __init__(self, max_concurrency: int, max_per_chat: int, worker_id: str):
+        self.max_per_chat = max_per_chat
+        self.worker_id = worker_id
+        self.kinds: dict[str, BackgroundJobKind] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def register(self, kind: str, job_kind: BackgroundJobKind) -> None:
+        self.kinds[kind] = job_kind
+
+    async def submit(
+        self,
+        context: ContextTypes.DEFAULT_TYPE,
+        chat_id: int,
+        kind: str,
+        payload: dict,
+        items: list[dict],
+        *,
+        message_id: int | None,
+    ) -> int | None:
+        """Queues a job and starts it as soon as there is room. Returns None if the chat has too many jobs."""
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown background job kind {kind}")
+        job_id = await asyncio.to_thread(
+            get_db().create_background_job,
+            chat_id,
+            kind,
+            json.dumps({**payload, "items": items}),
+            len(items),
+            message_id,
+            max_active_per_chat=self.max_per_chat,
+        )
+        if job_id is None:
+            return None
+        logger.info(f"Queued {kind} job {job_id} for chat {chat_id} with {len(items)} items")
+        self._start(context, job_id)
+        return job_id
+
+    async def cancel(self, context: ContextTypes.DEFAULT_TYPE, job_id: int, chat_id: int) -> bool:
+        """Cancels a job of the chat. Returns False if it had already finished."""
+        if not await asyncio.to_thread(get_db().request_background_job_cancel, job_id, chat_id):
+            return False
+        # a job that had not started is cancelled right away, so there's no worker to update the status
+        job = await asyncio.to_thread(get_db().get_background_job, job_id)
+        if job is not None and job.status == "cancelled":
+            await self._edit_status(context, job)
+        return True
+
+    async def resume(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Starts the unfinished jobs that nobody is running, e.g. because the bot restarted."""
+        stale_before = datetime.now() - timedelta(seconds=BACKGROUND_JOB_STALE_SECS)
+        job_ids = await asyncio.to_thread(get_db().get_resumable_background_jobs, self.worker_id, stale_before)
+        for job_id in job_ids:
+            if job_id not in self._tasks:
+                logger.info(f"Resuming background job {job_id}")
+                self._start(context, job_id)
+
+    async def stop(self) -> None:
+        """Stops the running jobs, putting them back in the queue so they are resumed later."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _start(self, context: ContextTypes.DEFAULT_TYPE, job_id: int) -> None:
+        task = asyncio.create_task(self._run(context, job_id), name=f"background_job_{job_id}")
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, context: ContextTypes.DEFAULT_TYPE, job_id: int) -> None:
+        async with self._semaphore:
+            db = get_db()
+            now = datetime.now()
+            stale_before = now - timedelta(seconds=BACKGROUND_JOB_STALE_SECS)
+            if not await asyncio.to_thread(db.claim_background_job, job_id, self.worker_id, now, stale_before):
+                logger.info(f"Background job {job_id} is being run by another worker")
+                return
+            job = await asyncio.to_thread(db.get_background_job, job_id)
+            if job is None:
+                return
+
+            try:
+                await self._run_items(context, job)
+            except asyncio.CancelledError:
+                logger.info(f"Background job {job_id} interrupted at item {job.cursor}, putting it back in the queue")
+                await asyncio.to_thread(db.release_background_job, job_id, self.worker_id)
+                raise
+            except Exception as e:
+                logger.exception(f"Background job {job_id} failed")
+                job.status = "failed"
+                job.error = str(e)
+                await asyncio.to_thread(db.finish_background_job, job_id, self.worker_id, "failed", str(e))
+                await asyncio.to_thread(db.inc_metric, "background_jobs_failed")
+                await self._edit_status(context, job)
+
+    async def _run_items(self, context: ContextTypes.DEFAULT_TYPE, job: BackgroundJob) -> None:
+        db = get_db()
+        kind = self.kinds[job.kind]
+        payload = json.loads(job.payload)
+        items = payload.pop("items")
+        progress: dict[str, int] = json.loads(job.progress)
+        await self._edit_status(context, job, payload, progress)
+        state = await asyncio.to_thread(kind.prepare, job.chat_id, payload, items[job.cursor :])
+
+        last_status_at = time.monotonic()
+        while job.cursor < len(items):
+            if time.monotonic() - last_status_at >= BACKGROUND_JOB_STATUS_SECS:
+                await self._edit_status(context, job, payload, progress)
+                last_status_at = time.monotonic()
+
+            try:
+                counters = await asyncio.to_thread(kind.run_item, state, payload, items[job.cursor])
+            except Exception:
+                logger.exception(f"Background job {job.id} failed on item {job.cursor}")
+                counters = {"failed": 1}
+            for key, value in counters.items():
+                progress[key] = progress.get(key, 0) + value
+            job.cursor += 1
+            job.progress = json.dumps(progress)
+
+            keep_going = await asyncio.to_thread(
+                db.save_background_job_progress, job.id, self.worker_id, job.cursor, job.progress, datetime.now()
+            )
+            if not keep_going:
+                current = await asyncio.to_thread(db.get_background_job, job.id)
+                if current is None or current.owner != self.worker_id:
+                    logger.warning(f"Background job {job.id} was taken over by another worker, stopping")
+                    return
+                job.status = "cancelled"
+                logger.info(f"Background job {job.id} stopped at item {job.cursor} of {job.total}")
+                await asyncio.to_thread(db.finish_background_job, job.id, self.worker_id, "cancelled")
+                await self._edit_status(context, job, payload, progress)
+                await self._finish(context, job, payload, items)
+                return
+
+        job.status = "done"
+        await asyncio.to_thread(db.finish_background_job, job.id, self.worker_id, "done")
+        logger.info(f"Background job {job.id} done: {progress}")
+        await self._edit_status(context, job, payload, progress)
+        await self._finish(context, job, payload, items)
+
+    async def _finish(
+        self, context: ContextTypes.DEFAULT_TYPE, job: BackgroundJob, payload: dict, items: list[dict]
+    ) -> None:
+        job_kind = self.kinds[job.kind]
+        if job_kind.finish is None:
+            return
+        try:
+            await job_kind.finish(context, job, payload, items[: job.cursor])
+        except Exception:
+            logger.exception(f"Could not finish background job {job.id}")
+
+    async def _edit_status(
+        self,
+        context: ContextTypes.DEFAULT_TYPE,
+        job: BackgroundJob,
+        payload: dict | None = None,
+        progress: dict[str, int] | None = None,
+    ) -> None:
+        job_kind = self.kinds.get(job.kind)
+        if job.message_id is None or job_kind is None:
+            return
+        if payload is None:
+            payload = json.loads(job.payload)
+        text, reply_markup = job_kind.render(job, payload, progress or json.loads(job.progress))
+        try:
+            await context.bot.edit_message_text(
+                chat_id=job.chat_id,
+                message_id=job.message_id,
+                text=text,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=reply_markup,
+            )
+        except BadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                logger.warning(f"Could not update the status of background job {job.id}: {e}")
+        except TelegramError as e:
+            logger.warning(f"Could not update the status of background job {job.id}: {e}")
+
+
+background_jobs = None
+
+
+def get_background_jobs() -> BackgroundJobRunner:
+    global background_jobs
+    if background_jobs is None:
+        background_jobs = BackgroundJobRunner(BACKGROUND_JOBS_MAX_CONCURRENCY, BACKGROUND_JOBS_PER_CHAT, WORKER_ID)
+    return background_jobs
@@ -1,12 +1,15 @@
+import asyncio
+import json
 import logging
 import os
 from textwrap import dedent
 
-import requests
-from lunchable import LunchMoney, TransactionUpdateObject
+from lunchable import TransactionUpdateObject
 from lunchable.models import CategoriesObject, TransactionObject
 
-from lunch import get_lunch_client_for_chat_id
+from async_persistence import get_async_db
+from deepinfra_client import get_deepinfra_client
+from lunch import get_async_lunch_client_for_chat_id
 from persistence import get_db
 from utils import remove_emojis
 
@@ -15,6 +18,10 @@ logger = logging.getLogger(__name__)
 # Constants
 HTTP_OK = 200
 
+# How many transactions are sent in a single prompt when categorizing several at once. The
+# category list, which is most of the prompt, is then sent once per batch instead of once per transaction
+DEEPINFRA_CATEGORIZE_BATCH_SIZE = int(os.getenv("DEEPINFRA_CATEGORIZE_BATCH_SIZE", "25"))
+
 
 def get_transaction_input_variable(transaction: TransactionObject, override_notes: str | None = None) -> str:
     tx_input_variable = dedent(
@@ -39,22 +46,27 @@ def get_transaction_input_variable(transaction: TransactionObject, override_note
     return tx_input_variable
 
 
-def get_categories_input_variable(categories: list[CategoriesObject]) -> str:
-    categories_info = []
+def get_assignable_categories(categories: list[CategoriesObject]) -> list[tuple[int, str]]:
+    """Returns the id and name of the categories the LLM can choose from."""
+    assignable = []
     for category in categories:
         # when a category has subcategories (children is not empty),
-        # we want to add an item to the categories_info with this format:
+        # we want to add an item with this format:
         # id: subcategory_name (parent_category_name)
         # but when a category has no subcategories, we want to add an item with this format:
         # id: category_name
         if category.children:
             for subcategory in category.children:
-                categories_info.append(
-                    f"{subcategory.id}:{remove_emojis(subcategory.name)} ({remove_emojis(category.name)})"
+                assignable.append(
+                    (subcategory.id, f"{remove_emojis(subcategory.name)} ({remove_emojis(category.name)})")
                 )
         elif category.group_id is None:
-            categories_info.append(f"{category.id}:{remove_emojis(category.name)}")
-    return "\n".join(categories_info)
+            assignable.append((category.id, remove_emojis(category.name)))
+    return assignable
+
+
+def get_categories_input_variable(categories: list[CategoriesObject]) -> str:
+    return "\n".join(f"{category_id}:{name}" for category_id, name in get_assignable_categories(categories))
 
 
 def build_prompt(
@@ -83,16 +95,70 @@ DO NOT EXPLAIN YOURSELF. JUST RESPOND WITH THE ID or null.
     )
 
 
-def send_message_to_llm(content):
-    url = "https://api.deepinfra.com/v1/openai/chat/completions"
-    headers = {"Content-Type": "application/json", "Authorization": "Bearer " + os.getenv("DEEPINFRA_API_KEY", "")}
+def build_batch_prompt(
+    transactions: list[TransactionObject], categories: list[CategoriesObject], override_notes: dict[int, str]
+) -> str:
+    transactions_info = "\n".join(
+        f"ID: {tx.id}{get_transaction_input_variable(tx, override_notes=override_notes.get(tx.id))}"
+        for tx in transactions
+    )
+    example_category_id = next((category_id for category_id, _ in get_assignable_categories(categories)), 1)
+    example = json.dumps({str(tx.id): example_category_id for tx in transactions[:2]})
+    return dedent(
+        f"""
+These are the transactions, each one starting with its ID:
+{transactions_info}
+
+What of the following categories would you suggest for each of these transactions?
+
+If the Payee is Amazon, then choose the Amazon category ONLY if the notes of the transaction can't be categorized as a specific non-Amazon category.
+
+These are the available categories (using the format `ID:Category Name`):
+
+{get_categories_input_variable(categories)}
+
+Respond with a JSON object that maps the ID of every transaction to the ID of its category (or null), like {example}
+
+Remember to ONLY RESPOND with the JSON object, and nothing else.
+
+DO NOT EXPLAIN YOURSELF. JUST RESPOND WITH THE JSON OBJECT.
+        """
+    )
+
+
+def parse_category_suggestions(content: str | None, tx_ids: set[int], category_ids: set[int]) -> dict[int, int]:
+    """Reads the JSON object the LLM responded with, keeping only the given transactions and categories."""
+    if not content:
+        return {}
+    # models sometimes wrap the JSON in a code block, or add some text around it
+    start, end = content.find("{"), content.rfind("}")
+    try:
+        response = json.loads(content[start : end + 1]) if start != -1 else None
+    except json.JSONDecodeError:
+        response = None
+    if not isinstance(response, dict):
+        logger.warning(f"LLM did not respond with a JSON object: {content}")
+        return {}
+
+    suggestions = {}
+    for key, value in response.items():
+        try:
+            tx_id, category_id = int(key), int(value)
+        except (TypeError, ValueError):
+            continue
+        if tx_id in tx_ids and category_id in category_ids:
+            suggestions[tx_id] = category_id
+    return suggestions
+
+
+async def send_message_to_llm(content: str) -> str | None:
     data = {
         "model": "meta-llama/Llama-4-Scout-17B-16E-Instruct",
         "temperature": 0.0,
         "messages": [{"role": "user", "content": content}],
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    response = await get_deepinfra_client().post("/v1/openai/chat/completions", json=data)
     get_db().inc_metric("deepinfra_requests")
 
     if response.status_code == HTTP_OK:
@@ -105,14 +171,16 @@ def send_message_to_llm(content):
         return response_json["choices"][0]["message"]["content"]
     else:
         response.raise_for_status()
+        return None
 
 
-def auto_categorize(tx_id: int, chat_id: int) -> str:
-    lunch = get_lunch_client_for_chat_id(chat_id)
-    categories = lunch.get_categories()
+async def auto_categorize(tx_id: int, chat_id: int) -> str:
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
 
     try:
-        tx, category_id = get_suggested_category_id(tx_id, lunch)
+        tx = await lunch.get_transaction(tx_id)
+        categories = await lunch.get_categories()
+        category_id = await suggest_category_id(tx, categories)
         if int(category_id) == tx.category_id:
             # no need to recategorize
             return "Already categorized correctly"
@@ -120,11 +188,11 @@ def auto_categorize(tx_id: int, chat_id: int) -> str:
         logger.info(f"AI response: {category_id}")
         for cat in categories:
             if cat.id == int(category_id):
-                settings = get_db().get_current_settings(chat_id)
+                settings = await get_async_db().get_current_settings(chat_id)
                 if settings.mark_reviewed_after_categorized:
-                    lunch.update_transaction(tx_id, TransactionUpdateObject(category_id=cat.id, status="cleared"))  # type: ignore
+                    await lunch.update_transaction(tx_id, TransactionUpdateObject(category_id=cat.id, status="cleared"))  # type: ignore
                 else:
-                    lunch.update_transaction(tx_id, TransactionUpdateObject(category_id=cat.id))  # type: ignore
+                    await lunch.update_transaction(tx_id, TransactionUpdateObject(category_id=cat.id))  # type: ignore
                 return f"Transaction recategorized to {cat.name}"
     except Exception:
         logger.exception("Error while categorizing transaction")
@@ -133,18 +201,68 @@ def auto_categorize(tx_id: int, chat_id: int) -> str:
         return "AI failed to categorize the transaction"
 
 
-def get_suggested_category_id(
-    tx_id: int, lunch: LunchMoney, override_notes: str | None = None
-) -> tuple[TransactionObject, int]:
-    tx = lunch.get_transaction(tx_id)
-    categories = lunch.get_categories()
-
+async def suggest_category_id(
+    tx: TransactionObject, categories: list[CategoriesObject], override_notes: str | None = None
+) -> int:
+    """Asks the LLM for the best category for the transaction. Returns -1 if it failed."""
     prompt = build_prompt(tx, categories, override_notes=override_notes)
     logger.info(prompt)
 
     try:
-        category_id = send_message_to_llm(prompt)
-        return tx, int(category_id or 0)
+        category_id = await send_message_to_llm(prompt)
+        return int(category_id or 0)
     except Exception:
         logger.exception("Error while categorizing transaction")
-        return tx, -1
+        return -1
+
+
+async def suggest_category_ids(
+    transactions: list[TransactionObject],
+    categories: list[CategoriesObject],
+    override_notes: dict[int, str] | None = None,
+) -> dict[int, int]:
+    """Asks the LLM for the best category of each transaction, DEEPINFRA_CATEGORIZE_BATCH_SIZE per prompt.
+
+    Returns the suggested category id by transaction id. Transactions the LLM had no valid
+    category for (or whose batch failed) are left out.
+    """
+    category_ids = {category_id for category_id, _ in get_assignable_categories(categories)}
+    batches = [
+        transactions[i : i + DEEPINFRA_CATEGORIZE_BATCH_SIZE]
+        for i in range(0, len(transactions), DEEPINFRA_CATEGORIZE_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(
+        *(_suggest_category_ids_batch(batch, categories, override_notes or {}, category_ids) for batch in batches)
+    )
+
+    suggestions = {}
+    for result in results:
+        suggestions.update(result)
+    logger.info(f"Got categories for {len(suggestions)} of {len(transactions)} transactions in {len(batches)} prompts")
+    return suggestions
+
+
+async def _suggest_category_ids_batch(
+    batch: list[TransactionObject],
+    categories: list[CategoriesObject],
+    override_notes: dict[int, str],
+    category_ids: set[int],
+) -> dict[int, int]:
+    prompt = build_batch_prompt(batch, categories, override_notes)
+    try:
+        response = await send_message_to_llm(prompt)
+    except Exception:
+        logger.exception(f"Error while categorizing a batch of {len(batch)} transactions")
+        return {}
+    return parse_category_suggestions(response, {tx.id for tx in batch}, category_ids)
+
+
+def get_suggested_category_ids(
+    transactions: list[TransactionObject],
+    categories: list[CategoriesObject],
+    override_notes: dict[int, str] | None = None,
+) -> dict[int, int]:
+    """Blocking version of suggest_category_ids, e.g. for the Amazon sync, which runs in a worker thread."""
+    if not transactions:
+        return {}
+    return get_deepinfra_client().run_sync(lambda: suggest_category_ids(transactions, categories, override_notes))
@@ -0,0 +1,153 @@
+import asyncio
+import importlib.util
+import logging
+import os
+import random
+from collections.abc import Callable, Coroutine
+from typing import Any
+
+import httpx
+
+from persistence import get_db
+
+logger = logging.getLogger("deepinfra_client")
+
+DEEPINFRA_BASE_URL = "https://api.deepinfra.com"
+
+# How many requests can be sent to DeepInfra at the same time. Connections are kept alive
+# (up to the same number) and reused by the categorizer and the transcriber
+DEEPINFRA_MAX_CONCURRENCY = int(os.getenv("DEEPINFRA_MAX_CONCURRENCY", "4"))
+
+# How many times a request that failed to connect, timed out, or got a 429/5xx is retried
+DEEPINFRA_MAX_RETRIES = int(os.getenv("DEEPINFRA_MAX_RETRIES", "3"))
+
+# Retries wait a random time between 0 and this, doubled after every attempt
+DEEPINFRA_RETRY_BASE_SECS = 0.5
+
+# Audio uploads and LLM responses can take a while, the connect timeout is kept short
+DEEPINFRA_TIMEOUT = httpx.Timeout(connect=5, read=60, write=30, pool=60)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# httpx only speaks HTTP/2 when the h2 package is installed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def get_retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    # full jitter, so that requests that failed together don't all retry together
+    delay = random.uniform(0, DEEPINFRA_RETRY_BASE_SECS * 2**attempt)
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+    return delay
+
+
+class DeepInfraClient:
+    """Async HTTP client for the DeepInfra API, shared by every call made to it.
+
+    The underlying httpx client and the concurrency semaphore belong to the event loop they
+    were created in. The bot binds them to its loop on start, so calls made from worker threads
+    (see run_sync) go through the same connections and concurrency limit. Outside of the bot
+    (e.g. the Amazon script) they are created on first use, and closed when the loop is done.
+    """
+
+    def __init__(self, max_concurrency: int, max_retries: int):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._client: httpx.AsyncClient | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def bind(self) -> None:
+        """Makes the running loop (i.e. the bot's) the one every call goes through."""
+        self._session()
+
+    async def close(self) -> None:
+        if self._client is not None and self._loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._client = None
+        self._semaphore = None
+        self._loop = None
+
+    def _session(self) -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._semaphore is None or self._loop is not loop:
+            if self._client is not None and self._loop is not None and self._loop.is_running():
+                # the previous loop is still around (in another thread), so the client can be closed there
+                asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop)
+            elif self._client is not None:
+                logger.warning("Replacing a DeepInfra client whose loop is gone without closing it")
+            self._client = httpx.AsyncClient(
+                base_url=DEEPINFRA_BASE_URL,
+                http2=HTTP2_AVAILABLE,
+                timeout=DEEPINFRA_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency
+                ),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._client, self._semaphore
+
+    async def post(self, path: str, **kwargs: Any) -> httpx.Response:
+        """Posts to the DeepInfra API, retrying transient failures with jittered exponential backoff.
+
+        The response of the last attempt is returned whatever its status code, so callers
+        check it the same way they would without retries.
+        """
+        api_key = os.getenv("DEEPINFRA_API_KEY")
+        if not api_key:
+            raise ValueError("DEEPINFRA_API_KEY not set")
+
+        client, semaphore = self._session()
+        headers = {"Authorization": f"Bearer {api_key}"}
+        async with semaphore:
+            for attempt in range(self.max_retries):
+                try:
+                    response = await client.post(path, headers=headers, **kwargs)
+                except httpx.TransportError as e:
+                    logger.warning(f"Request to {path} failed ({e!r}), retrying")
+                    delay = get_retry_delay(attempt)
+                else:
+                    if response.status_code not in RETRYABLE_STATUS_CODES:
+                        return response
+                    logger.warning(f"Request to {path} got status {response.status_code}, retrying")
+                    delay = get_retry_delay(attempt, response.headers.get("retry-after"))
+
+                get_db().inc_metric("deepinfra_retries")
+                await asyncio.sleep(delay)
+
+            return await client.post(path, headers=headers, **kwargs)
+
+    def run_sync[T](self, call: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        """Runs an async call from blocking code, e.g. a worker thread of the bot.
+
+        When the bot loop is running, the call runs there so it shares its connections,
+        otherwise (e.g. from a script) it runs in a loop of its own, whose client is closed
+        before returning.
+        """
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                raise RuntimeError("run_sync can't be called from the loop of the client, await the call instead")
+            return asyncio.run_coroutine_threadsafe(call(), loop).result()
+        return asyncio.run(self._run_and_close(call))
+
+    async def _run_and_close[T](self, call: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        try:
+            return await call()
+        finally:
+            await self.close()
+
+
+deepinfra_client = None
+
+
+def get_deepinfra_client() -> DeepInfraClient:
+    global deepinfra_client
+    if deepinfra_client is None:
+        deepinfra_client = DeepInfraClient(DEEPINFRA_MAX_CONCURRENCY, DEEPINFRA_MAX_RETRIES)
+    return deepinfra_client
@@ -8,6 +8,7 @@ from lunchable import TransactionInsertObject, TransactionUpdateObject
 
 from constants import NOTES_MAX_LENGTH
 from lunch import get_lunch_client_for_chat_id
+from transaction_mirror import get_transaction_mirror
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("aitools")
@@ -69,7 +70,7 @@ def get_plaid_account_balances(chat_id: int) -> str:
     logger.info("Calling get_plaid_account_balances for chat_id: %s", chat_id)
     try:
         lunch_client = get_lunch_client_for_chat_id(chat_id)
-        plaid_accounts = lunch_client.get_plaid_accounts()
+        plaid_accounts = lunch_client.get_plaid_accounts(fresh=True)
         logger.info("Retrieved %d Plaid accounts", len(plaid_accounts))
 
         accounts_data = []
@@ -106,7 +107,7 @@ def get_manual_accounts_balances(chat_id: int) -> str:
     try:
         lunch_client = get_lunch_client_for_chat_id(chat_id)
 
-        assets = lunch_client.get_assets()
+        assets = lunch_client.get_assets(fresh=True)
         logger.info("Retrieved %d total assets", len(assets))
 
         # Filter for manually managed accounts (credit and cash types)
@@ -494,8 +495,6 @@ def get_transactions(
         tag_id,
     )
     try:
-        lunch_client = get_lunch_client_for_chat_id(chat_id)
-
         # Validate and parse dates
         parsed_start_date = None
         parsed_end_date = None
@@ -521,21 +520,21 @@ def get_transactions(
             limit = MAX_TRANSACTION_LIMIT
             logger.warning("Limit capped at 100")
 
+        # Like the Lunch Money API, default to the current month when no dates are given
+        today = datetime.date.today()
+        range_end = parsed_end_date or today
+        range_start = parsed_start_date or range_end.replace(day=1)
+
         logger.info("Fetching transactions with filters")
-        transactions = lunch_client.get_transactions(
-            start_date=parsed_start_date,
-            end_date=parsed_end_date,
-            tag_id=tag_id,
-            recurring_id=None,  # Not filtering by recurring
-            plaid_account_id=None,  # Not filtering by plaid account
-            category_id=category_id,
-            asset_id=asset_id,
-            group_id=None,  # Not filtering by group
-            is_group=None,  # Not filtering by group status
-            status=None,  # Not filtering by status
-            offset=offset,
-            limit=limit,
-        )
+        transactions = get_transaction_mirror().get_transactions(chat_id, range_start, range_end)
+        transactions = [
+            t
+            for t in transactions
+            if not t.is_pending
+            and (category_id is None or t.category_id == category_id)
+            and (asset_id is None or t.asset_id == asset_id)
+            and (tag_id is None or any(tag.id == tag_id for tag in t.tags or []))
+        ]
 
         logger.info("Retrieved %d transactions", len(transactions))
 
@@ -546,6 +545,8 @@ def get_transactions(
             transactions = [t for t in transactions if t.payee and payee_lower in t.payee.lower()]
             logger.info("Filtered to %d transactions matching payee", len(transactions))
 
+        transactions = transactions[offset : offset + limit]
+
         transactions_data = []
         for transaction in transactions:
             logger.debug("Processing transaction: %s (id: %s)", transaction.payee, transaction.id)
@@ -618,17 +619,14 @@ def get_recent_transactions(chat_id: int, days: int = 7, limit: int = 20) -> str
     """
     logger.info("Calling get_recent_transactions with chat_id=%s, days=%s, limit=%s", chat_id, days, limit)
     try:
-        lunch_client = get_lunch_client_for_chat_id(chat_id)
-
         # Calculate date range
         end_date = datetime.date.today()
         start_date = end_date - datetime.timedelta(days=days)
 
         logger.info("Fetching recent transactions from %s to %s", start_date, end_date)
 
-        transactions = lunch_client.get_transactions(
-            start_date=start_date, end_date=end_date, limit=min(limit, 100), offset=0
-        )
+        transactions = get_transaction_mirror().get_transactions(chat_id, start_date, end_date)
+        transactions = [t for t in transactions if not t.is_pending][: min(limit, 100)]
 
         logger.info("Retrieved %d recent transactions", len(transactions))
 
@@ -1,25 +1,35 @@
+import asyncio
 import logging
-import os
-import random
-import shutil
-import tempfile
-import zipfile
-from datetime import datetime
+from io import BytesIO
 from textwrap import dedent
 
 from telegram import InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
-
-from amazon import get_amazon_transactions_summary, process_amazon_transactions
+from telegram.helpers import escape_markdown
+
+from amazon import (
+    AmazonOrderIndex,
+    apply_amazon_match,
+    get_amazon_transactions_summary,
+    plan_amazon_sync,
+    process_amazon_transactions,
+    suggest_amazon_categories,
+)
+from background_jobs import BackgroundJobKind, get_background_jobs
 from handlers.expectations import AMAZON_EXPORT, clear_expectation, set_expectation
-from lunch import get_lunch_money_token_for_chat_id
-from persistence import get_db
+from lunch import get_lunch_client_for_chat_id
+from persistence import BackgroundJob, get_db
 from telegram_extensions import Update
+from transaction_mirror import get_transaction_mirror
 from utils import Keyboard
 
 # Constants
 MAX_PREVIEW_UPDATES = 3
+AMAZON_SYNC_JOB = "amazon_sync"
+
+# How long the index of an uploaded export is kept in memory, waiting for it to be processed
+AMAZON_ORDER_INDEX_TTL_SECS = 30 * 60
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("amz")
@@ -82,11 +92,49 @@ def get_process_amazon_tx_buttons(ai_categorization_enabled: bool) -> InlineKeyb
 
     kbd += ("Preview", "preview_process_amazon_transactions")
     kbd += ("Process", "process_amazon_transactions")
-    kbd += ("Cancel", "cancel")
+    kbd += ("Cancel", "cancelAmazonSync")
 
     return kbd.build()
 
 
+def keep_amazon_order_index(update: Update, context: ContextTypes.DEFAULT_TYPE, order_index: AmazonOrderIndex) -> None:
+    """Keeps the index of the export for the next steps, until it is processed or AMAZON_ORDER_INDEX_TTL_SECS pass."""
+    context.user_data["amazon_order_index"] = order_index
+    if context.job_queue is None or update.effective_user is None:
+        return
+    user_id = update.effective_user.id
+    for job in context.job_queue.get_jobs_by_name(f"expire_amazon_order_index_{user_id}"):
+        job.schedule_removal()
+    context.job_queue.run_once(
+        expire_amazon_order_index,
+        when=AMAZON_ORDER_INDEX_TTL_SECS,
+        name=f"expire_amazon_order_index_{user_id}",
+        chat_id=update.chat_id,
+        user_id=user_id,
+    )
+
+
+def forget_amazon_order_index(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drops the index of the export, so it can be garbage collected."""
+    if context.user_data is not None:
+        context.user_data.pop("amazon_order_index", None)
+    if context.job_queue is None or update.effective_user is None:
+        return
+    for job in context.job_queue.get_jobs_by_name(f"expire_amazon_order_index_{update.effective_user.id}"):
+        job.schedule_removal()
+
+
+async def expire_amazon_order_index(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if context.user_data is not None and context.user_data.pop("amazon_order_index", None) is not None:
+        chat_id = context.job.chat_id if context.job else None
+        logger.info(f"Dropped the Amazon export of chat {chat_id}, it was not processed in time")
+
+
+async def handle_cancel_amazon_sync(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    forget_amazon_order_index(update, context)
+    await update.safe_delete_message()
+
+
 async def pre_processing_amazon_transactions(
     update: Update, context: ContextTypes.DEFAULT_TYPE, msg_id: int | None = None
 ):
@@ -94,14 +142,14 @@ async def pre_processing_amazon_transactions(
         logger.error("No user_data in context")
         return
 
-    export_file = context.user_data.get("amazon_export_file")
+    order_index = context.user_data.get("amazon_order_index")
     ai_categorization_enabled = context.user_data.get("ai_categorization_enabled", True)
 
-    if not export_file:
-        logger.error("No export file found in user_data")
+    if order_index is None:
+        logger.error("No Amazon order index found in user_data")
         return
 
-    summary = get_amazon_transactions_summary(export_file)
+    summary = get_amazon_transactions_summary(order_index)
     if ai_categorization_enabled:
         ai_categorization_enabled_text = "AI categorization is 🟢 ᴏɴ."
     else:
@@ -137,78 +185,44 @@ async def pre_processing_amazon_transactions(
         )
 
 
-async def extract_amazon_csv_file(update: Update, file_name: str, downloads_path: str) -> str | None:
-    """Extract the Amazon CSV file from an upload.
+async def load_amazon_order_index(update: Update, file_name: str) -> AmazonOrderIndex | None:
+    """Index the Amazon orders of an upload.
+
+    The upload is downloaded to memory (Telegram caps what bots can download at 20MB) and
+    the CSV is parsed straight from it, decompressing it from the zip as it is read, so
+    nothing is ever written to disk.
 
     Args:
         update: The update object
         file_name: The name of the uploaded file
-        downloads_path: Path to save downloaded files
 
     Returns:
-        The path to the extracted CSV file or None if extraction failed
+        The index of the orders or None if the CSV could not be found or read
     """
     if not update.message or not update.message.document:
         logger.error("Missing required message/document data")
         return None
 
-    current_time_path = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     file = await update.message.document.get_file()
-    os.makedirs(downloads_path, exist_ok=True)
-    download_path = f"{downloads_path}/{current_time_path}_{update.chat_id}_{file_name}"
-    logger.info(f"Downloading file to {download_path}")
-    await file.download_to_drive(custom_path=download_path)
-
-    # if zip, extract and find the csv file inside the Retail.OrderHistory.1/ folder
-    if file_name.lower().endswith(".zip"):
-        # Create a temporary directory for extracted CSV only
-        temp_dir = tempfile.mkdtemp(dir=downloads_path)
-        target_csv_path = os.path.join(temp_dir, "amazon_orders.csv")
-        logger.info(f"Looking for CSV in zip file, will extract to {target_csv_path}")
-
-        try:
-            # Open the zip file and process one file at a time
-            with zipfile.ZipFile(download_path, "r") as zip_ref:
-                # Process zip contents without extracting everything
-                csv_found = False
-                for info in zip_ref.infolist():
-                    # Look only for CSV files in the right directory
-                    if info.filename.lower().endswith(".csv") and "Retail.OrderHistory.1" in info.filename:
-                        logger.info(f"Found CSV file: {info.filename}")
-                        # Extract just this one file
-                        with zip_ref.open(info) as source, open(target_csv_path, "wb") as target:
-                            # Copy in chunks to minimize memory usage
-                            shutil.copyfileobj(source, target, 65536)  # 64KB chunks
-                        csv_found = True
-                        break
-
-                if not csv_found:
-                    if update.message:
-                        await update.message.reply_text(
-                            "Could not find the CSV file in the Retail.OrderHistory.1/ folder."
-                        )
-                    # Clean up
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                    os.remove(download_path)
-                    return None
-
-            # Remove the zip file to free up space
-            os.remove(download_path)
-
-        except Exception as e:
-            logger.exception("Error extracting CSV from zip")
-            # Clean up on error
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir, ignore_errors=True)
-            if os.path.exists(download_path):
-                os.remove(download_path)
-            if update.message:
-                await update.message.reply_text(f"Error extracting CSV from zip file: {e}")
-            return None
-        else:
-            return target_csv_path
+    logger.info(f"Downloading {file_name} ({file.file_size} bytes) to memory")
+    upload = BytesIO()
+    await file.download_to_memory(out=upload)
+    upload.seek(0)
 
-    return download_path
+    try:
+        if file_name.lower().endswith(".zip"):
+            # find the csv file inside the Retail.OrderHistory.1/ folder
+            order_index = await asyncio.to_thread(AmazonOrderIndex.from_zip, upload)
+            if order_index is None:
+                await update.message.reply_text("Could not find the CSV file in the Retail.OrderHistory.1/ folder.")
+                return None
+            return order_index
+
+        return await asyncio.to_thread(AmazonOrderIndex.from_csv_stream, upload)
+    except Exception as e:
+        logger.exception("Error reading the Amazon export")
+        await update.message.reply_text(f"Error reading the Amazon export: {e}")
+        return None
 
 
 async def handle_amazon_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -234,10 +248,9 @@ async def handle_amazon_export(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(f"Did not recognize the file format ({ext}). Please upload a zip or csv file.")
         return
 
-    # download and extract file
-    downloads_path = os.getenv("DOWNLOADS_PATH", f"/tmp/{random.randint(1000, 9999)}")
-    download_path = await extract_amazon_csv_file(update, file_name, downloads_path)
-    if download_path is None:
+    # download and index the orders
+    order_index = await load_amazon_order_index(update, file_name)
+    if order_index is None:
         return
 
     # Increment the metric for Amazon export uploads
@@ -248,7 +261,7 @@ async def handle_amazon_export(update: Update, context: ContextTypes.DEFAULT_TYP
         if not context.user_data:
             context.user_data = {}
 
-        context.user_data["amazon_export_file"] = download_path
+        keep_amazon_order_index(update, context, order_index)
         context.user_data["ai_categorization_enabled"] = True
         await pre_processing_amazon_transactions(update, context)
 
@@ -258,6 +271,7 @@ async def handle_amazon_export(update: Update, context: ContextTypes.DEFAULT_TYP
             if prev and prev.get("msg_id") and context.bot:
                 await context.bot.delete_message(chat_id=update.chat_id, message_id=int(prev["msg_id"]))
     except Exception as e:
+        forget_amazon_order_index(update, context)
         await update.message.reply_text(f"Error processing the file: {e}")
 
 
@@ -268,12 +282,12 @@ async def handle_update_amz_settings(update: Update, context: ContextTypes.DEFAU
         return
 
     ai_categorization_enabled = update.callback_data_suffix == "True"
-    export_file = context.user_data.get("amazon_export_file")
+    order_index = context.user_data.get("amazon_order_index")
     msg_id = query.message.message_id if query.message else None
 
     context.user_data["ai_categorization_enabled"] = ai_categorization_enabled
 
-    if export_file is None:
+    if order_index is None:
         await update.safe_edit_message_text(
             "Seems like I forgot the Amazon export file. Please start over: /amazon_sync"
         )
@@ -288,10 +302,10 @@ async def handle_preview_process_amazon_transactions(update: Update, context: Co
         logger.error("Missing query or user_data")
         return
 
-    export_file = context.user_data.get("amazon_export_file")
+    order_index = context.user_data.get("amazon_order_index")
     ai_categorization_enabled = context.user_data.get("ai_categorization_enabled", False)
 
-    if export_file is None:
+    if order_index is None:
         await update.safe_edit_message_text(
             "Seems like I forgot the Amazon export file. Please start over: /amazon_sync"
         )
@@ -303,15 +317,14 @@ async def handle_preview_process_amazon_transactions(update: Update, context: Co
     try:
         await update.safe_edit_message_text("⏳ Processing transactions. This might take a while. Be patient.")
 
-        lunch_money_token = get_lunch_money_token_for_chat_id(update.chat_id)
-
-        result = process_amazon_transactions(
-            file_path=export_file,
+        result = await asyncio.to_thread(
+            process_amazon_transactions,
+            export=order_index,
             days_back=60,
             dry_run=True,
             allow_days=5,
             auto_categorize=ai_categorization_enabled,
-            lunch_money_token=lunch_money_token,
+            chat_id=update.chat_id,
         )
 
         processed_transactions = result.get("processed_transactions", 0)
@@ -337,12 +350,13 @@ Processed {processed_transactions} Amazon transactions from Lunch Money,
             kbd += ("Proceed", "process_amazon_transactions")
             # just a hack to go back to the previous menu
             kbd += ("Back to settings", "update_amz_settings_True")
-            kbd += ("Cancel", "cancel")
+            kbd += ("Cancel", "cancelAmazonSync")
         else:
-            kbd += ("Close", "cancel")
+            kbd += ("Close", "cancelAmazonSync")
 
         await update.safe_edit_message_text(text=message, parse_mode=ParseMode.MARKDOWN, reply_markup=kbd.build())
     except Exception as e:
+        forget_amazon_order_index(update, context)
         await update.safe_edit_message_text(f"Error processing Amazon transactions: {e}")
 
 
@@ -396,10 +410,10 @@ async def handle_process_amazon_transactions(update: Update, context: ContextTyp
         logger.error("Missing query or user_data")
         return
 
-    export_file = context.user_data.get("amazon_export_file")
+    order_index = context.user_data.get("amazon_order_index")
     ai_categorization_enabled = context.user_data.get("ai_categorization_enabled", False)
 
-    if export_file is None:
+    if order_index is None:
         await update.safe_edit_message_text(
             "Seems like I forgot the Amazon export file. Please start over: /amazon_sync"
         )
@@ -409,52 +423,117 @@ async def handle_process_amazon_transactions(update: Update, context: ContextTyp
     get_db().inc_metric("amazon_autocategorization_runs")
 
     try:
-        await update.safe_edit_message_text("⏳ Processing transactions. This might take a while. Be patient.")
+        await update.safe_edit_message_text("⏳ Matching the transactions against the Amazon export...")
 
-        lunch_money_token = get_lunch_money_token_for_chat_id(update.chat_id)
+        plan = await asyncio.to_thread(
+            plan_amazon_sync, export=order_index, days_back=60, allow_days=5, chat_id=update.chat_id
+        )
 
-        result = process_amazon_transactions(
-            file_path=export_file,
-            days_back=60,
-            dry_run=False,
-            allow_days=5,
-            auto_categorize=ai_categorization_enabled,
-            lunch_money_token=lunch_money_token,
+        # updating the transactions is the slow part (specially with AI categorization), so it
+        # runs in the background, editing this message with its progress
+        job_id = await get_background_jobs().submit(
+            context,
+            update.chat_id,
+            AMAZON_SYNC_JOB,
+            {
+                "auto_categorize": ai_categorization_enabled,
+                "processed_transactions": len(plan.transactions),
+                "found_transactions": plan.found_count,
+            },
+            [{"transaction_id": tx.id, "match": found} for tx, found in plan.to_update],
+            message_id=update.message_id,
         )
+        if job_id is None:
+            await update.safe_edit_message_text(
+                "Another job is already running for this chat. Wait for it to finish (or cancel it) and try again.",
+                reply_markup=get_process_amazon_tx_buttons(ai_categorization_enabled),
+            )
+            return
+
+        # the export is not needed anymore, let it be garbage collected
+        forget_amazon_order_index(update, context)
+    except Exception as e:
+        forget_amazon_order_index(update, context)
+        await update.safe_edit_message_text(f"Error processing Amazon transactions: {e}")
+
+
+def prepare_amazon_sync_job(chat_id: int, payload: dict, items: list[dict]) -> tuple:
+    lunch = get_lunch_client_for_chat_id(chat_id)
+    categories = lunch.get_categories()
+
+    suggestions = {}
+    if payload["auto_categorize"]:
+        mirror = get_transaction_mirror()
+        to_update = []
+        for item in items:
+            tx_id = item["transaction_id"]
+            transaction = mirror.peek_transaction(chat_id, tx_id) or mirror.refresh_transaction(chat_id, tx_id)
+            to_update.append((transaction, item["match"]))
+        suggestions = suggest_amazon_categories(to_update, categories)
+    return chat_id, lunch, categories, suggestions
+
+
+def run_amazon_sync_job_item(state: tuple, _: dict, item: dict) -> dict[str, int]:
+    chat_id, lunch, categories, suggestions = state
+    result = apply_amazon_match(
+        chat_id,
+        item["transaction_id"],
+        item["match"],
+        lunch=lunch,
+        categories=categories,
+        suggested_category_id=suggestions.get(item["transaction_id"]),
+    )
+    return {"updated": 1} if result else {"skipped": 1}
 
-        processed_transactions = result.get("processed_transactions", 0)
-        found_transactions = result.get("found_transactions", 0)
-        will_update_transactions = result.get("will_update_transactions", 0)
 
-        not_updated = found_transactions - will_update_transactions
+def render_amazon_sync_job(
+    job: BackgroundJob, payload: dict, progress: dict[str, int]
+) -> tuple[str, InlineKeyboardMarkup | None]:
+    updated = progress.get("updated", 0)
+    skipped = progress.get("skipped", 0)
+    failed = progress.get("failed", 0)
+
+    details = []
+    if skipped > 0:
+        details.append(f"{skipped} transactions got notes in the meantime and were left as they were.")
+    if failed > 0:
+        details.append(f"{failed} transactions could not be updated.")
+    details_text = "\n".join(details)
+
+    if job.status == "done":
+        not_updated = payload["found_transactions"] - job.total
         not_updated_text = ""
         if not_updated > 0:
             not_updated_text = f"{not_updated} transactions were not updated because they already had notes."
 
-        message = dedent(
+        text = dedent(
             f"""
-            Found {processed_transactions} Amazon transactions in Lunch Money,
-            out of which {found_transactions} were found in the Amazon export file,
-            and will update {will_update_transactions} in total.
+            Found {payload["processed_transactions"]} Amazon transactions in Lunch Money,
+            out of which {payload["found_transactions"]} were found in the Amazon export file,
+            and updated {updated} in total.
 
             {not_updated_text}
             """
         )
+        return text + details_text, None
 
-        if context.bot:
-            await context.bot.send_message(chat_id=update.chat_id, text=message, parse_mode=ParseMode.MARKDOWN)
-            await update.safe_delete_message()
-    except Exception as e:
-        await update.safe_edit_message_text(f"Error processing Amazon transactions: {e}")
-    finally:
-        # Clean up extracted files
-        if export_file and os.path.exists(export_file):
-            try:
-                # Remove the file
-                os.remove(export_file)
-                # If it's in a temp directory, try to remove the directory too
-                parent_dir = os.path.dirname(export_file)
-                if os.path.basename(parent_dir).startswith("tmp") and len(os.listdir(parent_dir)) == 0:
-                    shutil.rmtree(parent_dir, ignore_errors=True)
-            except Exception:
-                logger.exception("Error cleaning up temporary files")
+    if job.status == "cancelled":
+        return f"🛑 Amazon sync cancelled. Updated {updated} of {job.total} transactions before stopping.", None
+
+    if job.status == "failed":
+        # the status is sent as Markdown, which error messages could break
+        error = escape_markdown(job.error or "")
+        return (
+            f"Error processing Amazon transactions: {error}. Updated {updated} of {job.total} before the error.",
+            None,
+        )
+
+    kbd = Keyboard()
+    kbd += ("Cancel", f"cancelJob_{job.id}")
+    text = f"⏳ Updating Amazon transactions: {job.cursor} of {job.total} done, {updated} updated.\n\n{details_text}"
+    return text, kbd.build()
+
+
+get_background_jobs().register(
+    AMAZON_SYNC_JOB, BackgroundJobKind(prepare_amazon_sync_job, run_amazon_sync_job_item, render_amazon_sync_job)
+)
@@ -1,12 +1,11 @@
+import asyncio
 import logging
-import os
 import time
-from tempfile import NamedTemporaryFile
 
-import requests
 from telegram.constants import ParseMode, ReactionEmoji
 from telegram.ext import ContextTypes
 
+from deepinfra_client import get_deepinfra_client
 from handlers.lunch_money_agent import get_agent_response, handle_ai_response
 from persistence import get_db
 from telegram_extensions import Update
@@ -83,7 +82,9 @@ async def handle_audio_transcription(update: Update, context: ContextTypes.DEFAU
             tx_id = get_db().get_tx_associated_with(replying_to_msg_id, message.chat_id)
 
         # Process the transcription with AI
-        ai_response = get_agent_response(transcription, chat_id, tx_id, replying_to_msg_id, verbose=True)
+        ai_response = await asyncio.to_thread(
+            get_agent_response, transcription, chat_id, tx_id, replying_to_msg_id, verbose=True
+        )
         await handle_ai_response(update, context, ai_response)
 
     except Exception as e:
@@ -125,14 +126,12 @@ async def _process_audio_transcription(
     file_size = getattr(audio_file, "file_size", 0) or 0
     get_db().inc_metric("audio_file_size_bytes", file_size)
 
-    # Save to a temporary file
-    with NamedTemporaryFile(delete=False, suffix=".ogg") as temp_file:
-        await audio_data.download_to_drive(temp_file.name)
-        temp_path = temp_file.name
+    # Voice messages are small, so they are kept in memory instead of a temporary file
+    audio_bytes = bytes(await audio_data.download_as_bytearray())
 
     # Transcribe the audio
     transcription_start = time.time()
-    transcription, language = transcribe_audio(temp_path)
+    transcription, language = await transcribe_audio(audio_bytes)
     transcription_time = time.time() - transcription_start
     get_db().inc_metric("audio_transcription_time_seconds", transcription_time)
 
@@ -151,36 +150,27 @@ async def _process_audio_transcription(
                     chat_id=chat_id, text=f"I will process now the following transcription:\n{transcription}"
                 )
 
-    # Delete the temporary file
-    os.unlink(temp_path)
-
     return transcription
 
 
-def transcribe_audio(file_path: str) -> tuple[str, str]:
+async def transcribe_audio(audio: bytes, filename: str = "audio.ogg") -> tuple[str, str]:
     """
     Transcribe an audio file using DeepInfra's Whisper API.
 
     Args:
-        file_path: Path to the audio file
+        audio: The content of the audio file
+        filename: The name the audio file is uploaded with
 
     Returns:
         A tuple containing the transcription text and detected language
     """
-    url = "https://api.deepinfra.com/v1/inference/openai/whisper-large-v3"
-    api_key = os.getenv("DEEPINFRA_API_KEY")
-
-    if not api_key:
-        raise ValueError("DEEPINFRA_API_KEY not set")
-
-    headers = {"Authorization": f"Bearer {api_key}"}
-
-    logger.info(f"Sending audio file {file_path} to DeepInfra for transcription")
+    logger.info(f"Sending {len(audio)} bytes of audio to DeepInfra for transcription")
 
     try:
-        with open(file_path, "rb") as audio_file:
-            files = {"audio": audio_file}
-            response = requests.post(url, headers=headers, files=files)
+        # the content is passed as bytes, so that it can be uploaded again if the request is retried
+        response = await get_deepinfra_client().post(
+            "/v1/inference/openai/whisper-large-v3", files={"audio": (filename, audio)}
+        )
 
         # Track DeepInfra usage metrics
         get_db().inc_metric("deepinfra_whisper_requests")
@@ -3,7 +3,7 @@ from telegram import InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
-from lunch import get_lunch_client_for_chat_id
+from lunch import get_async_lunch_client_for_chat_id
 from persistence import get_db
 from telegram_extensions import Update
 from utils import Keyboard, get_crypto_symbol, get_emoji_for_account_type, make_tag
@@ -140,17 +140,18 @@ async def handle_show_balances(
     update: Update, context: ContextTypes.DEFAULT_TYPE, mask: int = SHOW_BALANCES, message_id: int | None = None
 ):
     """Shows all the Plaid accounts and its balances to the user."""
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
 
+    # balances are what this view is about, so never show cached ones
     all_accounts = []
     if is_show_balances(mask):
-        all_accounts += lunch.get_plaid_accounts()
+        all_accounts += await lunch.get_plaid_accounts(fresh=True)
 
     if is_show_assets(mask):
-        all_accounts += lunch.get_assets()
+        all_accounts += await lunch.get_assets(fresh=True)
 
     if is_show_crypto(mask):
-        all_accounts += lunch.get_crypto()
+        all_accounts += await lunch.get_crypto()
 
     settings = get_db().get_current_settings(update.chat_id)
     tagging = settings.tagging if settings else True
@@ -1,11 +1,10 @@
 import logging
 from datetime import datetime, timedelta
 
-from lunchable import LunchMoney
 from telegram.ext import ContextTypes
 
 from budget_messaging import hide_budget_categories, send_budget, show_budget_categories, show_bugdget_for_category
-from lunch import get_lunch_client_for_chat_id
+from lunch import AsyncLunchMoney, get_async_lunch_client_for_chat_id
 from persistence import get_db
 from telegram_extensions import Update
 
@@ -40,12 +39,12 @@ def get_budget_range_from(date: datetime) -> tuple[datetime, datetime]:
     return date, end_of_month
 
 
-def get_default_budget(lunch: LunchMoney):
+async def get_default_budget(lunch: AsyncLunchMoney):
     """Get the budget for the current month."""
     # get a datetime of the first day of the current month
     first_day_current_month, final_day_current_month = get_default_budget_range()
 
-    return lunch.get_budgets(start_date=first_day_current_month, end_date=final_day_current_month)
+    return await lunch.get_budgets(start_date=first_day_current_month, end_date=final_day_current_month)
 
 
 async def handle_show_budget(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -59,10 +58,10 @@ async def handle_show_budget(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         budget_date, budget_end_date = get_default_budget_range()
 
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
     logger.info(f"Pulling budget for chat id {update.chat_id}...")
 
-    budget = lunch.get_budgets(start_date=budget_date, end_date=budget_end_date)
+    budget = await lunch.get_budgets(start_date=budget_date, end_date=budget_end_date)
     await send_budget(update, context, budget, budget_date, message_id)
 
     # delete command message
@@ -74,10 +73,10 @@ async def handle_btn_show_budget_categories(update: Update, context: ContextType
     budget_date = update.callback_data_suffix
     budget_date = datetime.fromisoformat(budget_date)
 
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
 
     budget_date, final_day_current_month = get_budget_range_from(budget_date)
-    budget = lunch.get_budgets(start_date=budget_date, end_date=final_day_current_month)
+    budget = await lunch.get_budgets(start_date=budget_date, end_date=final_day_current_month)
 
     await show_budget_categories(update, context, budget, budget_date)
 
@@ -87,10 +86,10 @@ async def handle_btn_hide_budget_categories(update: Update, _: ContextTypes.DEFA
     budget_date = update.callback_data_suffix
     budget_date = datetime.fromisoformat(budget_date)
 
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
 
     budget_date, budget_end_date = get_budget_range_from(budget_date)
-    budget = lunch.get_budgets(start_date=budget_date, end_date=budget_end_date)
+    budget = await lunch.get_budgets(start_date=budget_date, end_date=budget_end_date)
 
     await hide_budget_categories(update, budget, budget_date)
 
@@ -105,13 +104,13 @@ async def handle_btn_show_budget_for_category(update: Update, _: ContextTypes.DE
     budget_date = datetime.fromisoformat(budget_date)
     category_id = int(parts[2])
 
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
 
     budget_date, budget_end_date = get_budget_range_from(budget_date)
-    all_budget = lunch.get_budgets(start_date=budget_date, end_date=budget_end_date)
+    all_budget = await lunch.get_budgets(start_date=budget_date, end_date=budget_end_date)
 
     # get super category
-    category = lunch.get_category(category_id)
+    category = await lunch.get_category(category_id)
     children_categories_ids = []
     if category and category.children:
         children_categories_ids = [child.id for child in category.children]
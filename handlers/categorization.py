@@ -1,21 +1,162 @@
+import asyncio
 import logging
+import os
+from datetime import date, timedelta
 
+from lunchable import TransactionUpdateObject
+from telegram import InlineKeyboardMarkup
 from telegram.ext import ContextTypes
+from telegram.helpers import escape_markdown
 
-from deepinfra import auto_categorize
+from async_persistence import get_async_db
+from background_jobs import BackgroundJobKind, get_background_jobs
+from deepinfra import auto_categorize, get_suggested_category_ids
 from lunch import get_lunch_client_for_chat_id
-from persistence import get_db
-from tx_messaging import send_transaction_message
+from persistence import BackgroundJob, get_db
+from telegram_extensions import Update
+from transaction_mirror import get_transaction_mirror
+from tx_messaging import SendPriority, edit_transaction_message, render_updated_transaction
+from utils import Keyboard
 
 logger = logging.getLogger("categorization")
 
+AI_CATEGORIZE_JOB = "ai_categorize"
+
+# How far back /ai_categorize looks for uncategorized transactions
+AI_CATEGORIZE_DAYS_BACK = 30
+
 
 async def ai_categorize_transaction(tx_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    response = auto_categorize(tx_id, chat_id)
+    response = await auto_categorize(tx_id, chat_id)
     logger.info(f"AI-categorization response: {response}")
 
     # update the transaction message to show the new categories
-    lunch = get_lunch_client_for_chat_id(chat_id)
-    updated_tx = lunch.get_transaction(tx_id)
     msg_id = get_db().get_message_id_associated_with(tx_id, chat_id)
-    await send_transaction_message(context, transaction=updated_tx, chat_id=chat_id, message_id=msg_id)
+    await render_updated_transaction(context, chat_id, tx_id, msg_id)
+
+
+async def handle_ai_categorize_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """AI-categorizes all the uncategorized transactions of the last days, as a background job."""
+    if not update.message:
+        return
+
+    if not os.getenv("DEEPINFRA_API_KEY"):
+        await update.message.reply_text("AI categorization is not enabled in this bot.")
+        return
+
+    msg = await update.message.reply_text("⏳ Looking for uncategorized transactions...")
+    end_date = date.today()
+    transactions = await get_transaction_mirror().get_transactions_async(
+        update.chat_id, end_date - timedelta(days=AI_CATEGORIZE_DAYS_BACK), end_date
+    )
+    uncategorized = [tx for tx in transactions if tx.category_id is None and not tx.is_group and not tx.is_pending]
+    if not uncategorized:
+        await msg.edit_text(f"There are no uncategorized transactions in the last {AI_CATEGORIZE_DAYS_BACK} days.")
+        return
+
+    get_db().inc_metric("ai_categorize_all_runs")
+    job_id = await get_background_jobs().submit(
+        context,
+        update.chat_id,
+        AI_CATEGORIZE_JOB,
+        {},
+        [{"transaction_id": tx.id} for tx in uncategorized],
+        message_id=msg.message_id,
+    )
+    if job_id is None:
+        await msg.edit_text(
+            "Another job is already running for this chat. Wait for it to finish (or cancel it) and try again."
+        )
+
+
+def prepare_ai_categorize_job(chat_id: int, _: dict, items: list[dict]) -> tuple:
+    lunch = get_lunch_client_for_chat_id(chat_id)
+    categories = lunch.get_categories()
+    mirror = get_transaction_mirror()
+    transactions = []
+    for item in items:
+        tx_id = item["transaction_id"]
+        transactions.append(mirror.peek_transaction(chat_id, tx_id) or mirror.refresh_transaction(chat_id, tx_id))
+
+    # all of them are categorized upfront, in as few prompts as possible
+    suggestions = get_suggested_category_ids(transactions, categories)
+    mark_reviewed = get_db().get_current_settings(chat_id).mark_reviewed_after_categorized
+    return chat_id, lunch, suggestions, mark_reviewed
+
+
+def run_ai_categorize_job_item(state: tuple, _: dict, item: dict) -> dict[str, int]:
+    chat_id, lunch, suggestions, mark_reviewed = state
+    tx_id = item["transaction_id"]
+    category_id = suggestions.get(tx_id)
+    if category_id is None:
+        return {"skipped": 1}
+
+    # it could have been categorized since the job started (or before a restart)
+    transaction = get_transaction_mirror().refresh_transaction(chat_id, tx_id)
+    if transaction.category_id is not None:
+        return {"skipped": 1}
+
+    if mark_reviewed:
+        lunch.update_transaction(tx_id, TransactionUpdateObject(category_id=category_id, status="cleared"))  # type: ignore
+        get_db().mark_as_reviewed_by_tx_id(tx_id, chat_id)
+    else:
+        lunch.update_transaction(tx_id, TransactionUpdateObject(category_id=category_id))  # type: ignore
+    return {"categorized": 1}
+
+
+async def finish_ai_categorize_job(
+    context: ContextTypes.DEFAULT_TYPE, job: BackgroundJob, _: dict, items: list[dict]
+) -> None:
+    """Updates the messages of the transactions the job went through, in the bulk lane.
+
+    They are rendered from the locally updated copies kept by the transaction mirror, and the
+    ones that were left as they were render the same, so they are skipped without a Telegram call.
+    """
+    mirror = get_transaction_mirror()
+    for item in items:
+        tx_id = item["transaction_id"]
+        message_id = await get_async_db().get_message_id_associated_with(tx_id, job.chat_id)
+        if message_id is None:
+            continue
+        try:
+            transaction = await asyncio.to_thread(mirror.peek_transaction, job.chat_id, tx_id)
+            if transaction is None:
+                transaction = await mirror.refresh_transaction_async(job.chat_id, tx_id)
+            await edit_transaction_message(context, transaction, job.chat_id, message_id, priority=SendPriority.BULK)
+        except Exception:
+            logger.exception(f"Could not update the message of transaction {tx_id}")
+
+
+def render_ai_categorize_job(
+    job: BackgroundJob, _: dict, progress: dict[str, int]
+) -> tuple[str, InlineKeyboardMarkup | None]:
+    categorized = progress.get("categorized", 0)
+    skipped = progress.get("skipped", 0)
+    failed = progress.get("failed", 0)
+
+    details = ""
+    if skipped > 0:
+        details += f"\n{skipped} were left as they were (no suitable category, or already categorized)."
+    if failed > 0:
+        details += f"\n{failed} could not be updated."
+
+    if job.status == "done":
+        return f"🪄 Categorized {categorized} of {job.total} uncategorized transactions.{details}", None
+    if job.status == "cancelled":
+        return f"🛑 Cancelled. Categorized {categorized} of {job.total} transactions before stopping.{details}", None
+    if job.status == "failed":
+        # the status is sent as Markdown, which error messages could break
+        return f"AI failed to categorize the transactions: {escape_markdown(job.error or '')}", None
+
+    kbd = Keyboard()
+    kbd += ("Cancel", f"cancelJob_{job.id}")
+    text = f"⏳ AI-categorizing {job.total} uncategorized transactions: {job.cursor} done, {categorized} categorized."
+    return text + details, kbd.build()
+
+
+get_background_jobs().register(
+    AI_CATEGORIZE_JOB,
+    BackgroundJobKind(
+        prepare_ai_categorize_job, run_ai_categorize_job_item, render_ai_categorize_job, finish=finish_ai_categorize_job
+    ),
+)
@@ -1,4 +1,11 @@
+import json
 import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from persistence import Persistence, get_db
 
 EXPECTING_TOKEN = "token"
 EXPECTING_TIME_ZONE = "time_zone"
@@ -7,23 +14,117 @@ EDIT_NOTES = "edit_notes"
 SET_TAGS = "set_tags"
 AMAZON_EXPORT = "amazon_export"
 
-expectations: dict[int, dict[str, str] | None] = {}
+# How long an expectation waits for the reply before it is dropped
+EXPECTATION_TTL_SECS = int(os.getenv("EXPECTATION_TTL_SECS", "86400"))
+
+# How many expectations are kept in memory, and for how long they are trusted before being read
+# from the DB again (which is what another replica would have written to)
+EXPECTATION_CACHE_SIZE = int(os.getenv("EXPECTATION_CACHE_SIZE", "1000"))
+EXPECTATION_CACHE_TTL_SECS = int(os.getenv("EXPECTATION_CACHE_TTL_SECS", "60"))
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("expectations")
 
 
+class ExpectationStore:
+    """Keeps what each chat is expected to reply with (e.g. the new payee after pressing "Rename payee").
+
+    Expectations are written through to the durable tier (the DB, when given), so they survive
+    restarts and are visible to every replica. Reads are served from a bounded in-memory LRU
+    whose entries are trusted for cache_ttl_secs, then read from the durable tier again. Chats
+    without an expectation (which is what most messages find) are cached as such too.
+    Expectations nobody replied to expire after ttl_secs.
+    """
+
+    def __init__(self, durable: Persistence | None, ttl_secs: float, cache_size: int, cache_ttl_secs: float):
+        self.durable = durable
+        self.ttl = timedelta(seconds=ttl_secs)
+        self.cache_size = cache_size
+        self.cache_ttl = timedelta(seconds=cache_ttl_secs)
+        # chat_id -> (until when the entry can be served, when the expectation expires, the expectation
+        # or None if there is none)
+        self._cache: OrderedDict[int, tuple[datetime, datetime, dict[str, str] | None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int) -> dict[str, str] | None:
+        now = datetime.now()
+        with self._lock:
+            entry = self._cache.get(chat_id)
+            if entry is not None and now < entry[0]:
+                self._cache.move_to_end(chat_id)
+                return dict(entry[2]) if entry[2] is not None else None
+            self._cache.pop(chat_id, None)
+
+        if self.durable is None:
+            return None
+        row = self.durable.get_expectation(chat_id)
+        if row is not None and row.expires_at <= now:
+            self.durable.delete_expectation(chat_id)
+            row = None
+        if row is None:
+            self._cache_put(chat_id, now + self.cache_ttl, None, now)
+            return None
+        expectation = json.loads(row.payload)
+        self._cache_put(chat_id, row.expires_at, expectation, now)
+        return dict(expectation)
+
+    def set(self, chat_id: int, expectation: dict[str, str]) -> None:
+        now = datetime.now()
+        expires_at = now + self.ttl
+        if self.durable is not None:
+            self.durable.save_expectation(chat_id, json.dumps(expectation), expires_at)
+        self._cache_put(chat_id, expires_at, dict(expectation), now)
+
+    def clear(self, chat_id: int) -> dict[str, str] | None:
+        prev = self.get(chat_id)
+        if prev is not None and self.durable is not None:
+            self.durable.delete_expectation(chat_id)
+        now = datetime.now()
+        self._cache_put(chat_id, now + self.cache_ttl, None, now)
+        return prev
+
+    def purge_expired(self) -> int:
+        """Drops the expired expectations from both tiers, and returns how many were in the DB."""
+        now = datetime.now()
+        with self._lock:
+            for chat_id in [chat_id for chat_id, entry in self._cache.items() if entry[1] <= now]:
+                del self._cache[chat_id]
+        if self.durable is None:
+            return 0
+        return self.durable.delete_expired_expectations(now)
+
+    def _cache_put(self, chat_id: int, expires_at: datetime, expectation: dict[str, str] | None, now: datetime) -> None:
+        with self._lock:
+            self._cache[chat_id] = (min(expires_at, now + self.cache_ttl), expires_at, expectation)
+            self._cache.move_to_end(chat_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+expectation_store = None
+
+
+def get_expectation_store() -> ExpectationStore:
+    global expectation_store
+    if expectation_store is None:
+        expectation_store = ExpectationStore(
+            get_db(), EXPECTATION_TTL_SECS, EXPECTATION_CACHE_SIZE, EXPECTATION_CACHE_TTL_SECS
+        )
+    return expectation_store
+
+
 def get_expectation(chat_id: int) -> dict[str, str] | None:
-    return expectations.get(chat_id, None)
+    return get_expectation_store().get(chat_id)
 
 
 def set_expectation(chat_id: int, expectation: dict[str, str]):
     logger.info(f"Setting expectation for chat_id {chat_id}: {expectation}")
-    expectations[chat_id] = expectation
+    get_expectation_store().set(chat_id, expectation)
 
 
 def clear_expectation(chat_id: int) -> dict[str, str] | None:
-    prev = expectations.get(chat_id)
-    expectations[chat_id] = None
-    return prev
+    return get_expectation_store().clear(chat_id)
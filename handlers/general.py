@@ -8,6 +8,7 @@ from lunchable import TransactionUpdateObject
 from telegram.constants import ParseMode, ReactionEmoji
 from telegram.ext import ContextTypes
 
+from background_jobs import get_background_jobs
 from constants import NOTES_MAX_LENGTH
 from errors import NoLunchTokenError
 from handlers.amz import handle_amazon_export
@@ -26,10 +27,10 @@ from handlers.expectations import (
 from handlers.lunch_money_agent import handle_generic_message_with_ai
 from handlers.settings.schedule_rendering import get_schedule_rendering_buttons, get_schedule_rendering_text
 from handlers.settings.session import handle_register_token
-from lunch import get_lunch_client_for_chat_id
+from lunch import get_async_lunch_client_for_chat_id, invalidate_reference_data_for_chat_id
 from persistence import get_db
 from telegram_extensions import Update
-from tx_messaging import send_transaction_message
+from tx_messaging import render_updated_transaction
 
 logger = logging.getLogger("handlers")
 
@@ -131,6 +132,7 @@ async def clear_cache(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     get_db().delete_transactions_for_chat(update.chat_id)
+    invalidate_reference_data_for_chat_id(update.chat_id)
     await context.bot.set_message_reaction(
         chat_id=update.chat_id, message_id=update.message.message_id, reaction=ReactionEmoji.THUMBS_UP
     )
@@ -141,6 +143,14 @@ async def handle_cancel(update: Update, _: ContextTypes.DEFAULT_TYPE):
     await update.safe_delete_message()
 
 
+async def handle_btn_cancel_job(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancels a background job. The status message is updated once the job stops."""
+    job_id = int(update.callback_data_suffix)
+    cancelled = await get_background_jobs().cancel(context, job_id, update.chat_id)
+    if update.callback_query:
+        await update.callback_query.answer("Cancelling..." if cancelled else "It already finished")
+
+
 async def handle_rename_payee(update: Update, context: ContextTypes.DEFAULT_TYPE, expectation: dict) -> bool:
     """Handle renaming a payee for a transaction."""
     if not update.message or not update.message.text:
@@ -149,16 +159,13 @@ async def handle_rename_payee(update: Update, context: ContextTypes.DEFAULT_TYPE
     clear_expectation(update.chat_id)
 
     # updates the transaction with the new payee
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
     transaction_id = int(expectation["transaction_id"])
-    lunch.update_transaction(transaction_id, TransactionUpdateObject(payee=update.message.text))  # type: ignore
+    await lunch.update_transaction(transaction_id, TransactionUpdateObject(payee=update.message.text))  # type: ignore
 
     # edit the message to reflect the new payee
-    updated_transaction = lunch.get_transaction(transaction_id)
     msg_id = int(expectation["msg_id"])
-    await send_transaction_message(
-        context=context, transaction=updated_transaction, chat_id=update.chat_id, message_id=msg_id
-    )
+    await render_updated_transaction(context, update.chat_id, transaction_id, msg_id)
 
     # react to the message
     await context.bot.set_message_reaction(
@@ -175,19 +182,16 @@ async def handle_edit_notes(update: Update, context: ContextTypes.DEFAULT_TYPE,
     clear_expectation(update.chat_id)
 
     # updates the transaction with the new notes
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
     transaction_id = int(expectation["transaction_id"])
     notes = update.message.text
     if len(notes) > NOTES_MAX_LENGTH:
         notes = notes[:NOTES_MAX_LENGTH]
-    lunch.update_transaction(transaction_id, TransactionUpdateObject(notes=notes))  # type: ignore
+    await lunch.update_transaction(transaction_id, TransactionUpdateObject(notes=notes))  # type: ignore
 
     # edit the message to reflect the new notes
-    updated_transaction = lunch.get_transaction(transaction_id)
     msg_id = int(expectation["msg_id"])
-    await send_transaction_message(
-        context=context, transaction=updated_transaction, chat_id=update.chat_id, message_id=msg_id
-    )
+    await render_updated_transaction(context, update.chat_id, transaction_id, msg_id)
 
     settings = get_db().get_current_settings(update.chat_id)
     if settings and settings.auto_categorize_after_notes:
@@ -262,19 +266,16 @@ async def handle_set_tags(update: Update, context: ContextTypes.DEFAULT_TYPE, ex
     clear_expectation(update.chat_id)
 
     # updates the transaction with the new notes
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
     transaction_id = int(expectation["transaction_id"])
 
     tags_without_hashtag = [tag[1:] for tag in update.message.text.split(" ") if tag.startswith("#")]
     logger.info(f"Setting tags to transaction ({transaction_id}): {tags_without_hashtag}")
-    lunch.update_transaction(transaction_id, TransactionUpdateObject(tags=tags_without_hashtag))  # type: ignore
+    await lunch.update_transaction(transaction_id, TransactionUpdateObject(tags=tags_without_hashtag))  # type: ignore
 
     # edit the message to reflect the new notes
-    updated_transaction = lunch.get_transaction(transaction_id)
     msg_id = int(expectation["msg_id"])
-    await send_transaction_message(
-        context=context, transaction=updated_transaction, chat_id=update.chat_id, message_id=msg_id
-    )
+    await render_updated_transaction(context, update.chat_id, transaction_id, msg_id)
 
     # react to the message
     await context.bot.set_message_reaction(
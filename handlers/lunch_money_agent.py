@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import logging
 import os
@@ -26,10 +27,10 @@ from handlers.aitools.tools import (
     parse_date_reference,
     update_transaction,
 )
-from lunch import get_lunch_client_for_chat_id
+from lunch import get_async_lunch_client_for_chat_id
 from persistence import get_db
 from telegram_extensions import Update
-from tx_messaging import send_transaction_message
+from tx_messaging import send_new_transaction_message, send_transaction_message
 from utils import Keyboard
 
 logging.basicConfig(level=logging.INFO)
@@ -314,7 +315,9 @@ async def handle_generic_message_with_ai(update: Update, context: ContextTypes.D
         )
 
         # Get the AI response
-        response = get_agent_response(user_message, chat_id, tx_id, replying_to_msg_id, verbose=True)
+        response = await asyncio.to_thread(
+            get_agent_response, user_message, chat_id, tx_id, replying_to_msg_id, verbose=True
+        )
         await handle_ai_response(update, context, response)
 
         get_db().inc_metric("ai_agent_text_messages_successful")
@@ -360,10 +363,10 @@ async def handle_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE,
             raise
 
     if response.transactions_created_ids:
-        lunch_client = get_lunch_client_for_chat_id(chat_id)
+        lunch_client = get_async_lunch_client_for_chat_id(chat_id)
         for tx_id in response.transactions_created_ids:
-            tx = lunch_client.get_transaction(tx_id)
-            msg_id = await send_transaction_message(
+            tx = await lunch_client.get_transaction(tx_id)
+            msg_id, msg_render_hash = await send_new_transaction_message(
                 context, transaction=tx, chat_id=chat_id, reply_to_message_id=message.message_id
             )
             get_db().mark_as_sent(
@@ -373,15 +376,16 @@ async def handle_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 tx.recurring_type,
                 reviewed=True,
                 plaid_id=None,  # this is a manual transaction
+                render_hash=msg_render_hash,
             )
 
     if response.transaction_updated_ids:
-        lunch_client = get_lunch_client_for_chat_id(chat_id)
+        lunch_client = get_async_lunch_client_for_chat_id(chat_id)
         for tx_id, telegram_message_id in response.transaction_updated_ids.items():
             if telegram_message_id is None:
                 continue
             # update the transaction message to show its new content
-            updated_tx = lunch_client.get_transaction(tx_id)
+            updated_tx = await lunch_client.get_transaction(tx_id)
             await send_transaction_message(
                 context, transaction=updated_tx, chat_id=chat_id, message_id=telegram_message_id
             )
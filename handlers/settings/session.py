@@ -6,7 +6,7 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
 from handlers.expectations import EXPECTING_TOKEN, clear_expectation, set_expectation
-from lunch import get_lunch_client, get_lunch_client_for_chat_id
+from lunch import get_async_lunch_client, get_async_lunch_client_for_chat_id
 from persistence import get_db
 from telegram_extensions import Update
 from utils import Keyboard
@@ -79,8 +79,8 @@ async def handle_logout_cancel(update: Update, _: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_btn_trigger_plaid_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
-    lunch.trigger_fetch_from_plaid()
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
+    await lunch.trigger_fetch_from_plaid()
 
     settings_text = get_session_text(update.chat_id)
     await update.safe_edit_message_text(
@@ -123,8 +123,8 @@ async def handle_register_token(update: Update, context: ContextTypes.DEFAULT_TY
 
     try:
         # make sure the token is valid
-        lunch = get_lunch_client(token)
-        lunch_user = lunch.get_user()
+        lunch = get_async_lunch_client(token)
+        lunch_user = await lunch.get_user()
         get_db().save_token(update.chat_id, token)
 
         clear_expectation(hello_msg_id)
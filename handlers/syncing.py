@@ -1,15 +1,75 @@
+import asyncio
 import logging
+import os
+import time
 from datetime import timedelta
 
+from lunchable.models import TransactionObject
 from telegram.ext import ContextTypes
 
-from lunch import get_lunch_client_for_chat_id
-from persistence import get_db
+from async_persistence import get_async_db
+from persistence import Transaction
 from telegram_extensions import Update
-from tx_messaging import send_transaction_message
+from transaction_mirror import get_transaction_mirror
+from tx_messaging import SendPriority, edit_transaction_message, get_send_governor
 
 logger = logging.getLogger("messaging")
 
+# how many of the transactions missing from the mirror are fetched at the same time
+RESYNC_FETCH_CONCURRENCY = int(os.getenv("RESYNC_FETCH_CONCURRENCY", "4"))
+# how often the progress message is updated while resyncing
+RESYNC_PROGRESS_INTERVAL_SECS = 5
+
+
+class ResyncProgress:
+    """Counts what a resync did, and keeps a single progress message in the chat up to date."""
+
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, total: int):
+        self.context = context
+        self.chat_id = chat_id
+        self.total = total
+        self.updated = 0
+        self.unchanged = 0
+        self.errors = 0
+        self.missing = 0
+        self.message_id: int | None = None
+        self._last_report = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.updated + self.unchanged + self.errors + self.missing
+
+    def summary(self) -> str:
+        return f"{self.updated} updated, {self.unchanged} unchanged, {self.errors} errors, {self.missing} missing"
+
+    async def start(self) -> None:
+        msg = await self.context.bot.send_message(
+            chat_id=self.chat_id, text=f"⏳ Resyncing {self.total} transactions..."
+        )
+        self.message_id = msg.id
+        self._last_report = time.monotonic()
+
+    async def report(self) -> None:
+        now = time.monotonic()
+        if now - self._last_report < RESYNC_PROGRESS_INTERVAL_SECS:
+            return
+        self._last_report = now
+        await self._edit(f"⏳ Resyncing transactions: {self.done}/{self.total}\n{self.summary()}")
+
+    async def finish(self) -> None:
+        await self._edit(f"Resynced {self.total} transactions: {self.summary()}")
+
+    async def _edit(self, text: str) -> None:
+        try:
+            # progress goes ahead of the bulk edits, otherwise it would only show up at the end
+            await get_send_governor().send(
+                self.chat_id,
+                lambda: self.context.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text),
+                SendPriority.INTERACTIVE,
+            )
+        except Exception:
+            logger.exception(f"Error updating the resync progress in chat {self.chat_id}")
+
 
 async def handle_resync(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /resync command."""
@@ -22,8 +82,10 @@ async def handle_resync(update: Update, context: ContextTypes.DEFAULT_TYPE):
         last_n_days = int(parts[1])
 
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
-    chat_txs = get_db().get_all_tx_by_chat_id(chat_id)
+    chat_txs = await get_async_db().get_all_tx_by_chat_id(chat_id)
+    if not chat_txs:
+        await context.bot.send_message(chat_id=chat_id, text="There are no transactions to resync")
+        return
 
     # get the created_at bounds (i.e. the earliest and latest tx)
     earliest_tx_date = min(chat_txs, key=lambda tx: tx.created_at).created_at.replace(
@@ -36,48 +98,73 @@ async def handle_resync(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if last_n_days:
         earliest_tx_date = latest_tx_date - timedelta(days=last_n_days)
+        chat_txs = [tx for tx in chat_txs if tx.created_at >= earliest_tx_date]
+
+    progress = ResyncProgress(context, chat_id, len(chat_txs))
+    await progress.start()
 
     # get the txs within the bounds
     logger.info(f"Pulling transactions from lunch for range {earliest_tx_date} - {latest_tx_date}")
-    lunch_txs = lunch.get_transactions(start_date=earliest_tx_date, end_date=latest_tx_date)
+    lunch_txs = await get_transaction_mirror().get_transactions_async(
+        chat_id, earliest_tx_date.date(), latest_tx_date.date(), max_age_secs=0
+    )
 
-    # make a lookup map for the txs from lunch
+    # make a lookup map for the txs from lunch, and query the ones we miss individually
     lunch_txs_map = {tx.id: tx for tx in lunch_txs}
+    missing_tx_ids = [tx.tx_id for tx in chat_txs if tx.tx_id not in lunch_txs_map]
+    lunch_txs_map.update(await fetch_missing_transactions(chat_id, missing_tx_ids))
 
-    # now we use the information in this the tx from lunch to update the tx in the db
-    # and if we miss any, we will query them individually later on
-    if last_n_days:
-        chat_txs = [tx for tx in chat_txs if tx.created_at >= earliest_tx_date]
+    # the edits are paced by the send governor, so they can all be queued at once
+    await asyncio.gather(
+        *(resync_message(context, chat_id, tx, lunch_txs_map.get(tx.tx_id), progress) for tx in chat_txs)
+    )
 
-    errors = 0
-    missing = 0
-    for tx in chat_txs:
-        if tx.tx_id in lunch_txs_map:
-            lunch_tx = lunch_txs_map[tx.tx_id]
-            # for each transaction we must find the message that holds its information
-            # and update it to reflect the new information, if any
-            try:
-                await send_transaction_message(context, lunch_tx, chat_id, tx.message_id)
+    logger.info(f"Resynced {progress.total} transactions in chat {chat_id}: {progress.summary()}")
+    await progress.finish()
 
-                # update the tx in the db
-                if lunch_tx.status == "cleared":
-                    get_db().mark_as_reviewed(tx.message_id, chat_id)
-                else:
-                    get_db().mark_as_unreviewed(tx.message_id, chat_id)
-            except Exception:
-                logger.exception(f"Error sending transaction message for tx_id {tx.tx_id}")
-                errors += 1
-        else:
+
+async def fetch_missing_transactions(chat_id: int, tx_ids: list[int]) -> dict[int, TransactionObject]:
+    """Fetches the given transactions, RESYNC_FETCH_CONCURRENCY at a time. Failed fetches are left out."""
+    semaphore = asyncio.Semaphore(RESYNC_FETCH_CONCURRENCY)
+    mirror = get_transaction_mirror()
+
+    async def fetch(tx_id: int) -> TransactionObject | None:
+        async with semaphore:
             try:
-                lunch_tx = lunch.get_transaction(tx.tx_id)
-                await send_transaction_message(context, lunch_tx, chat_id, tx.message_id)
+                return await mirror.refresh_transaction_async(chat_id, tx_id)
             except Exception:
-                logger.exception(f"Error fetching transaction {tx.tx_id}")
-                missing += 1
-
-    logger.info(f"Resynced {len(chat_txs) - errors - missing} transactions, {errors} errors, {missing} missing")
-    # send a message showing the results
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"Resynced {len(chat_txs) - errors - missing} transactions, {errors} errors, {missing} missing",
-    )
+                logger.exception(f"Error fetching transaction {tx_id}")
+                return None
+
+    fetched = await asyncio.gather(*(fetch(tx_id) for tx_id in tx_ids))
+    return {tx_id: tx for tx_id, tx in zip(tx_ids, fetched, strict=True) if tx is not None}
+
+
+async def resync_message(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    tx: Transaction,
+    lunch_tx: TransactionObject | None,
+    progress: ResyncProgress,
+) -> None:
+    """Updates the message that holds the transaction, unless it would render exactly the same."""
+    if lunch_tx is None:
+        progress.missing += 1
+        await progress.report()
+        return
+
+    try:
+        if await edit_transaction_message(context, lunch_tx, chat_id, tx.message_id, priority=SendPriority.BULK):
+            progress.updated += 1
+        else:
+            progress.unchanged += 1
+
+        # update the tx in the db
+        if lunch_tx.status == "cleared" and tx.reviewed_at is None:
+            await get_async_db().mark_as_reviewed(tx.message_id, chat_id)
+        elif lunch_tx.status != "cleared" and tx.reviewed_at is not None:
+            await get_async_db().mark_as_unreviewed(tx.message_id, chat_id)
+    except Exception:
+        logger.exception(f"Error sending transaction message for tx_id {tx.tx_id}")
+        progress.errors += 1
+    await progress.report()
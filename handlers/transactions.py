@@ -1,26 +1,64 @@
+import asyncio
 import logging
-from datetime import UTC, datetime, timedelta
+import os
+import time
+from datetime import UTC, date, datetime, timedelta
 from textwrap import dedent
 
 from lunchable import TransactionUpdateObject
 from lunchable.models import TransactionObject
 from telegram import ForceReply
 from telegram.constants import ParseMode, ReactionEmoji
-from telegram.ext import ContextTypes
+from telegram.ext import ContextTypes, JobQueue
 
+from async_persistence import get_async_db
 from constants import NOTES_MAX_LENGTH
 from deepinfra import auto_categorize
+from errors import NoLunchTokenError
 from handlers.categorization import ai_categorize_transaction
 from handlers.expectations import EDIT_NOTES, RENAME_PAYEE, SET_TAGS, set_expectation
 from handlers.lunch_money_agent import handle_generic_message_with_ai
-from lunch import get_lunch_client_for_chat_id
-from persistence import get_db
+from lunch import get_async_lunch_client_for_chat_id
+from persistence import Transaction, get_db
+from poll_scheduler import get_next_poll_at
+from poll_shards import POLL_SHARD_COUNT, POLL_SHARD_LEASE_SECS, WORKER_ID, PollShards
 from telegram_extensions import Update
-from tx_messaging import get_tx_buttons, send_plaid_details, send_transaction_message
+from transaction_mirror import MIRROR_MAX_AGE_SECS, get_transaction_mirror
+from tx_messaging import (
+    SendPriority,
+    edit_transaction_buttons,
+    get_tx_buttons,
+    render_updated_transaction,
+    send_new_transaction_message,
+    send_plaid_details,
+    send_transaction_message,
+)
 from utils import Keyboard, ensure_token
 
 logger = logging.getLogger("tx_handler")
 
+# How many chats can be polled at the same time, and how long a single chat poll may take
+POLL_MAX_CONCURRENCY = int(os.getenv("POLL_MAX_CONCURRENCY", "8"))
+POLL_TIMEOUT_SECS = float(os.getenv("POLL_TIMEOUT_SECS", "120"))
+
+# Bounds on how long the poll job sleeps until the next chat is due
+POLL_MIN_SLEEP_SECS = 1
+POLL_MAX_SLEEP_SECS = int(os.getenv("POLL_MAX_SLEEP_SECS", "3600"))
+
+# How long to wait before retrying a due chat whose previous poll is still in flight
+POLL_RETRY_SECS = 60
+POLL_JOB_NAME = "poll_transactions"
+POLL_SHARDS_JOB_NAME = "renew_poll_shards"
+
+poll_semaphore = asyncio.Semaphore(POLL_MAX_CONCURRENCY)
+
+# The chats this worker polls when they are sharded across several workers. A chat is only
+# picked up if its lease lasts longer than the poll can take
+poll_shards = PollShards(WORKER_ID, POLL_SHARD_COUNT, POLL_SHARD_LEASE_SECS, POLL_TIMEOUT_SECS)
+
+# Chats whose poll is currently running (either scheduled or triggered by /review_transactions)
+polls_in_flight: set[int] = set()
+
 
 # Sort transactions by date in chronological order (oldest first)
 # Use plaid's authorized_datetime if available for more precise sorting
@@ -30,25 +68,26 @@ def get_transaction_datetime(t):
     return datetime.combine(t.date, datetime.min.time()).replace(tzinfo=UTC)
 
 
-async def fetch_transactions(chat_id: int, days_lookback: int, pending: bool):
+async def fetch_transactions(
+    chat_id: int, days_lookback: int, pending: bool, max_age_secs: float = MIRROR_MAX_AGE_SECS
+) -> list[TransactionObject]:
     """
-    Fetch transactions from LunchMoney API.
+    Fetch transactions from the local mirror of the LunchMoney transactions.
 
     Args:
         chat_id: Chat ID to get LunchMoney client for
         days_lookback: Number of days to look back from today
         pending: If True, fetch pending transactions. If False, fetch posted transactions.
+        max_age_secs: How stale the mirrored recent transactions can be before fetching them again
 
     Returns:
         List of transactions sorted chronologically
     """
-    lunch = get_lunch_client_for_chat_id(chat_id)
-    start_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days_lookback)
-    end_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    transactions = lunch.get_transactions(pending=pending, start_date=start_date, end_date=end_date)
+    end_date = date.today()
+    start_date = end_date - timedelta(days=days_lookback)
+    transactions = await get_transaction_mirror().get_transactions_async(chat_id, start_date, end_date, max_age_secs)
 
-    # TODO: this seems to be a bug in the LunchMoney API
-    # Filter out transactions whose pending state does not match the requested one
+    # the mirror keeps both pending and posted transactions
     transactions = [tx for tx in transactions if tx.is_pending == pending]
 
     logger.info(f"Found {len(transactions)} {'pending' if pending else 'posted'} transactions for chat {chat_id}")
@@ -85,17 +124,17 @@ async def check_transactions_and_telegram_them(
         f"Polling for {'pending' if poll_pending else 'posted'} transactions from {days_lookback} days ago for chat {chat_id}..."
     )
 
-    # Always get posted transactions
-    posted_transactions = await fetch_transactions(chat_id, days_lookback, pending=False)
+    # Always get posted transactions, refreshing the mirror so that the poll sees the latest state
+    posted_transactions = await fetch_transactions(chat_id, days_lookback, pending=False, max_age_secs=0)
 
-    # Get pending transactions if requested
+    # Get pending transactions if requested (the refresh above already brought them in)
     if poll_pending:
         pending_transactions = await fetch_transactions(chat_id, days_lookback, pending=True)
         transactions_to_process = pending_transactions + posted_transactions
     else:
         transactions_to_process = posted_transactions
 
-    settings = get_db().get_current_settings(chat_id)
+    settings = await get_async_db().get_current_settings(chat_id)
     all_updated_message_ids = set()
 
     ## 2. Handle transaction ID updates and auto-review based on settings
@@ -114,31 +153,45 @@ async def check_transactions_and_telegram_them(
         all_updated_message_ids = set(id_update_message_ids + reviewed_message_ids)
     else:
         # Handle auto-review for posted transactions
-        lunch = get_lunch_client_for_chat_id(chat_id)
+        lunch = get_async_lunch_client_for_chat_id(chat_id)
         for transaction in transactions_to_process:
             # Auto-mark as reviewed for posted transactions if enabled
             if settings.auto_mark_reviewed and transaction.status == "uncleared":
-                lunch.update_transaction(
+                await lunch.update_transaction(
                     transaction.id,
                     TransactionUpdateObject(status=TransactionUpdateObject.StatusEnum.cleared),  # type: ignore
                 )
                 transaction.status = "cleared"
 
     # 3. Send new transactions to Telegram that haven't been sent before
-    for transaction in transactions_to_process:
-        if get_db().was_already_sent(transaction.id):
-            logger.debug(f"Skipping already sent transaction {transaction.id} in chat {chat_id}")
-            continue
+    sent_tx_ids = await get_async_db().get_sent_tx_ids(chat_id, [tx.id for tx in transactions_to_process])
+    newly_sent: list[Transaction] = []
+    try:
+        for transaction in transactions_to_process:
+            if transaction.id in sent_tx_ids:
+                logger.debug(f"Skipping already sent transaction {transaction.id} in chat {chat_id}")
+                continue
 
-        msg_id = await send_transaction_message(context, transaction, chat_id)
-        get_db().mark_as_sent(
-            transaction.id,
-            chat_id,
-            msg_id,
-            transaction.recurring_type,
-            reviewed=transaction.status == "cleared",
-            plaid_id=(transaction.plaid_metadata.get("transaction_id", None) if transaction.plaid_metadata else None),
-        )
+            msg_id, msg_render_hash = await send_new_transaction_message(
+                context, transaction, chat_id, priority=SendPriority.BULK
+            )
+            sent_tx_ids.add(transaction.id)
+            newly_sent.append(
+                Transaction(
+                    tx_id=transaction.id,
+                    chat_id=chat_id,
+                    message_id=msg_id,
+                    recurring_type=transaction.recurring_type,
+                    reviewed_at=datetime.now() if transaction.status == "cleared" else None,
+                    plaid_id=(
+                        transaction.plaid_metadata.get("transaction_id", None) if transaction.plaid_metadata else None
+                    ),
+                    render_hash=msg_render_hash,
+                )
+            )
+    finally:
+        # persist whatever was sent, even if sending a later message failed
+        await get_async_db().mark_as_sent_many(newly_sent)
 
     # 4. Update Telegram messages for transactions that had their IDs updated or were marked as reviewed
     if poll_pending:
@@ -153,18 +206,22 @@ async def resync_updted_transactions(
         return
 
     logger.info(f"Resyncing {len(updated_message_ids)} updated transactions for chat {chat_id}")
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
     for message_id in updated_message_ids:
         try:
             # Get the transaction ID associated with this message
-            tx_id = get_db().get_tx_associated_with(message_id, chat_id)
+            tx_id = await get_async_db().get_tx_associated_with(message_id, chat_id)
             if tx_id:
                 # Get the updated transaction data from LunchMoney
-                updated_tx = lunch.get_transaction(tx_id)
+                updated_tx = await lunch.get_transaction(tx_id)
                 if updated_tx:
                     # Update the Telegram message with the latest transaction data
                     await send_transaction_message(
-                        context, transaction=updated_tx, chat_id=chat_id, message_id=message_id
+                        context,
+                        transaction=updated_tx,
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        priority=SendPriority.BULK,
                     )
                     logger.info(f"Updated Telegram message {message_id} for transaction {tx_id} in chat {chat_id}")
                 else:
@@ -217,7 +274,7 @@ async def update_transaction_ids_for_posted_transactions(
 
     # Get all previously sent pending transactions for this chat
     two_weeks_ago = datetime.now() - timedelta(days=14)
-    sent_txs = get_db().get_sent_transactions(chat_id, since=two_weeks_ago) or []
+    sent_txs = await get_async_db().get_sent_transactions(chat_id, since=two_weeks_ago) or []
 
     if not sent_txs:
         logger.info(f"No sent transactions found for chat {chat_id} in the last two weeks")
@@ -251,7 +308,7 @@ async def update_transaction_ids_for_posted_transactions(
             )
 
             # Update the transaction record with the new IDs
-            success = get_db().update_transaction_ids_by_plaid_id(
+            success = await get_async_db().update_transaction_ids_by_plaid_id(
                 old_plaid_id=sent_tx.plaid_id, new_tx_id=posted_tx.id, new_plaid_id=new_plaid_id
             )
 
@@ -277,13 +334,13 @@ async def mark_posted_txs_as_reviewed(
     Returns:
         list[int]: List of Telegram message IDs that were updated for reviewed transactions
     """
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
     logger.info(f"Checking if any previously sent transactions are now posted for {chat_id}...")
     updated_message_ids = []
 
     # Get all previously sent pending transactions
     two_weeks_ago = datetime.now() - timedelta(days=14)
-    sent_txs = get_db().get_sent_transactions(chat_id, since=two_weeks_ago) or []
+    sent_txs = await get_async_db().get_sent_transactions(chat_id, since=two_weeks_ago) or []
     if not sent_txs:
         logger.info(f"No sent transactions found for chat {chat_id} in the last two weeks")
         return []
@@ -325,15 +382,15 @@ async def mark_posted_txs_as_reviewed(
         )
         logger.info(f"Marking previously sent transaction {posted_tx.id} as reviewed")
         try:
-            lunch.update_transaction(
+            await lunch.update_transaction(
                 posted_tx.id,
                 TransactionUpdateObject(status=TransactionUpdateObject.StatusEnum.cleared),  # type: ignore
             )
 
             # Also mark as reviewed in the db
-            get_db().mark_as_reviewed_by_tx_id(posted_tx.id, chat_id)
+            await get_async_db().mark_as_reviewed_by_tx_id(posted_tx.id, chat_id)
 
-            msg_id = get_db().get_message_id_associated_with(posted_tx.id, chat_id)
+            msg_id = await get_async_db().get_message_id_associated_with(posted_tx.id, chat_id)
             if msg_id:
                 updated_message_ids.append(msg_id)
         except Exception:
@@ -346,17 +403,36 @@ async def mark_posted_txs_as_reviewed(
 
 
 async def handle_check_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.chat_id in polls_in_flight:
+        logger.info(f"Poll already in progress for chat {update.chat_id}, skipping manual check")
+        return
+
+    # polls_in_flight only covers this worker, so polling a chat another worker owns could send
+    # its transactions twice
+    if not poll_shards.owns(update.chat_id):
+        logger.info(f"Chat {update.chat_id} belongs to a shard this worker does not hold, skipping manual check")
+        if update.message:
+            await update.message.reply_text(
+                "Your transactions are checked by another instance of the bot. "
+                "New ones will show up on its next scheduled check."
+            )
+        return
+
+    polls_in_flight.add(update.chat_id)
     try:
         settings = ensure_token(update)
         await check_transactions_and_telegram_them(context, chat_id=update.chat_id, poll_pending=settings.poll_pending)
-        get_db().update_last_poll_at(update.chat_id, datetime.now().isoformat())
+        await get_async_db().update_last_poll_at(update.chat_id, datetime.now().isoformat())
     except Exception:
         logger.exception(f"Failed to check transactions for chat {update.chat_id}")
+    finally:
+        polls_in_flight.discard(update.chat_id)
 
 
 async def handle_btn_skip_transaction(update: Update, _: ContextTypes.DEFAULT_TYPE):
-    await update.safe_edit_message_reply_markup(
-        reply_markup=None,
+    await edit_transaction_buttons(
+        update,
+        None,
         answer_text="Transaction was left intact. You must review it manually from lunchmoney.app",
         show_alert=True,
     )
@@ -364,7 +440,7 @@ async def handle_btn_skip_transaction(update: Update, _: ContextTypes.DEFAULT_TY
 
 async def handle_btn_collapse_transaction(update: Update, _: ContextTypes.DEFAULT_TYPE):
     tx_id = int(update.callback_data_suffix)
-    await update.safe_edit_message_reply_markup(reply_markup=get_tx_buttons(update.chat_id, tx_id, collapsed=True))
+    await edit_transaction_buttons(update, await get_tx_buttons(update.chat_id, tx_id, collapsed=True))
 
 
 async def handle_btn_cancel_categorization(update: Update, _: ContextTypes.DEFAULT_TYPE):
@@ -372,7 +448,7 @@ async def handle_btn_cancel_categorization(update: Update, _: ContextTypes.DEFAU
         return
 
     tx_id = int(update.callback_data_suffix)
-    await update.safe_edit_message_reply_markup(reply_markup=get_tx_buttons(update.chat_id, tx_id))
+    await edit_transaction_buttons(update, await get_tx_buttons(update.chat_id, tx_id))
 
 
 async def handle_btn_show_categories(update: Update, _: ContextTypes.DEFAULT_TYPE):
@@ -381,10 +457,10 @@ async def handle_btn_show_categories(update: Update, _: ContextTypes.DEFAULT_TYP
         return
 
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
     transaction_id = int(update.callback_data_suffix)
 
-    categories = lunch.get_categories()
+    categories = await lunch.get_categories()
     kbd = Keyboard()
     for category in categories:
         if category.group_id is None:
@@ -395,7 +471,7 @@ async def handle_btn_show_categories(update: Update, _: ContextTypes.DEFAULT_TYP
 
     kbd += ("Cancel", f"cancelCategorization_{transaction_id}")
 
-    await update.safe_edit_message_reply_markup(reply_markup=kbd.build(columns=2))
+    await edit_transaction_buttons(update, kbd.build(columns=2))
 
 
 async def handle_btn_show_subcategories(update: Update, _: ContextTypes.DEFAULT_TYPE):
@@ -410,15 +486,15 @@ async def handle_btn_show_subcategories(update: Update, _: ContextTypes.DEFAULT_
     transaction_id, category_id = query.data.split("_")[1:]
 
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
-    subcategories = lunch.get_categories()
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
+    subcategories = await lunch.get_categories()
     kbd = Keyboard()
     for subcategory in subcategories:
         if str(subcategory.group_id) == str(category_id):
             kbd += (subcategory.name, f"applyCategory_{transaction_id}_{subcategory.id}")
     kbd += ("Cancel", f"cancelCategorization_{transaction_id}")
 
-    await update.safe_edit_message_reply_markup(reply_markup=kbd.build(columns=2))
+    await edit_transaction_buttons(update, kbd.build(columns=2))
 
 
 async def handle_btn_apply_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -434,20 +510,19 @@ async def handle_btn_apply_category(update: Update, context: ContextTypes.DEFAUL
 
     transaction_id, category_id = query.data.split("_")[1:]
     transaction_id = int(transaction_id)
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
 
-    settings = get_db().get_current_settings(chat_id)
+    settings = await get_async_db().get_current_settings(chat_id)
     if settings.mark_reviewed_after_categorized:
         update_obj = TransactionUpdateObject(category_id=category_id, status=TransactionUpdateObject.StatusEnum.cleared)  # type: ignore
-        lunch.update_transaction(transaction_id, update_obj)
-        get_db().mark_as_reviewed(query.message.message_id, chat_id)
+        await lunch.update_transaction(transaction_id, update_obj)
+        await get_async_db().mark_as_reviewed(query.message.message_id, chat_id)
     else:
         update_obj = TransactionUpdateObject(category_id=category_id)  # type: ignore
-        lunch.update_transaction(transaction_id, update_obj)
+        await lunch.update_transaction(transaction_id, update_obj)
     logger.info(f"Changed category for tx {transaction_id} to {category_id}")
 
-    updated_transaction = lunch.get_transaction(transaction_id)
-    await send_transaction_message(context, updated_transaction, chat_id, query.message.message_id)
+    await render_updated_transaction(context, chat_id, transaction_id, query.message.message_id)
     await query.answer()
 
 
@@ -456,9 +531,9 @@ async def handle_btn_dump_plaid_details(update: Update, context: ContextTypes.DE
     transaction_id = int(update.callback_data_suffix)
 
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
 
-    transaction = lunch.get_transaction(transaction_id)
+    transaction = await lunch.get_transaction(transaction_id)
     plaid_metadata = transaction.plaid_metadata
     plaid_details = "*Plaid Metadata*\n\n"
     plaid_details += f"*Transaction ID:* {transaction_id}\n"
@@ -476,17 +551,16 @@ async def handle_btn_mark_tx_as_reviewed(update: Update, context: ContextTypes.D
     if query is None or query.message is None:
         return
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
     transaction_id = int(update.callback_data_suffix)
     try:
-        lunch.update_transaction(transaction_id, TransactionUpdateObject(status="cleared"))  # type: ignore
+        await lunch.update_transaction(transaction_id, TransactionUpdateObject(status="cleared"))  # type: ignore
 
         # update message to show the right buttons
-        updated_tx = lunch.get_transaction(transaction_id)
-        msg_id = get_db().get_message_id_associated_with(transaction_id, chat_id)
-        await send_transaction_message(context, transaction=updated_tx, chat_id=chat_id, message_id=msg_id)
+        msg_id = await get_async_db().get_message_id_associated_with(transaction_id, chat_id)
+        await render_updated_transaction(context, chat_id, transaction_id, msg_id)
 
-        get_db().mark_as_reviewed(query.message.message_id, chat_id)
+        await get_async_db().mark_as_reviewed(query.message.message_id, chat_id)
         await query.answer()
     except Exception as e:
         await query.answer(text=f"Error marking transaction as reviewed: {e!s}", show_alert=True)
@@ -499,21 +573,20 @@ async def handle_btn_mark_tx_as_unreviewed(update: Update, context: ContextTypes
         return
 
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
     transaction_id = int(update.callback_data_suffix)
     try:
         logger.info(f"Marking transaction {transaction_id} as unreviewed")
-        lunch.update_transaction(
+        await lunch.update_transaction(
             transaction_id,
             TransactionUpdateObject(status=TransactionUpdateObject.StatusEnum.uncleared),  # type: ignore
         )
 
         # update message to show the right buttons
-        updated_tx = lunch.get_transaction(transaction_id)
-        msg_id = get_db().get_message_id_associated_with(transaction_id, chat_id)
-        await send_transaction_message(context, transaction=updated_tx, chat_id=chat_id, message_id=msg_id)
+        msg_id = await get_async_db().get_message_id_associated_with(transaction_id, chat_id)
+        await render_updated_transaction(context, chat_id, transaction_id, msg_id)
 
-        get_db().mark_as_unreviewed(query.message.message_id, chat_id)
+        await get_async_db().mark_as_unreviewed(query.message.message_id, chat_id)
         await query.answer()
     except Exception as e:
         await query.answer(text=f"Error marking transaction as reviewed: {e!s}", show_alert=True)
@@ -526,13 +599,13 @@ async def handle_message_reply(update: Update, context: ContextTypes.DEFAULT_TYP
 
     chat_id = update.chat_id
 
-    settings = get_db().get_current_settings(chat_id)
+    settings = await get_async_db().get_current_settings(chat_id)
     if settings is not None and settings.ai_agent:
         # If AI Agent is enabled, we just pass the message to the AI handler
         return await handle_generic_message_with_ai(update, context)
 
     replying_to_msg_id = update.message.reply_to_message.message_id if update.message.reply_to_message else -1
-    tx_id = get_db().get_tx_associated_with(replying_to_msg_id, chat_id)
+    tx_id = await get_async_db().get_tx_associated_with(replying_to_msg_id, chat_id)
 
     if tx_id is None:
         logger.error("No transaction ID found in bot data", exc_info=True)
@@ -554,23 +627,22 @@ async def handle_message_reply(update: Update, context: ContextTypes.DEFAULT_TYP
             message_are_tags = False
             break
 
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
     if message_are_tags:
         tags_without_hashtag = [tag[1:] for tag in msg_text.split(" ") if tag.startswith("#")]
         logger.info(f"Setting tags to transaction ({tx_id}): {tags_without_hashtag}")
-        lunch.update_transaction(tx_id, TransactionUpdateObject(tags=tags_without_hashtag))  # type: ignore
+        await lunch.update_transaction(tx_id, TransactionUpdateObject(tags=tags_without_hashtag))  # type: ignore
     else:
         notes = msg_text
         if len(notes) > NOTES_MAX_LENGTH:
             notes = notes[:NOTES_MAX_LENGTH]
         logger.info(f"Setting notes to transaction ({tx_id}): {notes}")
-        lunch.update_transaction(tx_id, TransactionUpdateObject(notes=notes))  # type: ignore
+        await lunch.update_transaction(tx_id, TransactionUpdateObject(notes=notes))  # type: ignore
 
     # update the transaction message to show the new notes
-    updated_tx = lunch.get_transaction(tx_id)
-    await send_transaction_message(context, transaction=updated_tx, chat_id=chat_id, message_id=replying_to_msg_id)
+    await render_updated_transaction(context, chat_id, tx_id, replying_to_msg_id)
 
-    settings = get_db().get_current_settings(chat_id)
+    settings = await get_async_db().get_current_settings(chat_id)
     if settings.auto_categorize_after_notes and not message_are_tags:
         await ai_categorize_transaction(tx_id, chat_id, context)
 
@@ -583,69 +655,181 @@ async def handle_btn_ai_categorize(update: Update, context: ContextTypes.DEFAULT
     tx_id = int(update.callback_data_suffix)
 
     chat_id = update.chat_id
-    response = auto_categorize(tx_id, chat_id)
+    response = await auto_categorize(tx_id, chat_id)
     if update.callback_query:
         await update.callback_query.answer(text=response, show_alert=True)
 
-    # update the transaction message to show the new notes
-    lunch = get_lunch_client_for_chat_id(chat_id)
-    updated_tx = lunch.get_transaction(tx_id)
-    await send_transaction_message(context, transaction=updated_tx, chat_id=chat_id, message_id=update.message_id)
-
-
-async def poll_transactions_on_schedule(context: ContextTypes.DEFAULT_TYPE):
-    """
-    Gets called every minute to poll transactions for all registered chats.
-    However, each chat can have its own polling settings, so we use this
-    function to check the settings for each chat and decide whether to poll.
-    """
-    chat_ids = get_db().get_all_registered_chats()
-    if len(chat_ids) is None:
-        logger.warning("No chats registered yet")
-
-    for chat_id in chat_ids:
-        settings = get_db().get_current_settings(chat_id)
-        if not settings:
-            # technically this should never happen, but just in case
-            logger.error(f"No settings found for chat {chat_id}!")
-            continue
-
-        if settings.token == "revoked":
-            logger.debug(f"Skipping chat {chat_id} because API token was revoked.")
-            continue
+    # update the transaction message to show the new category
+    await render_updated_transaction(context, chat_id, tx_id, update.message_id)
 
-        # this is the last time we polled, saved as a string using:
-        # datetime.now().isoformat()
-        last_poll_at = settings.last_poll_at
-        should_poll = False
-        if last_poll_at is None:
-            logger.info(f"First poll for chat {chat_id}")
-            last_poll_at = datetime.now() - timedelta(days=1)
-            should_poll = True
-        else:
-            poll_interval_seconds = settings.poll_interval_secs
-            next_poll_at = last_poll_at + timedelta(seconds=poll_interval_seconds)
-            should_poll = datetime.now() >= next_poll_at
 
-        if should_poll:
+async def poll_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, poll_pending: bool) -> None:
+    """Polls a single chat, bounded by poll_semaphore and POLL_TIMEOUT_SECS."""
+    polls_in_flight.add(chat_id)
+    try:
+        async with poll_semaphore:
             try:
-                await check_transactions_and_telegram_them(context, chat_id=chat_id, poll_pending=settings.poll_pending)
+                async with asyncio.timeout(POLL_TIMEOUT_SECS):
+                    await check_transactions_and_telegram_them(context, chat_id=chat_id, poll_pending=poll_pending)
+            except TimeoutError:
+                logger.warning(f"Polling chat {chat_id} timed out after {POLL_TIMEOUT_SECS} seconds")
+                await get_async_db().inc_metric("poll_timeouts")
             except Exception as e:
                 # check if the error message is lunchable.exceptions.LunchMoneyHTTPError
                 # and the message is: Access token does not exist, which means the user
                 # has revoked the access to the app.
                 # If that is the case, we should set the API token to 'revoked'.
                 if "Access token does not exist" in str(e):
-                    get_db().set_api_token(chat_id, "revoked")
+                    await get_async_db().set_api_token(chat_id, "revoked")
                     logger.exception(
                         f"User in chat {chat_id} has revoked access to the app. Setting API token to None."
                     )
-            get_db().update_last_poll_at(chat_id, datetime.now().isoformat())
+                else:
+                    logger.exception(f"Failed to poll transactions for chat {chat_id}")
+    except Exception:
+        # the chats are polled in a TaskGroup, where an error would cancel the polls of the other chats
+        logger.exception(f"Failed to handle the poll failure of chat {chat_id}")
+    finally:
+        polls_in_flight.discard(chat_id)
+        try:
+            # this also puts the chat back in the poll scheduler
+            await get_async_db().update_last_poll_at(chat_id, datetime.now().isoformat())
+        except Exception:
+            logger.exception(f"Failed to record the poll of chat {chat_id}, retrying in {POLL_RETRY_SECS} seconds")
+            get_db().poll_scheduler.schedule(chat_id, datetime.now() + timedelta(seconds=POLL_RETRY_SECS))
+
+
+def schedule_next_poll(job_queue: JobQueue | None) -> None:
+    """(Re)schedules the poll job to run when the next chat is due."""
+    if job_queue is None:
+        return
+
+    next_due_at = get_db().poll_scheduler.next_due_at()
+    if next_due_at is None:
+        delay = POLL_MAX_SLEEP_SECS
+    else:
+        delay = (next_due_at - datetime.now()).total_seconds()
+        delay = min(max(delay, POLL_MIN_SLEEP_SECS), POLL_MAX_SLEEP_SECS)
+
+    for job in job_queue.get_jobs_by_name(POLL_JOB_NAME):
+        job.schedule_removal()
+
+    # misfire_grace_time=None makes sure the job still runs if the event loop was busy,
+    # otherwise the chain of scheduled polls would stop
+    job_queue.run_once(
+        poll_transactions_on_schedule, when=delay, name=POLL_JOB_NAME, job_kwargs={"misfire_grace_time": None}
+    )
+    logger.debug(f"Next poll scheduled in {delay:.0f} seconds")
+
+
+def start_poll_scheduler(job_queue: JobQueue) -> None:
+    """Starts polling and wakes the poll job up whenever a chat becomes due earlier than expected."""
+    loop = asyncio.get_running_loop()
+    get_db().poll_scheduler.on_earlier_due = lambda _: loop.call_soon_threadsafe(schedule_next_poll, job_queue)
+    job_queue.run_once(
+        poll_transactions_on_schedule, when=5, name=POLL_JOB_NAME, job_kwargs={"misfire_grace_time": None}
+    )
+    if poll_shards.enabled:
+        job_queue.run_repeating(
+            renew_poll_shards, interval=POLL_SHARD_LEASE_SECS / 4, first=0, name=POLL_SHARDS_JOB_NAME
+        )
+
+
+async def renew_poll_shards(_: ContextTypes.DEFAULT_TYPE) -> None:
+    """Renews the shard leases of this worker, and catches up with what other workers wrote to the DB.
+
+    Other workers record their polls, registrations and settings changes (e.g. a new or revoked
+    token) in the DB, so the settings this worker derived state from are reconciled with it, and
+    the poll schedule of the chats it owns is reloaded from it.
+    """
+    try:
+        await poll_shards.renew()
+        all_settings = await get_async_db().get_all_settings()
+    except Exception:
+        logger.exception("Failed to renew the poll shard leases")
+        return
+
+    db = get_db()
+    outdated = db.reconcile_settings(all_settings)
+    if outdated:
+        logger.info(f"Reloaded the settings of {len(outdated)} chats changed by other workers")
+
+    scheduler = db.poll_scheduler
+    for settings in all_settings:
+        chat_id = settings.chat_id
+        if chat_id in polls_in_flight or settings.token == "revoked":
+            continue
+        due_at = get_next_poll_at(settings.last_poll_at, settings.poll_interval_secs)
+        if not poll_shards.owns(chat_id):
+            scheduler.unschedule(chat_id)
+        elif scheduler.due_at(chat_id) != due_at:
+            scheduler.schedule(chat_id, due_at)
+
+
+async def poll_transactions_on_schedule(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Polls the chats that are due according to the poll scheduler, which tracks the next
+    poll time of every chat based on its last_poll_at and poll_interval_secs settings.
+
+    Due chats are polled concurrently, at most POLL_MAX_CONCURRENCY at a time, and the
+    job reschedules itself to run again when the next chat is due.
+    """
+    tick_start = time.monotonic()
+    scheduler = get_db().poll_scheduler
+    due_chat_ids = scheduler.pop_due(datetime.now())
+    # popped chats only go back in the scheduler once polled, so the ones that don't get to
+    # poll_chat because the tick failed are put back here, otherwise they would never be polled again
+    not_polled = set(due_chat_ids)
+    try:
+        # schedule the next tick before polling, so that slow chats don't delay the rest
+        schedule_next_poll(context.job_queue)
+
+        due_chats: dict[int, bool] = {}
+        for chat_id in due_chat_ids:
+            if chat_id in polls_in_flight:
+                logger.info(f"Chat {chat_id} is due but its previous poll is still in flight, retrying later")
+                continue
+
+            if not poll_shards.owns(chat_id):
+                # another worker polls it, this one picks it up again if it gets its shard
+                logger.debug(f"Chat {chat_id} is due but belongs to a shard this worker does not hold")
+                not_polled.discard(chat_id)
+                continue
+
+            try:
+                settings = await get_async_db().get_current_settings(chat_id)
+            except NoLunchTokenError:
+                # technically this should never happen, but just in case
+                logger.exception(f"No settings found for chat {chat_id}!")
+                not_polled.discard(chat_id)
+                continue
+            except Exception:
+                logger.exception(f"Failed to load the settings of chat {chat_id}, retrying later")
+                continue
+
+            due_chats[chat_id] = settings.poll_pending
+
+        if not due_chats:
+            return
+
+        async with asyncio.TaskGroup() as tg:
+            for chat_id, poll_pending in due_chats.items():
+                tg.create_task(poll_chat(context, chat_id, poll_pending))
+                not_polled.discard(chat_id)
+    finally:
+        retry_at = datetime.now() + timedelta(seconds=POLL_RETRY_SECS)
+        for chat_id in not_polled:
+            scheduler.schedule(chat_id, retry_at)
+
+    tick_secs = time.monotonic() - tick_start
+    logger.info(f"Polled {len(due_chats)} of {len(scheduler)} scheduled chats in {tick_secs:.2f} seconds")
+    await get_async_db().inc_metric("poll_ticks")
+    await get_async_db().inc_metric("poll_tick_seconds", tick_secs)
 
 
 async def handle_expand_tx_options(update: Update, _: ContextTypes.DEFAULT_TYPE):
     tx_id = int(update.callback_data_suffix)
-    await update.safe_edit_message_reply_markup(reply_markup=get_tx_buttons(update.chat_id, tx_id, collapsed=False))
+    await edit_transaction_buttons(update, await get_tx_buttons(update.chat_id, tx_id, collapsed=False))
 
 
 async def handle_rename_payee(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1,25 +1,418 @@
-from lunchable import LunchMoney
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import cached_property
+from typing import TYPE_CHECKING, Any
+
+import httpx
+from lunchable import LunchMoney, TransactionInsertObject, TransactionUpdateObject
+from lunchable import __version__ as lunchable_version
+from lunchable.models import (
+    AssetsObject,
+    BudgetObject,
+    CategoriesObject,
+    CryptoObject,
+    PlaidAccountObject,
+    TagsObject,
+    TransactionObject,
+    UserObject,
+)
 
 from errors import NoLunchTokenError
 from persistence import get_db
 
-lunch_clients_cache: dict[int, LunchMoney] = {}
+if TYPE_CHECKING:
+    from persistence import Settings
 
+logger = logging.getLogger("lunch")
 
-def get_lunch_client(token: str) -> LunchMoney:
-    return LunchMoney(access_token=token)
+# how long categories, assets and plaid accounts are reused before being fetched again
+REFERENCE_DATA_TTL_SECS = float(os.getenv("REFERENCE_DATA_TTL_SECS", "600"))
 
+# lunchable is a blocking HTTP client, so calls made from async handlers run in this bounded
+# thread pool instead of freezing the event loop (and every other chat) during the round trip
+LUNCH_MAX_WORKERS = int(os.getenv("LUNCH_MAX_WORKERS", "16"))
 
-def get_lunch_client_for_chat_id(chat_id: int) -> LunchMoney:
-    if chat_id in lunch_clients_cache:
-        return lunch_clients_cache[chat_id]
+# how many per-chat clients are kept, and how long an unused one is kept around
+LUNCH_CLIENTS_MAX = int(os.getenv("LUNCH_CLIENTS_MAX", "256"))
+LUNCH_CLIENT_IDLE_SECS = float(os.getenv("LUNCH_CLIENT_IDLE_SECS", "3600"))
 
-    token = get_db().get_token(chat_id)
+
+class _CountedStream(httpx.SyncByteStream):
+    """Response body that tells its transport when it is closed, i.e. when its connection is free."""
+
+    def __init__(self, stream: httpx.SyncByteStream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close: Callable[[], None] | None = on_close
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+                self._on_close = None
+
+
+class LunchTransport(httpx.HTTPTransport):
+    """HTTP transport that counts the connections being used by a request."""
+
+    def __init__(self, max_connections: int):
+        super().__init__(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        self.max_connections = max_connections
+        self._in_use = 0
+        self._in_use_lock = threading.Lock()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        with self._in_use_lock:
+            self._in_use += 1
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            self._release()
+            raise
+        response.stream = _CountedStream(response.stream, self._release)
+        return response
+
+    def _release(self) -> None:
+        with self._in_use_lock:
+            self._in_use -= 1
+
+
+# every client sends its requests through this transport, so they all share one pool of
+# keep-alive connections to the Lunch Money API (and one TLS context) instead of one each
+lunch_transport = LunchTransport(max_connections=LUNCH_MAX_WORKERS)
+
+
+def apply_transaction_update(
+    transaction: TransactionObject, update: TransactionUpdateObject, categories: list[CategoriesObject]
+) -> TransactionObject:
+    """Returns a copy of the transaction with the update applied the way Lunch Money applies it.
+
+    This is a best-effort local version of the updated transaction, good enough to render it
+    right away. Derived fields it does not know about (e.g. account names) are left as they were.
+    """
+    changes = update.model_dump(exclude_unset=True, exclude={"tags"}, mode="json")
+
+    if update.category_id is not None:
+        categories_by_id = {category.id: category for category in categories}
+        category = categories_by_id.get(update.category_id)
+        group = categories_by_id.get(category.group_id) if category and category.group_id else None
+        changes["category_name"] = category.name if category else None
+        changes["category_group_id"] = group.id if group else None
+        changes["category_group_name"] = group.name if group else None
+
+    if update.tags is not None:
+        current_tags = transaction.tags or []
+        tags = []
+        for tag in update.tags:
+            known = next((t for t in current_tags if tag in {t.id, t.name}), None)
+            if known is not None:
+                tags.append(known)
+            elif isinstance(tag, str):
+                # new tags get their id once the transaction is fetched again
+                tags.append(TagsObject(id=0, name=tag))
+        changes["tags"] = [tag.model_dump() for tag in tags]
+
+    return TransactionObject.model_validate({**transaction.model_dump(), **changes})
+
+
+class CachingLunchMoney(LunchMoney):
+    """LunchMoney client that keeps the reference data of its account in memory.
+
+    Categories, assets and plaid accounts rarely change but are needed on almost every
+    interaction (category keyboards, AI categorization, the manual transaction form), so they
+    are reused for REFERENCE_DATA_TTL_SECS. Writes made through this client that affect them
+    drop the cached copy, and views that must show live balances pass fresh=True.
+    """
+
+    def __init__(self, access_token: str, chat_id: int | None = None):
+        super().__init__(access_token=access_token)
+        # the chat this client belongs to, if any, whose transaction mirror must follow its writes
+        self.chat_id = chat_id
+        self._reference_data: dict[str, tuple[float, list[Any]]] = {}
+        self._reference_data_lock = threading.Lock()
+
+    @cached_property
+    def session(self) -> httpx.Client:
+        # same settings and headers as lunchable's own client, except for the shared transport. Clients
+        # are never closed, since that would close the transport for all of them
+        return httpx.Client(
+            transport=lunch_transport,
+            timeout=httpx.Timeout(connect=5, read=30, write=20, pool=5),
+            headers={
+                "Authorization": f"Bearer {self.access_token}",
+                "User-Agent": f"lunchable/{lunchable_version}",
+                "Content-Type": "application/json",
+            },
+        )
+
+    def peek_reference_data(self, name: str) -> list[Any] | None:
+        """Returns a copy of the cached reference data, or None if it is missing or expired."""
+        with self._reference_data_lock:
+            entry = self._reference_data.get(name)
+        if entry is None or time.monotonic() - entry[0] > REFERENCE_DATA_TTL_SECS:
+            get_db().inc_metric("reference_cache_misses")
+            return None
+        get_db().inc_metric("reference_cache_hits")
+        return list(entry[1])
+
+    def invalidate_reference_data(self, *names: str) -> None:
+        """Drops the given reference data (or all of it if no names are given)."""
+        with self._reference_data_lock:
+            if not names:
+                self._reference_data.clear()
+            for name in names:
+                self._reference_data.pop(name, None)
+
+    def _get_reference_data[T](self, name: str, fetch: Callable[[], list[T]], fresh: bool) -> list[T]:
+        if not fresh:
+            cached = self.peek_reference_data(name)
+            if cached is not None:
+                return cached
+        data = fetch()
+        with self._reference_data_lock:
+            self._reference_data[name] = (time.monotonic(), data)
+        return list(data)
+
+    def get_categories(self, format=None, *, fresh: bool = False) -> list[CategoriesObject]:
+        if format is not None:
+            return super().get_categories(format)
+        return self._get_reference_data("categories", super().get_categories, fresh)
+
+    def get_assets(self, *, fresh: bool = False) -> list[AssetsObject]:
+        return self._get_reference_data("assets", super().get_assets, fresh)
+
+    def get_plaid_accounts(self, *, fresh: bool = False) -> list[PlaidAccountObject]:
+        return self._get_reference_data("plaid_accounts", super().get_plaid_accounts, fresh)
+
+    def update_transaction(
+        self, transaction_id: int, transaction: TransactionUpdateObject | None = None, *args: Any, **kwargs: Any
+    ) -> dict[str, Any]:
+        try:
+            response = super().update_transaction(transaction_id, transaction, *args, **kwargs)
+        except Exception:
+            if self.chat_id is not None:
+                get_db().mark_mirrored_transaction_stale(self.chat_id, transaction_id)
+            raise
+
+        if self.chat_id is not None:
+            payload = None
+            if isinstance(transaction, TransactionUpdateObject):
+                payload = self._locally_updated_payload(self.chat_id, transaction_id, transaction)
+            get_db().mark_mirrored_transaction_stale(self.chat_id, transaction_id, payload)
+        return response
+
+    def _locally_updated_payload(
+        self, chat_id: int, transaction_id: int, update: TransactionUpdateObject
+    ) -> str | None:
+        """Applies the update to the mirrored copy of the transaction, so it can be rendered without a fetch."""
+        row = get_db().get_mirrored_transaction(chat_id, transaction_id)
+        if row is None:
+            return None
+        try:
+            current = TransactionObject.model_validate_json(row.payload)
+            return apply_transaction_update(current, update, self.get_categories()).model_dump_json()
+        except Exception:
+            logger.exception(f"Could not apply update locally to transaction {transaction_id}")
+            return None
+
+    def insert_transactions(self, *args: Any, **kwargs: Any) -> list[int]:
+        try:
+            return super().insert_transactions(*args, **kwargs)
+        finally:
+            # manually-managed balances may have moved
+            self.invalidate_reference_data("assets")
+            # the new transactions can be on any date, so the whole mirror has to be fetched again
+            if self.chat_id is not None:
+                get_db().reset_transaction_mirror(self.chat_id)
+
+    def trigger_fetch_from_plaid(self, *args: Any, **kwargs: Any) -> bool:
+        try:
+            return super().trigger_fetch_from_plaid(*args, **kwargs)
+        finally:
+            self.invalidate_reference_data("plaid_accounts")
+
+
+class LunchClientPool:
+    """Per-chat clients, bounded by size (least recently used go first) and by idle time.
+
+    Clients hold the token and the cached reference data of their chat. They are dropped as
+    soon as the settings of the chat change to a different token (or are deleted), via a
+    Persistence settings listener, so a revoked or replaced token is never used again.
+    """
+
+    def __init__(self, max_size: int, idle_secs: float):
+        self.max_size = max_size
+        self.idle_secs = idle_secs
+        # chat_id -> (when it was last used, the client), least recently used first
+        self._clients: OrderedDict[int, tuple[float, CachingLunchMoney]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        # whether on_settings_changed is registered, which happens once, with the first client
+        self._listening = False
+
+    def get(self, chat_id: int) -> CachingLunchMoney | None:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(chat_id)
+            if entry is None:
+                return None
+            self._clients[chat_id] = (now, entry[1])
+            self._clients.move_to_end(chat_id)
+            return entry[1]
+
+    def put(self, chat_id: int, client: CachingLunchMoney) -> None:
+        with self._lock:
+            if not self._listening:
+                get_db().add_settings_listener(self.on_settings_changed)
+                self._listening = True
+            self._clients[chat_id] = (time.monotonic(), client)
+            self._clients.move_to_end(chat_id)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._clients.pop(chat_id, None)
+
+    def on_settings_changed(self, chat_id: int, settings: "Settings | None") -> None:
+        client = self.peek(chat_id)
+        if client is not None and (settings is None or settings.token != client.access_token):
+            logger.info(f"Dropping the Lunch Money client of chat {chat_id}, its token changed")
+            self.invalidate(chat_id)
+
+    def peek(self, chat_id: int) -> CachingLunchMoney | None:
+        """Returns the client without counting it as a use."""
+        with self._lock:
+            entry = self._clients.get(chat_id)
+        return entry[1] if entry else None
+
+    def _evict_idle(self, now: float) -> None:
+        # entries are ordered by last use, so the idle ones are all at the front
+        while self._clients:
+            last_used, _ = next(iter(self._clients.values()))
+            if now - last_used <= self.idle_secs:
+                break
+            self._clients.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+
+lunch_clients_cache = LunchClientPool(LUNCH_CLIENTS_MAX, LUNCH_CLIENT_IDLE_SECS)
+
+lunch_executor = ThreadPoolExecutor(max_workers=LUNCH_MAX_WORKERS, thread_name_prefix="lunch")
+
+
+class AsyncLunchMoney:
+    """Async facade over a LunchMoney client. Every call runs in lunch_executor."""
+
+    def __init__(self, client: CachingLunchMoney):
+        self.client = client
+
+    async def _run[T](self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(lunch_executor, functools.partial(fn, *args, **kwargs))
+
+    async def get_transactions(self, **kwargs: Any) -> list[TransactionObject]:
+        return await self._run(self.client.get_transactions, **kwargs)
+
+    async def get_transaction(self, transaction_id: int) -> TransactionObject:
+        return await self._run(self.client.get_transaction, transaction_id)
+
+    async def update_transaction(self, transaction_id: int, transaction: TransactionUpdateObject) -> dict[str, Any]:
+        return await self._run(self.client.update_transaction, transaction_id, transaction)
+
+    async def insert_transactions(self, transactions: TransactionInsertObject) -> list[int]:
+        return await self._run(self.client.insert_transactions, transactions)
+
+    async def get_categories(self, *, fresh: bool = False) -> list[CategoriesObject]:
+        # cache hits are served right away, without a trip through the thread pool
+        cached = None if fresh else self.client.peek_reference_data("categories")
+        if cached is not None:
+            return cached
+        return await self._run(self.client.get_categories, fresh=True)
+
+    async def get_category(self, category_id: int) -> CategoriesObject:
+        return await self._run(self.client.get_category, category_id)
+
+    async def get_budgets(self, start_date: date | datetime, end_date: date | datetime) -> list[BudgetObject]:
+        return await self._run(self.client.get_budgets, start_date=start_date, end_date=end_date)
+
+    async def get_assets(self, *, fresh: bool = False) -> list[AssetsObject]:
+        cached = None if fresh else self.client.peek_reference_data("assets")
+        if cached is not None:
+            return cached
+        return await self._run(self.client.get_assets, fresh=True)
+
+    async def get_plaid_accounts(self, *, fresh: bool = False) -> list[PlaidAccountObject]:
+        cached = None if fresh else self.client.peek_reference_data("plaid_accounts")
+        if cached is not None:
+            return cached
+        return await self._run(self.client.get_plaid_accounts, fresh=True)
+
+    async def get_crypto(self) -> list[CryptoObject]:
+        return await self._run(self.client.get_crypto)
+
+    async def get_user(self) -> UserObject:
+        return await self._run(self.client.get_user)
+
+    async def trigger_fetch_from_plaid(self) -> bool:
+        return await self._run(self.client.trigger_fetch_from_plaid)
+
+
+def get_lunch_client(token: str) -> CachingLunchMoney:
+    return CachingLunchMoney(access_token=token)
+
+
+def get_lunch_client_for_chat_id(chat_id: int) -> CachingLunchMoney:
+    client = lunch_clients_cache.get(chat_id)
+    if client is not None:
+        return client
+
+    db = get_db()
+    token = db.get_token(chat_id)
     if token is None:
         raise NoLunchTokenError("No token registered")
 
-    lunch_clients_cache[chat_id] = get_lunch_client(token)
-    return lunch_clients_cache[chat_id]
+    client = CachingLunchMoney(access_token=token, chat_id=chat_id)
+    lunch_clients_cache.put(chat_id, client)
+    return client
+
+
+def get_async_lunch_client(token: str) -> AsyncLunchMoney:
+    return AsyncLunchMoney(get_lunch_client(token))
+
+
+def get_async_lunch_client_for_chat_id(chat_id: int) -> AsyncLunchMoney:
+    return AsyncLunchMoney(get_lunch_client_for_chat_id(chat_id))
+
+
+def invalidate_reference_data_for_chat_id(chat_id: int) -> None:
+    client = lunch_clients_cache.peek(chat_id)
+    if client is not None:
+        client.invalidate_reference_data()
 
 
 def get_lunch_money_token_for_chat_id(chat_id: int) -> str:
@@ -1,14 +1,19 @@
 import asyncio
 import logging
 import os
+import secrets
 import signal
 
 from dotenv import load_dotenv
 from telegram.error import Conflict, TelegramError
 from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, filters
 
+from async_persistence import get_async_db
+from background_jobs import BACKGROUND_JOBS_RESUME_SECS, get_background_jobs
+from deepinfra_client import get_deepinfra_client
 from handlers.amz import (
     handle_amazon_sync,
+    handle_cancel_amazon_sync,
     handle_preview_process_amazon_transactions,
     handle_process_amazon_transactions,
     handle_update_amz_settings,
@@ -23,8 +28,11 @@ from handlers.budget import (
     handle_done_budget,
     handle_show_budget,
 )
+from handlers.categorization import handle_ai_categorize_all
+from handlers.expectations import get_expectation_store
 from handlers.general import (
     clear_cache,
+    handle_btn_cancel_job,
     handle_cancel,
     handle_errors,
     handle_file_upload,
@@ -83,13 +91,19 @@ from handlers.transactions import (
     handle_message_reply,
     handle_rename_payee,
     handle_set_tags,
-    poll_transactions_on_schedule,
+    start_poll_scheduler,
 )
-from lunch import get_lunch_client_for_chat_id
 from manual_tx import handle_manual_tx, handle_web_app_data
 from telegram_extensions import Update
+from transaction_mirror import get_transaction_mirror
 from tx_messaging import send_transaction_message
-from web_server import run_web_server, set_bot_instance, update_bot_status
+from web_server import (
+    TELEGRAM_WEBHOOK_PATH,
+    enable_telegram_webhook,
+    run_web_server,
+    set_bot_instance,
+    update_bot_status,
+)
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(name)s] %(levelname%s: %(message)s")
 logger = logging.getLogger("lonchera")
@@ -100,6 +114,11 @@ logging.getLogger("httpcore.connection").setLevel(logging.WARNING)
 logging.getLogger("telegram.ext.ExtBot").setLevel(logging.WARNING)
 logging.getLogger("telegram.ext.Updater").setLevel(logging.WARNING)
 
+# how often buffered metric increments (see Persistence.inc_metric) are written to the analytics table
+METRICS_FLUSH_SECS = int(os.getenv("METRICS_FLUSH_SECS", "30"))
+# how often expectations nobody replied to are deleted
+EXPECTATIONS_PURGE_SECS = 3600
+
 
 def add_command_handlers(app):
     app.add_handler(CommandHandler("start", handle_start))
@@ -111,6 +130,7 @@ def add_command_handlers(app):
     app.add_handler(CommandHandler("stats", handle_stats))
     app.add_handler(CommandHandler("status", handle_status))
     app.add_handler(CommandHandler("amazon_sync", handle_amazon_sync))
+    app.add_handler(CommandHandler("ai_categorize", handle_ai_categorize_all))
     app.add_handler(CommandHandler("resync", handle_resync))
     app.add_handler(CommandHandler("balances", handle_show_balances))
 
@@ -199,6 +219,10 @@ def add_application_callback_query_handlers(app):
         )
     )
     app.add_handler(CallbackQueryHandler(handle_process_amazon_transactions, pattern=r"^process_amazon_transactions$"))
+    app.add_handler(CallbackQueryHandler(handle_cancel_amazon_sync, pattern=r"^cancelAmazonSync$"))
+
+    # Background job handlers
+    app.add_handler(CallbackQueryHandler(handle_btn_cancel_job, pattern=r"^cancelJob_"))
 
     # Generic cancel handler for any leftover cancel buttons
     app.add_handler(CallbackQueryHandler(handle_cancel, pattern=r"^cancel$"))
@@ -217,6 +241,20 @@ def add_callback_query_handlers(app):
     add_application_callback_query_handlers(app)
 
 
+async def flush_metrics(_: ContextTypes.DEFAULT_TYPE) -> None:
+    await get_async_db().flush_metrics()
+
+
+async def resume_background_jobs(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await get_background_jobs().resume(context)
+
+
+async def purge_expired_expectations(_: ContextTypes.DEFAULT_TYPE) -> None:
+    purged = await asyncio.to_thread(get_expectation_store().purge_expired)
+    if purged:
+        logger.info(f"Purged {purged} expired expectations")
+
+
 def setup_handlers(config):
     app = Application.builder().token(config["TELEGRAM_BOT_TOKEN"]).build()
 
@@ -226,7 +264,10 @@ def setup_handlers(config):
     app.add_error_handler(handle_errors)  # type: ignore
 
     if app.job_queue:
-        app.job_queue.run_repeating(poll_transactions_on_schedule, interval=60, first=5)
+        start_poll_scheduler(app.job_queue)
+        app.job_queue.run_repeating(flush_metrics, interval=METRICS_FLUSH_SECS, first=METRICS_FLUSH_SECS)
+        app.job_queue.run_repeating(purge_expired_expectations, interval=EXPECTATIONS_PURGE_SECS, first=0)
+        app.job_queue.run_repeating(resume_background_jobs, interval=BACKGROUND_JOBS_RESUME_SECS, first=0)
 
     app.add_handler(MessageHandler(filters.TEXT & filters.REPLY, handle_message_reply))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.REPLY, handle_generic_message))
@@ -244,6 +285,9 @@ def load_config():
 
     return {
         "TELEGRAM_BOT_TOKEN": os.getenv("TELEGRAM_BOT_TOKEN"),
+        # public base URL of the web server. When set, Telegram posts updates to it instead of being polled
+        "WEBHOOK_URL": os.getenv("WEBHOOK_URL"),
+        "WEBHOOK_SECRET_TOKEN": os.getenv("WEBHOOK_SECRET_TOKEN"),
         "PROMPT_FOR_NOTES": os.getenv("PROMPT_FOR_NOTES", "true").lower() == "true",
         "PROMPT_FOR_CATEGORIES": os.getenv("PROMPT_FOR_CATEGORIES", "true").lower() == "true",
     }
@@ -252,10 +296,9 @@ def load_config():
 async def handle_refresh_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the refresh button for a transaction."""
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
 
     transaction_id = int(update.callback_data_suffix)
-    transaction = lunch.get_transaction(transaction_id)
+    transaction = await get_transaction_mirror().refresh_transaction_async(chat_id, transaction_id)
 
     # Re-render the transaction message (edit the current message)
     await send_transaction_message(
@@ -266,6 +309,19 @@ async def handle_refresh_transaction(update: Update, context: ContextTypes.DEFAU
     await update.callback_query.answer("Transaction refreshed!")
 
 
+async def start_webhook(app: Application, webhook_url: str, secret_token: str | None):
+    """Makes Telegram post updates to the web server, instead of waiting for them to be polled."""
+    if not secret_token:
+        logger.warning("No WEBHOOK_SECRET_TOKEN provided, generating one. Instances will not share it.")
+        secret_token = secrets.token_urlsafe(32)
+
+    enable_telegram_webhook(app, secret_token)
+    await app.bot.set_webhook(
+        url=webhook_url.rstrip("/") + TELEGRAM_WEBHOOK_PATH, secret_token=secret_token, allowed_updates=Update.ALL_TYPES
+    )
+    logger.info(f"Receiving updates through the webhook at {webhook_url}")
+
+
 async def main():
     config = load_config()
 
@@ -306,24 +362,35 @@ async def main():
         logger.warning(f"Exception happened while polling for updates: {exc}", exc_info=exc)
         update_bot_status(True, error_msg)
 
+    webhook_url = config["WEBHOOK_URL"]
     async with app:
         await app.initialize()
         await app.start()
+        # LLM calls made from worker threads (e.g. background jobs) run on this loop, sharing its client
+        get_deepinfra_client().bind()
         update_bot_status(True)  # Mark as running when started
-        if app.updater:
+        if not webhook_url and app.updater:
             await app.updater.start_polling(allowed_updates=Update.ALL_TYPES, error_callback=error_callback)
 
         # Start the web server
         runner = await run_web_server()
 
+        if webhook_url:
+            # registered once the web server is up, so the first updates have somewhere to go
+            await start_webhook(app, webhook_url, config["WEBHOOK_SECRET_TOKEN"])
+
         try:
             await stop_signal.wait()
         finally:
             update_bot_status(False)  # Mark as stopped during cleanup
+            await get_background_jobs().stop()
             await runner.cleanup()
-            if app.updater:
+            if app.updater and app.updater.running:
                 await app.updater.stop()
             await app.stop()
+            await get_deepinfra_client().close()
+            await get_async_db().flush_metrics()
+            await get_async_db().dispose()
 
 
 if __name__ == "__main__":
@@ -9,10 +9,10 @@ from telegram import KeyboardButton, ReplyKeyboardMarkup, WebAppInfo
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
-from lunch import get_lunch_client_for_chat_id
+from lunch import get_async_lunch_client_for_chat_id
 from persistence import get_db
 from telegram_extensions import Update
-from tx_messaging import send_transaction_message
+from tx_messaging import send_new_transaction_message
 
 logger = logging.getLogger("manual_tx")
 
@@ -36,17 +36,17 @@ async def do_save_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE
     if tx_data["is_received"]:
         tx_data["amount"] = tx_data["amount"] * -1
 
-    lunch = get_lunch_client_for_chat_id(update.chat_id)
+    lunch = get_async_lunch_client_for_chat_id(update.chat_id)
 
     # get currency for this type of account
-    assets = lunch.get_assets()
+    assets = await lunch.get_assets()
     account = next((asset for asset in assets if asset.id == int(tx_data["account_id"])), None)
     if account:
         tx_data["currency"] = account.currency
 
     logger.info(f"Transaction data: {tx_data}")
 
-    tx_ids = lunch.insert_transactions(
+    tx_ids = await lunch.insert_transactions(
         TransactionInsertObject(
             date=datetime.datetime.strptime(tx_data["date"], "%Y-%m-%d"),
             category_id=tx_data["category_id"],
@@ -61,11 +61,13 @@ async def do_save_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # poll the transaction we just created
     [transaction_id] = tx_ids
-    transaction = lunch.get_transaction(transaction_id)
+    transaction = await lunch.get_transaction(transaction_id)
 
     logger.info(f"Transaction saved: {transaction}")
 
-    msg_id = await send_transaction_message(context, transaction=transaction, chat_id=update.chat_id)
+    msg_id, msg_render_hash = await send_new_transaction_message(
+        context, transaction=transaction, chat_id=update.chat_id
+    )
     get_db().mark_as_sent(
         transaction.id,
         update.chat_id,
@@ -73,15 +75,16 @@ async def do_save_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE
         transaction.recurring_type,
         reviewed=True,
         plaid_id=None,  # this is a manual transaction
+        render_hash=msg_render_hash,
     )
 
 
 async def handle_manual_tx(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.chat_id
-    lunch = get_lunch_client_for_chat_id(chat_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
 
     # Check for manually managed accounts
-    assets = lunch.get_assets()
+    assets = await lunch.get_assets()
     manual_accounts = [asset for asset in assets if asset.type_name in {"credit", "cash"}]
 
     if not manual_accounts:
@@ -0,0 +1,41 @@
+import threading
+from datetime import datetime
+
+
+def metric_day(date: datetime | None = None) -> datetime:
+    """Analytics are stored per day, keyed by the midnight that starts it."""
+    return (date or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class MetricsBuffer:
+    """Accumulates metric increments in memory, coalesced per (key, day), until they are flushed."""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._values: dict[tuple[str, datetime], float] = {}
+        # number of increments added since the last drain, which is what triggers an early flush
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def add(self, key: str, increment: float, day: datetime) -> bool:
+        """Adds the increment and returns True when the buffer is due for a flush."""
+        with self._lock:
+            self._values[key, day] = self._values.get((key, day), 0.0) + increment
+            self._pending += 1
+            return self._pending >= self.max_pending
+
+    def drain(self) -> dict[tuple[str, datetime], float]:
+        with self._lock:
+            values = self._values
+            self._values = {}
+            self._pending = 0
+            return values
+
+    def restore(self, values: dict[tuple[str, datetime], float]) -> None:
+        """Puts back values that were drained but could not be written."""
+        with self._lock:
+            for key_day, value in values.items():
+                self._values[key_day] = self._values.get(key_day, 0.0) + value
+
+    def __len__(self) -> int:
+        return len(self._values)
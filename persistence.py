@@ -1,12 +1,41 @@
 import logging
 import os
-from datetime import datetime, timedelta
-
-from sqlalchemy import Boolean, DateTime, Float, Integer, String, and_, create_engine, delete, func, update
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING
+
+from sqlalchemy import (
+    Boolean,
+    Date,
+    DateTime,
+    Float,
+    Index,
+    Integer,
+    String,
+    Text,
+    and_,
+    create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    literal,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Mapped, mapped_column, sessionmaker
 
 from errors import NoLunchTokenError
+from metrics_buffer import MetricsBuffer, metric_day
+from poll_scheduler import PollScheduler, get_next_poll_at
+from settings_cache import SettingsCache, SettingsSnapshot
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
 
 logger = logging.getLogger("db")
 
@@ -15,6 +44,13 @@ Base = declarative_base()
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        Index("ix_transactions_tx_id", "tx_id"),
+        Index("ix_transactions_chat_id_tx_id", "chat_id", "tx_id"),
+        Index("ix_transactions_chat_id_message_id", "chat_id", "message_id"),
+        Index("ix_transactions_chat_id_created_at", "chat_id", "created_at"),
+        Index("ix_transactions_plaid_id", "plaid_id"),
+    )
 
     # The unique identifier for the transaction in the database
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -40,6 +76,9 @@ class Transaction(Base):
     # The Plaid transaction ID associated with this transaction, if available
     plaid_id: Mapped[str | None] = mapped_column(String, default=None, nullable=True)
 
+    # Hash of the text and buttons last rendered in the message, to skip edits that change nothing
+    render_hash: Mapped[str | None] = mapped_column(String, default=None, nullable=True)
+
 
 class Settings(Base):
     __tablename__ = "settings"
@@ -95,6 +134,7 @@ class Settings(Base):
 
 class Analytics(Base):
     __tablename__ = "analytics"
+    __table_args__ = (Index("ux_analytics_key_date", "key", "date", unique=True),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     key: Mapped[str] = mapped_column(String, nullable=False)
@@ -102,11 +142,394 @@ class Analytics(Base):
     value: Mapped[float] = mapped_column(Float, default=0.0, nullable=False)
 
 
+class MirroredTransaction(Base):
+    __tablename__ = "mirrored_transactions"
+    __table_args__ = (Index("ix_mirrored_transactions_chat_id_date", "chat_id", "date"),)
+
+    # The unique identifier for the Telegram chat the transaction belongs to
+    chat_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    # The Lunch Money transaction ID
+    tx_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    # The date of the transaction, used to select the ranges that are mirrored
+    date: Mapped[date] = mapped_column(Date, nullable=False)
+
+    # Whether the transaction was still pending when it was mirrored
+    is_pending: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+
+    # The TransactionObject as returned by Lunch Money, serialized as JSON
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+
+    # Set when the bot modified the transaction, so it gets fetched again on the next read
+    stale: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+
+    # The timestamp when the transaction was last fetched from Lunch Money
+    synced_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), nullable=False)
+
+
+class TransactionSyncState(Base):
+    __tablename__ = "transaction_sync_state"
+
+    # The unique identifier for the Telegram chat
+    chat_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    # The (inclusive) range of dates for which every transaction is mirrored
+    covered_from: Mapped[date] = mapped_column(Date, nullable=False)
+    covered_to: Mapped[date] = mapped_column(Date, nullable=False)
+
+    # When the covered range was first established. It is discarded after a while, since
+    # transactions outside of the refreshed window can still be edited in Lunch Money
+    covered_since: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    # The timestamp of the last refresh of the trailing window
+    refreshed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class Expectation(Base):
+    __tablename__ = "expectations"
+
+    # The chat that is expected to send a reply
+    chat_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    # What the reply is expected to be, and the context needed to handle it, as JSON
+    payload: Mapped[str] = mapped_column(String, nullable=False)
+
+    # When the expectation is dropped if no reply came
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+
+
+class PollShardLease(Base):
+    __tablename__ = "poll_shard_leases"
+
+    # The shard, which holds the chats whose chat_id % POLL_SHARD_COUNT equals it
+    shard: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    # The worker that polls the chats of the shard
+    owner: Mapped[str] = mapped_column(String, nullable=False)
+
+    # When the lease ends, unless the owner renews it before. Other workers can claim it after
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class PollWorker(Base):
+    __tablename__ = "poll_workers"
+
+    # The worker, i.e. one of the bot replicas sharing the DB
+    worker_id: Mapped[str] = mapped_column(String, primary_key=True)
+
+    # Until when the worker is considered alive. It is extended every time it renews its leases
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class BackgroundJob(Base):
+    __tablename__ = "background_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    chat_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+
+    # What the job does, as registered in the BackgroundJobRunner
+    kind: Mapped[str] = mapped_column(String, nullable=False)
+
+    # One of queued, running, done, failed or cancelled
+    status: Mapped[str] = mapped_column(String, nullable=False, index=True)
+
+    # The parameters of the job and the items it goes through, as JSON
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+
+    # How many items are done, and the counters of what happened with them (as JSON). Saved
+    # after every item, so a job picks up where it was left after a restart
+    cursor: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    total: Mapped[int] = mapped_column(Integer, nullable=False)
+    progress: Mapped[str] = mapped_column(Text, nullable=False, default="{}")
+
+    # The message that shows the status of the job
+    message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+    # The worker running the job, and when it last saved progress. Other workers only take
+    # over a running job once it has not been heard of for a while
+    owner: Mapped[str | None] = mapped_column(String, nullable=True)
+    heartbeat_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    # Set when the user presses Cancel, which could be handled by any of the workers
+    cancel_requested: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), nullable=False)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+
+# statuses of the jobs that are not finished yet
+BACKGROUND_JOB_ACTIVE_STATUSES = ("queued", "running")
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    # The version of the migration, as listed in MIGRATIONS
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    # A short description of what the migration does
+    name: Mapped[str] = mapped_column(String, nullable=False)
+
+    # The timestamp when the migration was applied
+    applied_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), nullable=False)
+
+
+# create_all only creates missing tables, it never alters existing ones. So any change to an
+# existing table (new columns, indexes, etc.) must also be listed here so it gets applied to
+# databases created before it. Migrations run in order, once, and are recorded in schema_migrations.
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (
+        1,
+        "add transactions lookup indexes",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_transactions_tx_id ON transactions (tx_id)",
+            "CREATE INDEX IF NOT EXISTS ix_transactions_chat_id_tx_id ON transactions (chat_id, tx_id)",
+            "CREATE INDEX IF NOT EXISTS ix_transactions_chat_id_message_id ON transactions (chat_id, message_id)",
+            "CREATE INDEX IF NOT EXISTS ix_transactions_chat_id_created_at ON transactions (chat_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS ix_transactions_plaid_id ON transactions (plaid_id)",
+        ],
+    ),
+    (
+        2,
+        "make analytics unique per key and day",
+        [
+            # fold any duplicated (key, date) rows into the oldest one before adding the constraint
+            """
+            UPDATE analytics SET value = (
+                SELECT SUM(dup.value) FROM analytics dup WHERE dup.key = analytics.key AND dup.date = analytics.date
+            )
+            WHERE id IN (SELECT MIN(id) FROM analytics GROUP BY key, date HAVING COUNT(*) > 1)
+            """,
+            "DELETE FROM analytics WHERE id NOT IN (SELECT MIN(id) FROM analytics GROUP BY key, date)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_analytics_key_date ON analytics (key, date)",
+        ],
+    ),
+    (3, "add transactions render hash", ["ALTER TABLE transactions ADD COLUMN render_hash VARCHAR"]),
+]
+
+# buffered metric increments are flushed early once this many accumulate between timed flushes
+METRICS_MAX_PENDING = int(os.getenv("METRICS_MAX_PENDING", "500"))
+
+
+def metrics_upsert(values: dict[tuple[str, datetime], float]):
+    """Builds a single statement that adds all the given values to their (key, day) rows."""
+    stmt = sqlite_insert(Analytics).values(
+        [{"key": key, "date": day, "value": value} for (key, day), value in values.items()]
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[Analytics.key, Analytics.date], set_={"value": Analytics.value + stmt.excluded.value}
+    )
+
+
+def poll_worker_heartbeat(worker_id: str, expires_at: datetime):
+    stmt = sqlite_insert(PollWorker).values(worker_id=worker_id, expires_at=expires_at)
+    return stmt.on_conflict_do_update(index_elements=[PollWorker.worker_id], set_={"expires_at": expires_at})
+
+
+def poll_shards_claim(worker_id: str, shards: list[int], expires_at: datetime, now: datetime):
+    """Builds a statement that leases the shards to the worker, unless another worker holds a live lease."""
+    stmt = sqlite_insert(PollShardLease).values(
+        [{"shard": shard, "owner": worker_id, "expires_at": expires_at} for shard in shards]
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[PollShardLease.shard],
+        set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at},
+        where=(PollShardLease.owner == worker_id) | (PollShardLease.expires_at <= now),
+    )
+
+
+@dataclass(frozen=True)
+class StorageProfile:
+    """SQLite tuning applied to every connection the engine opens.
+
+    The defaults favor a single bot process with many concurrent readers (poller, button
+    handlers, web server): WAL lets readers run while a write is in progress, and
+    synchronous=NORMAL only fsyncs at checkpoints instead of on every commit.
+    """
+
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    # bytes of the database file to memory-map (0 disables it)
+    mmap_size: int = 256 * 1024 * 1024
+    # page cache size, in KiB
+    cache_size_kb: int = 64 * 1024
+    # how long a connection waits for a lock before failing with "database is locked"
+    busy_timeout_ms: int = 5000
+    pool_size: int = 5
+    pool_max_overflow: int = 10
+    pool_timeout_secs: float = 30
+
+    @classmethod
+    def from_env(cls) -> "StorageProfile":
+        return cls(
+            journal_mode=os.getenv("DB_JOURNAL_MODE", cls.journal_mode).upper(),
+            synchronous=os.getenv("DB_SYNCHRONOUS", cls.synchronous).upper(),
+            mmap_size=int(os.getenv("DB_MMAP_SIZE", str(cls.mmap_size))),
+            cache_size_kb=int(os.getenv("DB_CACHE_SIZE_KB", str(cls.cache_size_kb))),
+            busy_timeout_ms=int(os.getenv("DB_BUSY_TIMEOUT_MS", str(cls.busy_timeout_ms))),
+            pool_size=int(os.getenv("DB_POOL_SIZE", str(cls.pool_size))),
+            pool_max_overflow=int(os.getenv("DB_POOL_MAX_OVERFLOW", str(cls.pool_max_overflow))),
+            pool_timeout_secs=float(os.getenv("DB_POOL_TIMEOUT_SECS", str(cls.pool_timeout_secs))),
+        )
+
+    def apply(self, dbapi_connection) -> None:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+            cursor.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+            cursor.execute(f"PRAGMA synchronous = {self.synchronous}")
+            cursor.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+            # a negative cache_size is interpreted by SQLite as KiB instead of pages
+            cursor.execute(f"PRAGMA cache_size = -{self.cache_size_kb}")
+            cursor.execute("PRAGMA temp_store = MEMORY")
+        finally:
+            cursor.close()
+
+
 class Persistence:
-    def __init__(self, db_path: str):
-        self.engine = create_engine(f"sqlite:///{db_path}")
+    def __init__(self, db_path: str, storage_profile: StorageProfile | None = None):
+        self.storage_profile = storage_profile or StorageProfile.from_env()
+        self.engine = create_engine(
+            f"sqlite:///{db_path}",
+            pool_size=self.storage_profile.pool_size,
+            max_overflow=self.storage_profile.pool_max_overflow,
+            pool_timeout=self.storage_profile.pool_timeout_secs,
+        )
+        event.listen(self.engine, "connect", lambda dbapi_connection, _: self.storage_profile.apply(dbapi_connection))
+        logger.info(f"Using database {db_path} with {self.storage_profile}")
+        # a brand new database is created with the latest schema, so it needs no migrations
+        fresh_db = not inspect(self.engine).has_table(Settings.__tablename__)
         Base.metadata.create_all(self.engine)
+        self.run_migrations(fresh_db)
         self.Session = sessionmaker(bind=self.engine)
+        self.poll_scheduler = PollScheduler()
+        self.settings_cache = SettingsCache()
+        self.metrics = MetricsBuffer(METRICS_MAX_PENDING)
+        # called by settings_changed, for state kept outside of this module (e.g. the lunch clients)
+        self.settings_listeners: list[Callable[[int, Settings | None], None]] = []
+        self._load_poll_schedule()
+
+    def run_migrations(self, fresh_db: bool = False) -> None:
+        with self.engine.connect() as conn:
+            applied = set(conn.execute(select(SchemaMigration.version)).scalars())
+
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+
+            with self.engine.begin() as conn:
+                if fresh_db:
+                    logger.debug(f"Marking migration {version} ({name}) as applied on new database")
+                else:
+                    logger.info(f"Applying migration {version}: {name}")
+                    for statement in statements:
+                        conn.execute(text(statement))
+                conn.execute(insert(SchemaMigration).values(version=version, name=name, applied_at=datetime.now()))
+
+    def _load_poll_schedule(self) -> None:
+        schedule = self.get_poll_schedule()
+        for chat_id, due_at in schedule:
+            self.poll_scheduler.schedule(chat_id, due_at)
+        logger.info(f"Loaded poll schedule for {len(schedule)} chats")
+
+    def get_poll_schedule(self) -> list[tuple[int, datetime]]:
+        """Returns when each chat with a valid token is due for polling, according to the DB."""
+        with self.Session() as session:
+            rows = (
+                session.query(Settings.chat_id, Settings.last_poll_at, Settings.poll_interval_secs)
+                .filter(Settings.token != "revoked")
+                .all()
+            )
+        return [
+            (chat_id, get_next_poll_at(last_poll_at, poll_interval_secs))
+            for chat_id, last_poll_at, poll_interval_secs in rows
+        ]
+
+    def heartbeat_poll_worker(self, worker_id: str, expires_at: datetime, now: datetime) -> list[str]:
+        """Records the worker as alive until expires_at, and returns the ids of all the live workers."""
+        with self.Session() as session:
+            session.execute(poll_worker_heartbeat(worker_id, expires_at))
+            session.commit()
+            stmt = select(PollWorker.worker_id).where(PollWorker.expires_at > now)
+            return list(session.execute(stmt).scalars())
+
+    def get_poll_shard_leases(self) -> list[PollShardLease]:
+        with self.Session() as session:
+            return session.query(PollShardLease).all()
+
+    def claim_poll_shards(self, worker_id: str, shards: list[int], expires_at: datetime, now: datetime) -> list[int]:
+        """Leases the shards to the worker until expires_at, and returns the ones it got."""
+        if not shards:
+            return []
+        with self.Session() as session:
+            session.execute(poll_shards_claim(worker_id, shards, expires_at, now))
+            session.commit()
+            stmt = select(PollShardLease.shard).where(
+                PollShardLease.owner == worker_id,
+                PollShardLease.expires_at == expires_at,
+                PollShardLease.shard.in_(shards),
+            )
+            return list(session.execute(stmt).scalars())
+
+    def settings_changed(self, chat_id: int, settings: Settings | None) -> None:
+        """Called after the settings of a chat are written, with the new row (None if it was deleted).
+
+        Both Persistence and AsyncPersistence call this, so state derived from the settings table
+        is kept up to date no matter which of them did the write.
+        """
+        self.settings_cache.set(chat_id, SettingsSnapshot.from_row(settings) if settings else None)
+
+        if settings is None or settings.token == "revoked":
+            self.poll_scheduler.unschedule(chat_id)
+        else:
+            self.poll_scheduler.schedule(chat_id, get_next_poll_at(settings.last_poll_at, settings.poll_interval_secs))
+
+        for listener in self.settings_listeners:
+            try:
+                listener(chat_id, settings)
+            except Exception:
+                logger.exception(f"Settings listener failed for chat {chat_id}")
+
+    def reconcile_settings(self, rows: list[Settings]) -> list[int]:
+        """Catches up with the settings written by other workers sharing the DB, given all the rows.
+
+        settings_changed only runs for writes made by this worker, so the settings cache, the
+        poll schedule and the settings listeners (e.g. the Lunch Money clients) would otherwise
+        keep what this worker last saw. Chats whose row differs from the cached one go through
+        settings_changed, and so do chats this worker knows of that have no row anymore (as
+        deleted). Returns the chats whose cached settings were outdated.
+        """
+        outdated = []
+        for settings in rows:
+            cached = self.settings_cache.peek(settings.chat_id)
+            if cached != SettingsSnapshot.from_row(settings):
+                if cached is not None:
+                    outdated.append(settings.chat_id)
+                self.settings_changed(settings.chat_id, settings)
+
+        known = self.settings_cache.chat_ids() | self.poll_scheduler.chat_ids()
+        for chat_id in known - {settings.chat_id for settings in rows}:
+            outdated.append(chat_id)
+            self.settings_changed(chat_id, None)
+        return outdated
+
+    def add_settings_listener(self, listener: "Callable[[int, Settings | None], None]") -> None:
+        if listener not in self.settings_listeners:
+            self.settings_listeners.append(listener)
+
+    def _notify_settings_changed(self, chat_id: int) -> None:
+        with self.Session() as session:
+            settings = session.query(Settings).filter_by(chat_id=chat_id).first()
+        self.settings_changed(chat_id, settings)
+
+    def _update_settings(self, chat_id: int, **values) -> None:
+        with self.Session() as session:
+            stmt = update(Settings).where(Settings.chat_id == chat_id).values(**values)
+            session.execute(stmt)
+            session.commit()
+        self._notify_settings_changed(chat_id)
 
     def save_token(self, chat_id: int, token: str):
         with self.Session() as session:
@@ -116,8 +539,12 @@ class Persistence:
                 new_setting = Settings(chat_id=chat_id, token=token)
                 session.add(new_setting)
             session.commit()
+        self._notify_settings_changed(chat_id)
 
     def get_token(self, chat_id) -> str | None:
+        cached = self.settings_cache.get(int(chat_id))
+        if cached is not None:
+            return cached.token
         with self.Session() as session:
             setting = session.query(Settings).filter_by(chat_id=chat_id).first()
             return setting.token if setting else None
@@ -136,8 +563,10 @@ class Persistence:
         chat_id: int,
         message_id: int,
         recurring_type: str | None,
+        *,
         reviewed=False,
         plaid_id: str | None = None,
+        render_hash: str | None = None,
     ) -> None:
         logger.info(f"Marking transaction {tx_id} as sent with message ID {message_id}")
         with self.Session() as session:
@@ -148,10 +577,32 @@ class Persistence:
                 recurring_type=recurring_type,
                 reviewed_at=datetime.now() if reviewed else None,
                 plaid_id=plaid_id,
+                render_hash=render_hash,
             )
             session.add(new_transaction)
             session.commit()
 
+    def get_sent_tx_ids(self, chat_id: int, tx_ids: list[int]) -> set[int]:
+        """Returns the subset of tx_ids that were already sent to the given chat."""
+        if not tx_ids:
+            return set()
+        with self.Session() as session:
+            rows = (
+                session.query(Transaction.tx_id)
+                .filter(Transaction.chat_id == chat_id, Transaction.tx_id.in_(set(tx_ids)))
+                .all()
+            )
+            return {row.tx_id for row in rows}
+
+    def mark_as_sent_many(self, transactions: list[Transaction]) -> None:
+        """Inserts all the given sent transactions in a single DB transaction."""
+        if not transactions:
+            return
+        logger.info(f"Marking {len(transactions)} transactions as sent")
+        with self.Session() as session:
+            session.add_all(transactions)
+            session.commit()
+
     def get_tx_associated_with(self, message_id: int, chat_id: int) -> int | None:
         with self.Session() as session:
             transaction = session.query(Transaction.tx_id).filter_by(message_id=message_id, chat_id=chat_id).first()
@@ -181,6 +632,83 @@ class Persistence:
             session.execute(stmt)
             session.commit()
             logger.info(f"Transactions deleted for chat {chat_id}")
+        self.reset_transaction_mirror(chat_id, delete_rows=True)
+
+    def get_transaction_sync_state(self, chat_id: int) -> TransactionSyncState | None:
+        with self.Session() as session:
+            return session.query(TransactionSyncState).filter_by(chat_id=chat_id).first()
+
+    def save_mirrored_transactions(
+        self,
+        chat_id: int,
+        replace_from: date,
+        replace_to: date,
+        rows: list[MirroredTransaction],
+        state: TransactionSyncState,
+    ) -> None:
+        """Replaces the mirrored transactions of the given date range and saves the new sync state, atomically."""
+        with self.Session() as session:
+            session.execute(
+                delete(MirroredTransaction).where(
+                    MirroredTransaction.chat_id == chat_id,
+                    MirroredTransaction.date >= replace_from,
+                    MirroredTransaction.date <= replace_to,
+                )
+            )
+            for row in rows:
+                # a transaction may come back with a date outside of the range if it moved
+                session.merge(row)
+            session.merge(state)
+            session.commit()
+
+    def get_mirrored_transactions(self, chat_id: int, start_date: date, end_date: date) -> list[MirroredTransaction]:
+        with self.Session() as session:
+            return (
+                session.query(MirroredTransaction)
+                .filter(
+                    MirroredTransaction.chat_id == chat_id,
+                    MirroredTransaction.date >= start_date,
+                    MirroredTransaction.date <= end_date,
+                )
+                .order_by(MirroredTransaction.date, MirroredTransaction.tx_id)
+                .all()
+            )
+
+    def get_mirrored_transaction(self, chat_id: int, tx_id: int) -> MirroredTransaction | None:
+        with self.Session() as session:
+            return session.query(MirroredTransaction).filter_by(chat_id=chat_id, tx_id=tx_id).first()
+
+    def mark_mirrored_transaction_stale(self, chat_id: int, tx_id: int, payload: str | None = None) -> None:
+        """Flags the transaction as changed by the bot. The payload, if given, is the locally updated version."""
+        values: dict = {"stale": True}
+        if payload is not None:
+            values["payload"] = payload
+        with self.Session() as session:
+            stmt = (
+                update(MirroredTransaction)
+                .where(MirroredTransaction.chat_id == chat_id, MirroredTransaction.tx_id == tx_id)
+                .values(**values)
+            )
+            session.execute(stmt)
+            session.commit()
+
+    def save_mirrored_transaction(self, row: MirroredTransaction) -> None:
+        with self.Session() as session:
+            session.merge(row)
+            session.commit()
+
+    def delete_mirrored_transaction(self, chat_id: int, tx_id: int) -> None:
+        with self.Session() as session:
+            session.query(MirroredTransaction).filter_by(chat_id=chat_id, tx_id=tx_id).delete()
+            session.commit()
+
+    def reset_transaction_mirror(self, chat_id: int, delete_rows: bool = False) -> None:
+        """Forgets what is mirrored for the chat, so the next read fetches it again from Lunch Money."""
+        with self.Session() as session:
+            session.query(TransactionSyncState).filter_by(chat_id=chat_id).delete()
+            if delete_rows:
+                session.query(MirroredTransaction).filter_by(chat_id=chat_id).delete()
+            session.commit()
 
     def mark_as_reviewed(self, message_id: int, chat_id: int):
         with self.Session() as session:
@@ -192,6 +720,193 @@ class Persistence:
             session.execute(stmt)
             session.commit()
 
+    def get_render_hash(self, chat_id: int, message_id: int) -> str | None:
+        with self.Session() as session:
+            stmt = select(Transaction.render_hash).where(
+                (Transaction.message_id == message_id) & (Transaction.chat_id == chat_id)
+            )
+            return session.execute(stmt).scalars().first()
+
+    def save_render_hashes(self, chat_id: int, render_hashes: dict[int, str | None]) -> None:
+        """Stores the hash of what was last rendered in each of the given messages (keyed by message_id)."""
+        if not render_hashes:
+            return
+        with self.Session() as session:
+            for message_id, render_hash in render_hashes.items():
+                stmt = (
+                    update(Transaction)
+                    .where((Transaction.message_id == message_id) & (Transaction.chat_id == chat_id))
+                    .values(render_hash=render_hash)
+                )
+                session.execute(stmt)
+            session.commit()
+
+    def get_expectation(self, chat_id: int) -> Expectation | None:
+        with self.Session() as session:
+            return session.get(Expectation, chat_id)
+
+    def save_expectation(self, chat_id: int, payload: str, expires_at: datetime) -> None:
+        with self.Session() as session:
+            session.merge(Expectation(chat_id=chat_id, payload=payload, expires_at=expires_at))
+            session.commit()
+
+    def delete_expectation(self, chat_id: int) -> None:
+        with self.Session() as session:
+            session.query(Expectation).filter_by(chat_id=chat_id).delete()
+            session.commit()
+
+    def delete_expired_expectations(self, now: datetime) -> int:
+        with self.Session() as session:
+            deleted = session.query(Expectation).filter(Expectation.expires_at <= now).delete()
+            session.commit()
+            return deleted
+
+    def create_background_job(
+        self, chat_id: int, kind: str, payload: str, total: int, message_id: int | None, *, max_active_per_chat: int
+    ) -> int | None:
+        """Queues a job, unless the chat already has max_active_per_chat unfinished jobs. Returns its id."""
+        active = (
+            select(func.count(BackgroundJob.id))
+            .where(BackgroundJob.chat_id == chat_id, BackgroundJob.status.in_(BACKGROUND_JOB_ACTIVE_STATUSES))
+            .scalar_subquery()
+        )
+        # the limit is checked by the INSERT itself, so two replicas (or two taps) can not both
+        # see room for one more job and go over it
+        values = {
+            "chat_id": chat_id,
+            "kind": kind,
+            "status": "queued",
+            "payload": payload,
+            "total": total,
+            "message_id": message_id,
+        }
+        stmt = (
+            insert(BackgroundJob)
+            .from_select(
+                list(values),
+                select(*(literal(value, BackgroundJob.__table__.c[name].type) for name, value in values.items())).where(
+                    active < max_active_per_chat
+                ),
+            )
+            .returning(BackgroundJob.id)
+        )
+        with self.Session() as session:
+            job_id = session.execute(stmt).scalar()
+            session.commit()
+            return job_id
+
+    def get_background_job(self, job_id: int) -> BackgroundJob | None:
+        with self.Session() as session:
+            return session.get(BackgroundJob, job_id)
+
+    def get_resumable_background_jobs(self, worker_id: str, stale_before: datetime) -> list[int]:
+        """Returns the ids of the unfinished jobs the worker can run: queued ones, its own, and abandoned ones."""
+        with self.Session() as session:
+            stmt = (
+                select(BackgroundJob.id)
+                .where(
+                    BackgroundJob.status.in_(BACKGROUND_JOB_ACTIVE_STATUSES),
+                    BackgroundJob.owner.is_(None)
+                    | (BackgroundJob.owner == worker_id)
+                    | (BackgroundJob.heartbeat_at <= stale_before),
+                )
+                .order_by(BackgroundJob.id)
+            )
+            return list(session.execute(stmt).scalars())
+
+    def claim_background_job(self, job_id: int, worker_id: str, now: datetime, stale_before: datetime) -> bool:
+        """Makes the worker the one running the job, unless another (live) worker already is."""
+        with self.Session() as session:
+            stmt = (
+                update(BackgroundJob)
+                .where(
+                    BackgroundJob.id == job_id,
+                    BackgroundJob.status.in_(BACKGROUND_JOB_ACTIVE_STATUSES),
+                    BackgroundJob.owner.is_(None)
+                    | (BackgroundJob.owner == worker_id)
+                    | (BackgroundJob.heartbeat_at <= stale_before),
+                )
+                .values(status="running", owner=worker_id, heartbeat_at=now)
+            )
+            claimed = session.execute(stmt).rowcount == 1
+            session.commit()
+            return claimed
+
+    def save_background_job_progress(
+        self, job_id: int, worker_id: str, cursor: int, progress: str, now: datetime
+    ) -> bool:
+        """Saves how far the job got. Returns False if it should stop: it was cancelled or taken over."""
+        with self.Session() as session:
+            stmt = (
+                update(BackgroundJob)
+                .where(BackgroundJob.id == job_id, BackgroundJob.owner == worker_id)
+                .values(cursor=cursor, progress=progress, heartbeat_at=now)
+            )
+            owned = session.execute(stmt).rowcount == 1
+            session.commit()
+            if not owned:
+                return False
+            return not session.execute(
+                select(BackgroundJob.cancel_requested).where(BackgroundJob.id == job_id)
+            ).scalar_one()
+
+    def finish_background_job(self, job_id: int, worker_id: str, status: str, error: str | None = None) -> None:
+        with self.Session() as session:
+            stmt = (
+                update(BackgroundJob)
+                .where(BackgroundJob.id == job_id, BackgroundJob.owner == worker_id)
+                .values(status=status, error=error, finished_at=datetime.now())
+            )
+            session.execute(stmt)
+            session.commit()
+
+    def release_background_job(self, job_id: int, worker_id: str) -> None:
+        """Puts a job the worker was running back in the queue, e.g. when the bot is shutting down."""
+        with self.Session() as session:
+            stmt = (
+                update(BackgroundJob)
+                .where(
+                    BackgroundJob.id == job_id,
+                    BackgroundJob.owner == worker_id,
+                    BackgroundJob.status.in_(BACKGROUND_JOB_ACTIVE_STATUSES),
+                )
+                .values(status="queued", owner=None, heartbeat_at=None)
+            )
+            session.execute(stmt)
+            session.commit()
+
+    def request_background_job_cancel(self, job_id: int, chat_id: int) -> bool:
+        """Flags an unfinished job of the chat to be cancelled. Returns False if there was no such job.
+
+        Jobs nobody has started yet are cancelled right away, the rest are stopped by their worker.
+        """
+        with self.Session() as session:
+            stmt = (
+                update(BackgroundJob)
+                .where(
+                    BackgroundJob.id == job_id,
+                    BackgroundJob.chat_id == chat_id,
+                    BackgroundJob.status == "queued",
+                    BackgroundJob.owner.is_(None),
+                )
+                .values(status="cancelled", cancel_requested=True, finished_at=datetime.now())
+            )
+            if session.execute(stmt).rowcount == 1:
+                session.commit()
+                return True
+            stmt = (
+                update(BackgroundJob)
+                .where(
+                    BackgroundJob.id == job_id,
+                    BackgroundJob.chat_id == chat_id,
+                    BackgroundJob.status.in_(BACKGROUND_JOB_ACTIVE_STATUSES),
+                )
+                .values(cancel_requested=True)
+            )
+            requested = session.execute(stmt).rowcount == 1
+            session.commit()
+            return requested
+
     def mark_as_reviewed_by_tx_id(self, tx_id: int, chat_id: int):
         with self.Session() as session:
             stmt = (
@@ -212,123 +927,98 @@ class Persistence:
             session.execute(stmt)
             session.commit()
 
-    def get_current_settings(self, chat_id: str | int) -> Settings:
+    def get_current_settings(self, chat_id: str | int) -> SettingsSnapshot:
+        chat_id = int(chat_id)
+        cached = self.settings_cache.get(chat_id)
+        if cached is not None:
+            return cached
+
+        generation = self.settings_cache.generation(chat_id)
         with self.Session() as session:
             settings = session.query(Settings).filter_by(chat_id=chat_id).first()
             if settings is None:
                 raise NoLunchTokenError("No settings found")
-            return settings
+            return self.settings_cache.fill(chat_id, SettingsSnapshot.from_row(settings), generation)
 
     def update_poll_interval(self, chat_id: int, interval: int) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(poll_interval_secs=interval)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, poll_interval_secs=interval)
 
     def update_last_poll_at(self, chat_id: int, timestamp: str) -> None:
-        with self.Session() as session:
-            stmt = (
-                update(Settings)
-                .where(Settings.chat_id == chat_id)
-                .values(last_poll_at=datetime.fromisoformat(timestamp))
-            )
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, last_poll_at=datetime.fromisoformat(timestamp))
 
     def logout(self, chat_id: int) -> None:
         with self.Session() as session:
             session.query(Settings).filter_by(chat_id=chat_id).delete()
             session.query(Transaction).filter_by(chat_id=chat_id).delete()
+            session.query(MirroredTransaction).filter_by(chat_id=chat_id).delete()
+            session.query(TransactionSyncState).filter_by(chat_id=chat_id).delete()
             session.commit()
+        self.settings_changed(chat_id, None)
 
     def update_auto_mark_reviewed(self, chat_id: int, auto_mark_reviewed: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(auto_mark_reviewed=auto_mark_reviewed)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, auto_mark_reviewed=auto_mark_reviewed)
 
     def update_poll_pending(self, chat_id: int, poll_pending: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(poll_pending=poll_pending)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, poll_pending=poll_pending)
 
     def update_show_datetime(self, chat_id: int, show_datetime: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(show_datetime=show_datetime)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, show_datetime=show_datetime)
 
     def update_tagging(self, chat_id: int, tagging: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(tagging=tagging)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, tagging=tagging)
 
     def update_mark_reviewed_after_categorized(self, chat_id: int, value: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(mark_reviewed_after_categorized=value)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, mark_reviewed_after_categorized=value)
 
     def update_timezone(self, chat_id: int, timezone: str) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(timezone=timezone)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, timezone=timezone)
 
     def update_auto_categorize_after_notes(self, chat_id: int, value: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(auto_categorize_after_notes=value)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, auto_categorize_after_notes=value)
 
     def update_ai_agent(self, chat_id: int, ai_agent: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(ai_agent=ai_agent)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, ai_agent=ai_agent)
 
     def update_show_transcription(self, chat_id: int, show_transcription: bool) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(show_transcription=show_transcription)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, show_transcription=show_transcription)
 
     def update_ai_response_language(self, chat_id: int, language: str | None) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(ai_response_language=language)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, ai_response_language=language)
 
     def update_ai_model(self, chat_id: int, model: str | None) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(ai_model=model)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, ai_model=model)
 
     def set_api_token(self, chat_id: int, token: str | None) -> None:
-        with self.Session() as session:
-            stmt = update(Settings).where(Settings.chat_id == chat_id).values(token=token)
-            session.execute(stmt)
-            session.commit()
+        self._update_settings(chat_id, token=token)
 
     def inc_metric(self, key: str, increment: float = 1.0, date: datetime | None = None):
-        if date is None:
-            date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        else:
-            date = date.replace(hour=0, minute=0, second=0, microsecond=0)
-
-        with self.Session() as session:
-            metric = session.query(Analytics).filter_by(key=key, date=date).first()
-            if metric:
-                metric.value = metric.value + increment
-            else:
-                metric = Analytics(key=key, date=date, value=increment)
-                session.add(metric)
-            session.commit()
+        """Buffers the increment in memory. It reaches the DB on the next flush_metrics."""
+        if self.metrics.add(key, increment, metric_day(date)):
+            self.flush_metrics()
+
+    def drain_pending_metrics(self) -> dict[tuple[str, datetime], float]:
+        hits, misses = self.settings_cache.pop_stats()
+        today = metric_day()
+        if hits:
+            self.metrics.add("settings_cache_hits", hits, today)
+        if misses:
+            self.metrics.add("settings_cache_misses", misses, today)
+        return self.metrics.drain()
+
+    def flush_metrics(self) -> None:
+        values = self.drain_pending_metrics()
+        if not values:
+            return
+        try:
+            with self.Session() as session:
+                session.execute(metrics_upsert(values))
+                session.commit()
+        except Exception:
+            logger.exception(f"Failed to flush {len(values)} metrics, will retry on the next flush")
+            self.metrics.restore(values)
 
     def get_metric(self, key: str, start_date: datetime, end_date: datetime) -> float:
+        self.flush_metrics()
         with self.Session() as session:
             result = (
                 session.query(func.sum(Analytics.value))
@@ -344,6 +1034,7 @@ class Persistence:
             return result or 0.0
 
     def get_all_metrics(self, start_date: datetime, end_date: datetime) -> dict:
+        self.flush_metrics()
         with self.Session() as session:
             results = (
                 session.query(Analytics.key, Analytics.date, Analytics.value)
@@ -364,6 +1055,7 @@ class Persistence:
             return metrics
 
     def get_specific_metrics(self, key: str, start_date: datetime, end_date: datetime) -> dict:
+        self.flush_metrics()
         with self.Session() as session:
             results = (
                 session.query(Analytics.key, Analytics.date, Analytics.value)
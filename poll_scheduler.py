@@ -0,0 +1,79 @@
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+logger = logging.getLogger("poll_scheduler")
+
+
+def get_next_poll_at(last_poll_at: datetime | None, poll_interval_secs: int) -> datetime:
+    # chats that were never polled are due right away
+    if last_poll_at is None:
+        return datetime.now()
+    return last_poll_at + timedelta(seconds=poll_interval_secs)
+
+
+class PollScheduler:
+    """Keeps a min-heap of the next time each chat is due for polling.
+
+    Rescheduling a chat does not remove its previous heap entry. Instead, `due_at` holds the
+    current due time of every scheduled chat, and entries that no longer match it are
+    discarded when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int]] = []
+        self._due_at: dict[int, datetime] = {}
+        self._lock = threading.Lock()
+        # called with the new due time whenever a chat becomes due earlier than any other
+        self.on_earlier_due: Callable[[datetime], None] | None = None
+
+    def schedule(self, chat_id: int, due_at: datetime) -> None:
+        with self._lock:
+            next_due = self._peek()
+            self._due_at[chat_id] = due_at
+            heapq.heappush(self._heap, (due_at, chat_id))
+
+        logger.debug(f"Chat {chat_id} scheduled to be polled at {due_at}")
+        if self.on_earlier_due and (next_due is None or due_at < next_due):
+            self.on_earlier_due(due_at)
+
+    def unschedule(self, chat_id: int) -> None:
+        with self._lock:
+            self._due_at.pop(chat_id, None)
+
+    def pop_due(self, now: datetime) -> list[int]:
+        """Removes and returns all the chats whose due time is before now."""
+        due_chats = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, chat_id = heapq.heappop(self._heap)
+                if self._due_at.get(chat_id) == due_at:
+                    del self._due_at[chat_id]
+                    due_chats.append(chat_id)
+        return due_chats
+
+    def due_at(self, chat_id: int) -> datetime | None:
+        with self._lock:
+            return self._due_at.get(chat_id)
+
+    def chat_ids(self) -> set[int]:
+        with self._lock:
+            return set(self._due_at)
+
+    def next_due_at(self) -> datetime | None:
+        with self._lock:
+            return self._peek()
+
+    def _peek(self) -> datetime | None:
+        # drop stale entries so that the top of the heap is always a live one
+        while self._heap and self._due_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def __len__(self) -> int:
+        return len(self._due_at)
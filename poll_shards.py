@@ -0,0 +1,94 @@
+import logging
+import math
+import os
+import socket
+import zlib
+from datetime import datetime, timedelta
+
+from async_persistence import get_async_db
+from persistence import PollShardLease
+
+logger = logging.getLogger("poll_shards")
+
+# How many shards the chats are split into for polling. With more than one, each worker
+# (i.e. each bot replica sharing the DB) polls only the chats of the shards it holds a lease on
+POLL_SHARD_COUNT = int(os.getenv("POLL_SHARD_COUNT", "1"))
+
+# How long a shard lease lasts. Workers renew theirs every quarter of it, and the leases of a
+# worker that died are taken over by the rest once they expire
+POLL_SHARD_LEASE_SECS = float(os.getenv("POLL_SHARD_LEASE_SECS", "300"))
+
+# Identifies this worker in the leases, so it must be unique among the replicas
+WORKER_ID = os.getenv("WORKER_ID") or os.getenv("FLY_MACHINE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def shard_of(chat_id: int, shard_count: int) -> int:
+    return chat_id % shard_count
+
+
+def plan_shard_claims(
+    leases: list[PollShardLease], workers: list[str], worker_id: str, shard_count: int, now: datetime
+) -> list[int]:
+    """Returns the shards the worker should try to lease, given the current leases and live workers.
+
+    Each live worker gets an even share of the shards. A worker keeps the shards it already holds
+    up to its share, letting the rest expire, and fills its share with shards nobody holds, starting
+    at an offset derived from its id so that workers starting together do not all go for the same
+    ones. Shards held by others are never taken before their lease expires.
+    """
+    live = {lease.shard: lease.owner for lease in leases if lease.expires_at > now and lease.shard < shard_count}
+    share = math.ceil(shard_count / len({*workers, worker_id}))
+
+    offset = zlib.crc32(worker_id.encode()) % shard_count
+    ordered = [(offset + i) % shard_count for i in range(shard_count)]
+
+    owned = [shard for shard in ordered if live.get(shard) == worker_id][:share]
+    free = [shard for shard in ordered if shard not in live]
+    return sorted(owned + free[: share - len(owned)])
+
+
+class PollShards:
+    """Tracks the shards of chats this worker is allowed to poll.
+
+    A chat is only polled while the lease on its shard outlives a whole poll (min_remaining_secs),
+    so that a lease cannot expire, and be taken over by another worker, in the middle of one.
+    With a single shard sharding is disabled and every chat is owned.
+    """
+
+    def __init__(self, worker_id: str, shard_count: int, lease_secs: float, min_remaining_secs: float):
+        self.worker_id = worker_id
+        self.shard_count = max(shard_count, 1)
+        self.lease_secs = lease_secs
+        self.min_remaining = timedelta(seconds=min_remaining_secs)
+        # the shards this worker holds, and when their lease ends
+        self.leases: dict[int, datetime] = {}
+        if self.enabled and lease_secs <= min_remaining_secs:
+            logger.warning(
+                f"POLL_SHARD_LEASE_SECS ({lease_secs}) is not longer than a poll ({min_remaining_secs}), "
+                "so no chat will ever be polled"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.shard_count > 1
+
+    def owns(self, chat_id: int) -> bool:
+        if not self.enabled:
+            return True
+        expires_at = self.leases.get(shard_of(chat_id, self.shard_count))
+        return expires_at is not None and expires_at - self.min_remaining > datetime.now()
+
+    async def renew(self) -> None:
+        """Renews the leases this worker holds and claims its share of the free shards."""
+        db = get_async_db()
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=self.lease_secs)
+        workers = await db.heartbeat_poll_worker(self.worker_id, expires_at, now)
+        leases = await db.get_poll_shard_leases()
+        wanted = plan_shard_claims(leases, workers, self.worker_id, self.shard_count, now)
+        claimed = await db.claim_poll_shards(self.worker_id, wanted, expires_at, now)
+
+        previous = set(self.leases)
+        self.leases = dict.fromkeys(claimed, expires_at)
+        if set(claimed) != previous:
+            logger.info(f"Worker {self.worker_id} now polls shards {sorted(claimed)} of {self.shard_count}")
@@ -0,0 +1,116 @@
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from persistence import Settings
+
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """Immutable, session-less copy of a Settings row. See the Settings model for what each field means."""
+
+    chat_id: int
+    token: str
+    poll_interval_secs: int
+    created_at: datetime
+    last_poll_at: datetime | None
+    auto_mark_reviewed: bool
+    poll_pending: bool
+    show_datetime: bool
+    tagging: bool
+    mark_reviewed_after_categorized: bool
+    timezone: str
+    auto_categorize_after_notes: bool
+    ai_agent: bool
+    show_transcription: bool
+    ai_response_language: str | None
+    ai_model: str | None
+
+    @classmethod
+    def from_row(cls, settings: "Settings") -> "SettingsSnapshot":
+        return cls(
+            chat_id=settings.chat_id,
+            token=settings.token,
+            poll_interval_secs=settings.poll_interval_secs,
+            created_at=settings.created_at,
+            last_poll_at=settings.last_poll_at,
+            auto_mark_reviewed=settings.auto_mark_reviewed,
+            poll_pending=settings.poll_pending,
+            show_datetime=settings.show_datetime,
+            tagging=settings.tagging,
+            mark_reviewed_after_categorized=settings.mark_reviewed_after_categorized,
+            timezone=settings.timezone,
+            auto_categorize_after_notes=settings.auto_categorize_after_notes,
+            ai_agent=settings.ai_agent,
+            show_transcription=settings.show_transcription,
+            ai_response_language=settings.ai_response_language,
+            ai_model=settings.ai_model,
+        )
+
+
+class SettingsCache:
+    """Per-process cache of settings snapshots, keyed by chat_id.
+
+    Writes to the settings table go through `set` (or `invalidate`), which also bumps the
+    generation of the chat. A reader that missed the cache takes the generation before querying
+    the DB and passes it to `fill`, so a snapshot read before a concurrent write never
+    overwrites the newer one.
+    """
+
+    def __init__(self):
+        self._snapshots: dict[int, SettingsSnapshot] = {}
+        self._generations: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int) -> SettingsSnapshot | None:
+        with self._lock:
+            snapshot = self._snapshots.get(chat_id)
+            if snapshot is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return snapshot
+
+    def peek(self, chat_id: int) -> SettingsSnapshot | None:
+        """Like get, but without counting a hit or a miss."""
+        with self._lock:
+            return self._snapshots.get(chat_id)
+
+    def chat_ids(self) -> set[int]:
+        with self._lock:
+            return set(self._snapshots)
+
+    def generation(self, chat_id: int) -> int:
+        with self._lock:
+            return self._generations.get(chat_id, 0)
+
+    def fill(self, chat_id: int, snapshot: SettingsSnapshot, generation: int) -> SettingsSnapshot:
+        with self._lock:
+            if self._generations.get(chat_id, 0) == generation:
+                self._snapshots[chat_id] = snapshot
+        return snapshot
+
+    def set(self, chat_id: int, snapshot: SettingsSnapshot | None) -> None:
+        with self._lock:
+            self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+            if snapshot is None:
+                self._snapshots.pop(chat_id, None)
+            else:
+                self._snapshots[chat_id] = snapshot
+
+    def invalidate(self, chat_id: int) -> None:
+        self.set(chat_id, None)
+
+    def pop_stats(self) -> tuple[int, int]:
+        """Returns the (hits, misses) counted since the last call and resets them."""
+        with self._lock:
+            stats = (self.hits, self.misses)
+            self.hits = self.misses = 0
+            return stats
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
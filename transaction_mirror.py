@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+from lunchable.models import TransactionObject
+
+from lunch import get_lunch_client_for_chat_id, lunch_executor
+from persistence import MirroredTransaction, TransactionSyncState, get_db
+
+logger = logging.getLogger("transaction_mirror")
+
+# transactions in the last MIRROR_WINDOW_DAYS can still change (pending ones post, categories get
+# applied, etc.) so that window is fetched again whenever it is older than the reader allows
+MIRROR_WINDOW_DAYS = int(os.getenv("MIRROR_WINDOW_DAYS", "15"))
+# how old the trailing window can be for readers that do not ask for a specific freshness
+MIRROR_MAX_AGE_SECS = float(os.getenv("MIRROR_MAX_AGE_SECS", "300"))
+# older transactions are only fetched once, but are still fetched again after this long,
+# since they can be edited from the Lunch Money web app too
+MIRROR_SETTLED_MAX_AGE_SECS = float(os.getenv("MIRROR_SETTLED_MAX_AGE_SECS", "86400"))
+# page size used when fetching a date range from Lunch Money
+MIRROR_PAGE_SIZE = 500
+
+
+class TransactionMirror:
+    """Local, per-chat copy of the Lunch Money transactions, kept in the mirrored_transactions table.
+
+    For every chat it tracks a contiguous range of dates that is fully mirrored. Reads only hit
+    the API for the parts of the requested range that are not covered yet, plus the trailing
+    window when it is stale. Each chat is synced under its own lock, so concurrent readers
+    (the poller, /resync, the AI tools) share a single fetch.
+    """
+
+    def __init__(self):
+        self._locks: dict[int, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock_for(self, chat_id: int) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(chat_id, threading.Lock())
+
+    def get_transactions(
+        self, chat_id: int, start_date: date, end_date: date, max_age_secs: float = MIRROR_MAX_AGE_SECS
+    ) -> list[TransactionObject]:
+        """Returns the transactions (posted and pending) between start_date and end_date, inclusive.
+
+        max_age_secs is how stale the trailing window can be. The poller passes 0 to always
+        see the latest state.
+        """
+        with self._lock_for(chat_id):
+            self._sync(chat_id, start_date, end_date, max_age_secs)
+            rows = get_db().get_mirrored_transactions(chat_id, start_date, end_date)
+            return [tx for row in rows if (tx := self._load(row)) is not None]
+
+    async def get_transactions_async(
+        self, chat_id: int, start_date: date, end_date: date, max_age_secs: float = MIRROR_MAX_AGE_SECS
+    ) -> list[TransactionObject]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            lunch_executor, functools.partial(self.get_transactions, chat_id, start_date, end_date, max_age_secs)
+        )
+
+    def peek_transaction(self, chat_id: int, transaction_id: int) -> TransactionObject | None:
+        """Returns the mirrored transaction without going to Lunch Money, or None if it is not mirrored.
+
+        Right after the bot updates a transaction this is the locally updated version, which
+        refresh_transaction later reconciles with the one in Lunch Money.
+        """
+        row = get_db().get_mirrored_transaction(chat_id, transaction_id)
+        if row is None:
+            return None
+        return TransactionObject.model_validate_json(row.payload)
+
+    def refresh_transaction(self, chat_id: int, transaction_id: int) -> TransactionObject:
+        """Fetches the transaction from Lunch Money and stores it in the mirror."""
+        tx = get_lunch_client_for_chat_id(chat_id).get_transaction(transaction_id)
+        get_db().inc_metric("transaction_mirror_fetches")
+        get_db().save_mirrored_transaction(self._to_row(chat_id, tx, datetime.now()))
+        return tx
+
+    async def refresh_transaction_async(self, chat_id: int, transaction_id: int) -> TransactionObject:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            lunch_executor, functools.partial(self.refresh_transaction, chat_id, transaction_id)
+        )
+
+    def _sync(self, chat_id: int, start_date: date, end_date: date, max_age_secs: float) -> None:
+        now = datetime.now()
+        today = now.date()
+        window_start = today - timedelta(days=MIRROR_WINDOW_DAYS)
+        state = get_db().get_transaction_sync_state(chat_id)
+
+        if state and (now - state.covered_since).total_seconds() > MIRROR_SETTLED_MAX_AGE_SECS:
+            logger.debug(f"Mirrored transactions for chat {chat_id} are too old, fetching them again")
+            state = None
+
+        if state is None:
+            fetch_from = min(start_date, window_start)
+            self._fetch_and_save(
+                chat_id,
+                fetch_from,
+                today,
+                TransactionSyncState(
+                    chat_id=chat_id, covered_from=fetch_from, covered_to=today, covered_since=now, refreshed_at=now
+                ),
+            )
+            return
+
+        if start_date < state.covered_from:
+            # backfill the older transactions right before the covered range
+            backfill_to = state.covered_from - timedelta(days=1)
+            state.covered_from = start_date
+            self._fetch_and_save(chat_id, start_date, backfill_to, state)
+
+        window_is_stale = state.covered_to < today or (now - state.refreshed_at).total_seconds() > max_age_secs
+        if end_date >= window_start and window_is_stale:
+            # refresh the trailing window, and whatever days passed since the last refresh
+            refresh_from = min(window_start, state.covered_to + timedelta(days=1))
+            state.covered_to = today
+            state.refreshed_at = now
+            self._fetch_and_save(chat_id, refresh_from, today, state)
+
+    def _load(self, row: MirroredTransaction) -> TransactionObject | None:
+        if not row.stale:
+            return TransactionObject.model_validate_json(row.payload)
+
+        # the bot changed this transaction since it was mirrored, so get its current version
+        try:
+            return self.refresh_transaction(row.chat_id, row.tx_id)
+        except Exception:
+            logger.exception(f"Could not refresh mirrored transaction {row.tx_id}, dropping it")
+            get_db().delete_mirrored_transaction(row.chat_id, row.tx_id)
+            return None
+
+    def _to_row(self, chat_id: int, tx: TransactionObject, synced_at: datetime) -> MirroredTransaction:
+        return MirroredTransaction(
+            chat_id=chat_id,
+            tx_id=tx.id,
+            date=tx.date,
+            is_pending=bool(tx.is_pending),
+            payload=tx.model_dump_json(),
+            stale=False,
+            synced_at=synced_at,
+        )
+
+    def _fetch_and_save(self, chat_id: int, start_date: date, end_date: date, state: TransactionSyncState) -> None:
+        lunch = get_lunch_client_for_chat_id(chat_id)
+        transactions: list[TransactionObject] = []
+        while True:
+            # pending=True makes Lunch Money include pending transactions in addition to posted ones
+            page = lunch.get_transactions(
+                start_date=start_date, end_date=end_date, pending=True, limit=MIRROR_PAGE_SIZE, offset=len(transactions)
+            )
+            get_db().inc_metric("transaction_mirror_fetches")
+            transactions += page
+            if len(page) < MIRROR_PAGE_SIZE:
+                break
+
+        logger.info(f"Mirrored {len(transactions)} transactions from {start_date} to {end_date} for chat {chat_id}")
+        rows = [self._to_row(chat_id, tx, state.refreshed_at) for tx in transactions]
+        get_db().save_mirrored_transactions(chat_id, start_date, end_date, rows, state)
+
+
+transaction_mirror = None
+
+
+def get_transaction_mirror() -> TransactionMirror:
+    global transaction_mirror
+    if transaction_mirror is None:
+        transaction_mirror = TransactionMirror()
+    return transaction_mirror
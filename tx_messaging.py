@@ -1,20 +1,220 @@
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
 import logging
 import os
-from datetime import datetime
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from enum import IntEnum
 
 import pytz
 from lunchable.models import TransactionObject
 from telegram import InlineKeyboardMarkup
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import ContextTypes
 
-from lunch import get_lunch_client_for_chat_id
-from persistence import get_db
+from async_persistence import get_async_db
+from lunch import get_async_lunch_client_for_chat_id
 from telegram_extensions import Update
+from transaction_mirror import get_transaction_mirror
 from utils import Keyboard, clean_md, make_tag
 
 logger = logging.getLogger("messaging")
 
+# Telegram allows about 30 messages per second overall and about one per second in a chat.
+# The global rate leaves some room for the messages that are not sent through the governor.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+# how many messages a chat can get at once before being held to TELEGRAM_CHAT_RATE
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+# how many times a send is retried after Telegram answers with RetryAfter
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "3"))
+
+
+class SendPriority(IntEnum):
+    """Lanes of the send governor. Lower values go first."""
+
+    # replies to something the user just did (a button, a reply, a command)
+    INTERACTIVE = 0
+    # messages the user is not waiting for, like polling and /resync
+    BULK = 1
+
+
+class TokenBucket:
+    """Allows `rate` operations per second, with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # set when Telegram asks us to back off
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        missing = max(0.0, 1 - self.tokens)
+        return max(missing / self.rate, self.blocked_until - now, 0.0)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now: float, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+@dataclass(order=True)
+class _PendingSend:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+
+
+class SendGovernor:
+    """Paces outgoing Telegram messages with a global and a per-chat token bucket.
+
+    Sends that can not go right away wait in a queue ordered by priority, then arrival, so
+    interactive replies jump ahead of bulk edits, also within the same chat. A send answered with
+    RetryAfter holds its chat for the requested time and is retried, instead of failing the
+    loop that sent it.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self._pending: list[_PendingSend] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        self.peak_depth = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def depth(self) -> dict[SendPriority, int]:
+        """Number of sends waiting in each lane."""
+        depth = dict.fromkeys(SendPriority, 0)
+        for pending in self._pending:
+            depth[SendPriority(pending.priority)] += 1
+        return depth
+
+    async def send[T](
+        self, chat_id: int | str, call: Callable[[], Awaitable[T]], priority: SendPriority = SendPriority.INTERACTIVE
+    ) -> T:
+        """Waits for the chat's turn, then awaits call(), retrying it when Telegram asks to back off."""
+        chat_id = int(chat_id)
+        retries = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                return await call()
+            except RetryAfter as e:
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Telegram asked to retry chat {chat_id} in {seconds}s (retry {retries})")
+                await get_async_db().inc_metric("telegram_retry_after")
+                self._chat_bucket(chat_id).block(time.monotonic(), seconds)
+
+    async def _acquire(self, chat_id: int, priority: SendPriority) -> None:
+        now = time.monotonic()
+        chat_bucket = self._chat_bucket(chat_id)
+        if not self._pending and self.global_bucket.wait_time(now) == 0 and chat_bucket.wait_time(now) == 0:
+            self.global_bucket.take(now)
+            chat_bucket.take(now)
+            return
+
+        loop = asyncio.get_running_loop()
+        pending = _PendingSend(priority, next(self._seq), chat_id, loop.create_future(), now)
+        bisect.insort(self._pending, pending)
+        self.peak_depth = max(self.peak_depth, len(self._pending))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        self._wakeup.set()
+
+        try:
+            await pending.future
+        finally:
+            if not pending.future.done():
+                # cancelled while waiting for its turn
+                pending.future.cancel()
+            if pending in self._pending:
+                self._pending.remove(pending)
+
+        await get_async_db().inc_metric("telegram_sends_delayed")
+        await get_async_db().inc_metric("telegram_send_wait_secs", time.monotonic() - pending.enqueued_at)
+
+    async def _dispatch(self) -> None:
+        """Hands out tokens to the queued sends for as long as there are any."""
+        while self._pending:
+            now = time.monotonic()
+            wait = self.global_bucket.wait_time(now)
+            if wait == 0:
+                released, wait = self._release_next(now)
+                if released or wait is None:
+                    continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except TimeoutError:
+                pass
+
+    def _release_next(self, now: float) -> tuple[bool, float | None]:
+        """Lets the first queued send whose chat has a token go.
+
+        Returns whether one went, and otherwise how long until one of the chats has a token
+        (None if nothing is waiting anymore).
+        """
+        wait = None
+        for pending in list(self._pending):
+            if pending.future.done():
+                self._pending.remove(pending)
+                continue
+            chat_bucket = self._chat_bucket(pending.chat_id)
+            chat_wait = chat_bucket.wait_time(now)
+            if chat_wait == 0:
+                self.global_bucket.take(now)
+                chat_bucket.take(now)
+                self._pending.remove(pending)
+                pending.future.set_result(None)
+                return True, None
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return False, wait
+
+
+send_governor = None
+
+
+def get_send_governor() -> SendGovernor:
+    global send_governor
+    if send_governor is None:
+        send_governor = SendGovernor(
+            TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_SEND_MAX_RETRIES
+        )
+    return send_governor
+
 
 def _add_expanded_buttons(
     kbd: Keyboard, transaction_id: int, recurring_type, is_pending: bool, is_reviewed: bool, plaid_id, ai_agent=False
@@ -48,17 +248,17 @@ def _add_expanded_buttons(
     return kbd
 
 
-def get_tx_buttons(chat_id: int, transaction: TransactionObject | int, collapsed=True) -> InlineKeyboardMarkup:
+async def get_tx_buttons(chat_id: int, transaction: TransactionObject | int, collapsed=True) -> InlineKeyboardMarkup:
     """Returns a list of buttons to be displayed for a transaction."""
     # if transaction is an int, it's a transaction_id, so we fetch it from the API
     if isinstance(transaction, int):
-        lunch = get_lunch_client_for_chat_id(chat_id)
+        lunch = get_async_lunch_client_for_chat_id(chat_id)
         # assume the transaction is persisted if a transaction_id is provided
         tx_id = transaction
-        transaction = lunch.get_transaction(tx_id)
+        transaction = await lunch.get_transaction(tx_id)
 
     # Fetch settings and ai_agent value
-    settings = get_db().get_current_settings(chat_id)
+    settings = await get_async_db().get_current_settings(chat_id)
     ai_agent = settings.ai_agent if settings else False
 
     tx_id = transaction.id
@@ -174,49 +374,161 @@ def format_transaction_message(transaction: TransactionObject, tagging: bool, sh
     return message
 
 
+async def render_transaction(transaction: TransactionObject, chat_id: str | int) -> tuple[str, InlineKeyboardMarkup]:
+    """Returns the text and the buttons of the message of a transaction."""
+    settings = await get_async_db().get_current_settings(chat_id)
+    # Ensure settings fields are bool, not SQLAlchemy Columns
+    show_datetime = settings.show_datetime if settings else True
+    tagging = settings.tagging if settings else True
+
+    message = format_transaction_message(transaction, tagging, show_datetime)
+    return message, await get_tx_buttons(int(chat_id), transaction)
+
+
+def render_hash(message: str, reply_markup: InlineKeyboardMarkup) -> str:
+    """Fingerprint of a rendered message, to tell whether editing it would change anything."""
+    rendered = json.dumps([message, reply_markup.to_dict()], sort_keys=True)
+    return hashlib.sha256(rendered.encode()).hexdigest()
+
+
 async def send_transaction_message(
     context: ContextTypes.DEFAULT_TYPE,
     transaction: TransactionObject,
     chat_id: str | int,
     message_id: int | None = None,
     reply_to_message_id: int | None = None,
+    *,
+    priority: SendPriority = SendPriority.INTERACTIVE,
 ) -> int:
     """Sends a message to the chat_id with the details of a transaction.
-    If message_id is provided, edits the existing"""
-    settings = get_db().get_current_settings(chat_id)
-    # Ensure settings fields are bool, not SQLAlchemy Columns
-    show_datetime = settings.show_datetime if settings else True
-    tagging = settings.tagging if settings else True
+    If message_id is provided, edits the existing. Messages go through the send governor,
+    in the given priority lane."""
+    if message_id:
+        await edit_transaction_message(context, transaction, chat_id, message_id, priority=priority)
+        return message_id
+
+    message_id, _ = await send_new_transaction_message(
+        context, transaction, chat_id, reply_to_message_id, priority=priority
+    )
+    return message_id
 
-    message = format_transaction_message(transaction, tagging, show_datetime)
 
+async def send_new_transaction_message(
+    context: ContextTypes.DEFAULT_TYPE,
+    transaction: TransactionObject,
+    chat_id: str | int,
+    reply_to_message_id: int | None = None,
+    *,
+    priority: SendPriority = SendPriority.INTERACTIVE,
+) -> tuple[int, str]:
+    """Sends a new message with the details of a transaction. Returns its id and its render hash,
+    which is stored when the message is recorded as sent, so the first re-render can be skipped
+    if nothing changed."""
+    message, reply_markup = await render_transaction(transaction, chat_id)
     logger.info(f"Sending message to chat_id {chat_id} (tx id: {transaction.id}): {message}")
-    get_db().inc_metric("sent_transaction_messages")
-    if message_id:
-        # edit existing message
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=get_tx_buttons(int(chat_id), transaction.id),
-            )
-        except Exception as e:
-            if "Message is not modified" in str(e):
-                logger.debug(f"Message is not modified, skipping edit ({message_id})")
-            else:
-                raise
-        return message_id
-    else:
-        msg = await context.bot.send_message(
+    await get_async_db().inc_metric("sent_transaction_messages")
+    msg = await get_send_governor().send(
+        chat_id,
+        lambda: context.bot.send_message(
             chat_id=chat_id,
             text=message,
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=get_tx_buttons(int(chat_id), transaction),
+            reply_markup=reply_markup,
             reply_to_message_id=reply_to_message_id,
+        ),
+        priority,
+    )
+    return msg.id, render_hash(message, reply_markup)
+
+
+async def edit_transaction_message(
+    context: ContextTypes.DEFAULT_TYPE,
+    transaction: TransactionObject,
+    chat_id: str | int,
+    message_id: int,
+    *,
+    priority: SendPriority = SendPriority.INTERACTIVE,
+) -> bool:
+    """Edits the message of a transaction. Returns False if the edit was skipped because nothing changed.
+
+    The hash of what gets rendered is stored with the transaction, so rendering the same text
+    and buttons again is detected locally instead of spending a Telegram call on it.
+    """
+    message, reply_markup = await render_transaction(transaction, chat_id)
+    new_render_hash = render_hash(message, reply_markup)
+    if new_render_hash == await get_async_db().get_render_hash(int(chat_id), message_id):
+        logger.debug(f"Message would render the same, skipping edit ({message_id})")
+        await get_async_db().inc_metric("avoided_transaction_edits")
+        return False
+
+    logger.info(f"Editing message {message_id} in chat_id {chat_id} (tx id: {transaction.id}): {message}")
+    await get_async_db().inc_metric("sent_transaction_messages")
+    edited = True
+    try:
+        await get_send_governor().send(
+            chat_id,
+            lambda: context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=message,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=reply_markup,
+            ),
+            priority,
         )
-        return msg.id
+    except Exception as e:
+        if "Message is not modified" in str(e):
+            logger.debug(f"Message is not modified, skipping edit ({message_id})")
+            edited = False
+        else:
+            raise
+    await get_async_db().save_render_hashes(int(chat_id), {message_id: new_render_hash})
+    return edited
+
+
+async def edit_transaction_buttons(update: Update, reply_markup: InlineKeyboardMarkup | None, **kwargs):
+    """Replaces only the buttons of the transaction message a callback came from (menus, expand, collapse)."""
+    result = await update.safe_edit_message_reply_markup(reply_markup=reply_markup, **kwargs)
+    if update.callback_query and update.callback_query.message:
+        # the message no longer shows what its stored render hash describes
+        await get_async_db().save_render_hashes(update.chat_id, {update.callback_query.message.message_id: None})
+    return result
+
+
+async def render_updated_transaction(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, transaction_id: int, message_id: int | None
+) -> TransactionObject:
+    """Re-renders the message of a transaction right after the bot updated it.
+
+    The locally updated copy kept by the transaction mirror is rendered right away, so the update
+    costs a single API call. The transaction is then fetched in the background, and the message
+    is corrected if Lunch Money ended up with something different. Transactions that are not
+    mirrored are fetched before rendering.
+    """
+    mirror = get_transaction_mirror()
+    transaction = mirror.peek_transaction(chat_id, transaction_id)
+    if transaction is None:
+        transaction = await mirror.refresh_transaction_async(chat_id, transaction_id)
+        await send_transaction_message(context, transaction, chat_id, message_id)
+        return transaction
+
+    await get_async_db().inc_metric("optimistic_transaction_renders")
+    message_id = await send_transaction_message(context, transaction, chat_id, message_id)
+    context.application.create_task(_reconcile_transaction_message(context, chat_id, transaction, message_id))
+    return transaction
+
+
+async def _reconcile_transaction_message(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, rendered: TransactionObject, message_id: int
+) -> None:
+    try:
+        transaction = await get_transaction_mirror().refresh_transaction_async(chat_id, rendered.id)
+        # the edit is skipped when the transaction renders the same as its local update
+        if await edit_transaction_message(context, transaction, chat_id, message_id, priority=SendPriority.BULK):
+            logger.info(f"Transaction {rendered.id} differs from its local update, rendered it again")
+            await get_async_db().inc_metric("optimistic_transaction_corrections")
+    except Exception:
+        logger.exception(f"Error reconciling transaction {rendered.id} with Lunch Money")
 
 
 async def send_plaid_details(
@@ -238,7 +550,7 @@ async def send_plaid_details(
         else None,
     )
 
-    lunch = get_lunch_client_for_chat_id(chat_id)
-    transaction = lunch.get_transaction(transaction_id)
+    lunch = get_async_lunch_client_for_chat_id(chat_id)
+    transaction = await lunch.get_transaction(transaction_id)
 
-    await update.safe_edit_message_reply_markup(reply_markup=get_tx_buttons(chat_id, transaction))
+    await edit_transaction_buttons(update, await get_tx_buttons(chat_id, transaction))
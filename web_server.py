@@ -8,8 +8,10 @@ from datetime import datetime, timedelta
 from urllib.parse import unquote
 
 from aiohttp import web
+from telegram import Update
 
-from lunch import get_lunch_client_for_chat_id
+from lunch import get_async_lunch_client_for_chat_id, lunch_clients_cache, lunch_transport
+from tx_messaging import SendPriority, get_send_governor
 
 # Initialize logger
 logger = logging.getLogger("web_server")
@@ -28,12 +30,26 @@ bot_instance = None  # Add this line to store bot instance
 
 bot_info_cache = None
 
+# where Telegram posts the updates when running in webhook mode
+TELEGRAM_WEBHOOK_PATH = "/telegram/webhook"
+
+# the Application that receives the updates posted to the webhook (None when polling)
+webhook_application = None
+webhook_secret_token = ""
+
 
 def set_bot_instance(bot):
     global bot_instance
     bot_instance = bot
 
 
+def enable_telegram_webhook(application, secret_token: str):
+    """Makes the web server accept Telegram updates and feed them to the application."""
+    global webhook_application, webhook_secret_token
+    webhook_application = application
+    webhook_secret_token = secret_token
+
+
 async def get_bot_info():
     global bot_info_cache
     if bot_instance:
@@ -60,7 +76,8 @@ def update_bot_status(is_running: bool, error: str = ""):
 def get_db_size():
     db_path = os.getenv("DB_PATH", "lonchera.db")
     if os.path.exists(db_path):
-        size_bytes = os.path.getsize(db_path)
+        # in WAL mode recent writes live in the -wal file until the next checkpoint
+        size_bytes = sum(os.path.getsize(path) for path in (db_path, f"{db_path}-wal") if os.path.exists(path))
         size_mb = size_bytes / (1024 * 1024)
         return f"{size_mb:.2f} MB"
     return "DB not found"
@@ -113,6 +130,21 @@ def get_ai_status():
     return f"AI enabled (key: {api_key[:4]}...)"
 
 
+def get_send_queue_status():
+    governor = get_send_governor()
+    depth = governor.depth()
+    interactive, bulk = depth[SendPriority.INTERACTIVE], depth[SendPriority.BULK]
+    return f"{interactive} interactive, {bulk} bulk (peak {governor.peak_depth})"
+
+
+def get_lunch_clients_status():
+    return (
+        f"{len(lunch_clients_cache)} clients (max {lunch_clients_cache.max_size}, "
+        f"{lunch_clients_cache.evictions} evicted), "
+        f"{lunch_transport.in_use} connections in use (max {lunch_transport.max_connections})"
+    )
+
+
 async def handle_root(request):
     db_size = get_db_size()
     uptime_seconds = time.time() - start_time
@@ -135,6 +167,8 @@ async def handle_root(request):
     bot_status_text = "running" if application_running() else "crashing"
     bot_token = get_masked_token()
     ai_status = get_ai_status()
+    send_queue = get_send_queue_status()
+    lunch_clients = get_lunch_clients_status()
 
     app_name = os.getenv("FLY_APP_NAME", "lonchera")
 
@@ -163,6 +197,8 @@ async def handle_root(request):
         {commit_info}
         bot token: {bot_token}
         ai status: {ai_status}
+        send queue: {send_queue}
+        lunch clients: {lunch_clients}
         bot status: {bot_status_text}
         {status_details}
     </body>
@@ -176,9 +212,9 @@ async def handle_manual_tx_endpoint(request):
     logger.info("Serving manual tx page for chat id %s", chat_id)
 
     # Generate account options
-    lunch = get_lunch_client_for_chat_id(int(chat_id))
+    lunch = get_async_lunch_client_for_chat_id(int(chat_id))
     account_options = "<option value=''>Select account...</option>"
-    assets = lunch.get_assets()
+    assets = await lunch.get_assets()
     only_accounts = [asset for asset in assets if asset.type_name in {"credit", "cash"}]
     if only_accounts:
         account_options += "<option disabled>Manually-managed accounts</option>"
@@ -187,7 +223,7 @@ async def handle_manual_tx_endpoint(request):
             account_options += f'<option value="{asset.id}">└ {asset.name} (${balance})</option>'
 
     # Generate category options
-    categories = lunch.get_categories()
+    categories = await lunch.get_categories()
     super_categories = [cat for cat in categories if cat.is_group]
     subcategories = [cat for cat in categories if cat.group_id is not None]
     standalone_categories = [cat for cat in categories if not cat.is_group and cat.group_id is None]
@@ -240,11 +276,33 @@ async def handle_validate(request):
     return web.json_response({"valid": is_valid})
 
 
+async def handle_telegram_webhook(request):
+    if webhook_application is None:
+        return web.Response(status=404)
+
+    # Telegram sends back the secret token given to setWebhook, which proves the request comes from it
+    secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret_token, webhook_secret_token):
+        logger.warning(f"Rejected webhook request from {request.remote} with an invalid secret token")
+        return web.Response(status=403)
+
+    try:
+        update = Update.de_json(await request.json(), webhook_application.bot)
+    except ValueError:
+        logger.warning("Rejected webhook request with an invalid body")
+        return web.Response(status=400)
+
+    # the Application processes it like any update fetched by polling
+    await webhook_application.update_queue.put(update)
+    return web.Response()
+
+
 async def run_web_server():
     app = web.Application()
     app.router.add_get("/", handle_root)
     app.router.add_get("/manual_tx/{chat_id}", handle_manual_tx_endpoint)
     app.router.add_post("/validate", handle_validate)
+    app.router.add_post(TELEGRAM_WEBHOOK_PATH, handle_telegram_webhook)
 
     runner = web.AppRunner(app)
     await runner.setup()